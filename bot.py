@@ -1,17 +1,61 @@
 import os
 import re
+import sys
 import json
 import time
+import atexit
+import signal
 import random
 import subprocess
 import threading
 import traceback
 import shutil
 import glob
+import hashlib
+import heapq
+import itertools
+import sqlite3
+import asyncio
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, fields, replace
 from datetime import datetime, timezone, timedelta
 from html import escape as html_escape
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Optional fast serializers for state.json (see STATE_SERIALIZER).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+# Optional websocket client for the Kick push source (see KICK_PUSH_ENABLED).
+try:
+    import websocket
+
+    _WS_TIMEOUTS = (TimeoutError, websocket.WebSocketTimeoutException)
+except ImportError:
+    websocket = None
+    _WS_TIMEOUTS = (TimeoutError,)
+# Optional HTTP/2 client for Kick/VK/images (see HTTP2_ENABLED); needs httpx[http2].
+try:
+    import httpx
+except ImportError:
+    httpx = None
+# Optional async HTTP client for the asyncio runtime (see ASYNC_RUNTIME).
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 # ========== CONFIG (ENV) ==========
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
@@ -55,9 +99,34 @@ PUBG_CATEGORY_MATCH = os.getenv("PUBG_CATEGORY_MATCH", "PUBG: Battlegrounds").st
 
 KICK_SLUG = os.getenv("KICK_SLUG", "gladvalakaspwnz").strip()
 VK_SLUG = os.getenv("VK_SLUG", "gladvalakas").strip()
+STREAMER_NAME = os.getenv("STREAMER_NAME", "Глад Валакас").strip()
+
+# More channels to watch from the same process (the channel above is always "main"). JSON list, e.g.
+# [{"id": "foo", "name": "Foo", "kick": "foo_kick", "vk": "foo", "chat_id": -100123, "topic_id": 5}]
+# Optional per channel: "pubg_chat_id", "pubg_topic_id". Inline in CHANNELS_JSON or a file in CHANNELS_FILE.
+CHANNELS_JSON = os.getenv("CHANNELS_JSON", "").strip()
+CHANNELS_FILE = os.getenv("CHANNELS_FILE", "").strip()
+CHANNEL_WORKERS = int(os.getenv("CHANNEL_WORKERS", "4"))  # channels ticked in parallel
 
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "30"))
+# Adaptive per-platform cadence (POLL_INTERVAL stays the default "steady" rate).
+POLL_SCHED_ENABLED = os.getenv("POLL_SCHED_ENABLED", "1").strip() not in {"0", "false", "False"}
+POLL_LIVE_SEC = int(os.getenv("POLL_LIVE_SEC", str(POLL_INTERVAL)))  # while a stream is on
+POLL_HOT_SEC = int(os.getenv("POLL_HOT_SEC", "10"))  # offline, in an hour when streams usually start
+POLL_IDLE_SEC = int(os.getenv("POLL_IDLE_SEC", "90"))  # offline for a long time, outside hot hours
+POLL_IDLE_AFTER_SEC = int(os.getenv("POLL_IDLE_AFTER_SEC", str(6 * 3600)))
+POLL_HOT_MIN_STARTS = int(os.getenv("POLL_HOT_MIN_STARTS", "2"))  # past starts in the hour (±1 h) to call it hot
 STATE_FILE = os.getenv("STATE_FILE", "state.json")
+# State lives in RAM; dirty changes are flushed to STATE_FILE at most once per this interval.
+STATE_FLUSH_SEC = int(os.getenv("STATE_FLUSH_SEC", "5"))
+# Journaled persistence: flushes append field-level changes to a log instead of rewriting state.json;
+# the log is compacted into a fresh snapshot once it grows past STATE_JOURNAL_MAX_BYTES.
+STATE_JOURNAL_ENABLED = os.getenv("STATE_JOURNAL_ENABLED", "1").strip() not in {"0", "false", "False"}
+STATE_JOURNAL_FILE = os.getenv("STATE_JOURNAL_FILE", STATE_FILE + ".journal")
+STATE_JOURNAL_MAX_BYTES = int(os.getenv("STATE_JOURNAL_MAX_BYTES", str(256 * 1024)))
+# auto = orjson if installed, else stdlib json: state.json stays JSON either way, so an older bot can read it.
+# msgpack is opt-in only (binary, prefixed with STATE_MSGPACK_MAGIC). Loading detects the format.
+STATE_SERIALIZER = os.getenv("STATE_SERIALIZER", "auto").strip().lower()
 
 START_DEDUP_SEC = int(os.getenv("START_DEDUP_SEC", "120"))
 CHANGE_DEDUP_SEC = int(os.getenv("CHANGE_DEDUP_SEC", "20"))
@@ -70,8 +139,14 @@ COMMANDS_ENABLED = os.getenv("COMMANDS_ENABLED", "1").strip() not in {"0", "fals
 COMMAND_POLL_TIMEOUT = int(os.getenv("COMMAND_POLL_TIMEOUT", "5"))
 # IMPORTANT: HTTP timeout must be > long-poll timeout, otherwise you'll see ReadTimeout on getUpdates.
 COMMAND_HTTP_TIMEOUT = int(os.getenv("COMMAND_HTTP_TIMEOUT", "20"))
-COMMAND_STATE_SAVE_SEC = int(os.getenv("COMMAND_STATE_SAVE_SEC", "60"))
 STATUS_COMMANDS = {"/status", "/stream", "/patok", "/state", "/стрим", "/паток"}
+HISTORY_COMMANDS = {"/history", "/история"}
+
+# Stream history archive (SQLite, WAL). Every finished session is kept for /history.
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1").strip() not in {"0", "false", "False"}
+HISTORY_DB_FILE = os.getenv("HISTORY_DB_FILE", "history.db")
+HISTORY_DEFAULT_LIMIT = int(os.getenv("HISTORY_DEFAULT_LIMIT", "5"))
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", "20"))
 
 # Admin
 ADMIN_ID = 417850992
@@ -93,13 +168,113 @@ HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "1.6"))
 HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "15"))
 HTTP_JITTER = os.getenv("HTTP_JITTER", "1").strip() not in {"0", "false", "False"}
 
+# Per-tick time budget: every timeout, retry and backoff inside one main loop iteration is clamped to it.
+TICK_DEADLINE_SEC = float(os.getenv("TICK_DEADLINE_SEC", "60"))
+FETCH_DEADLINE_SEC = float(os.getenv("FETCH_DEADLINE_SEC", "20"))  # Kick/VK fetch share of the tick budget
+# Hedged Kick requests: if the first one is slower than this percentile of recent latencies, send a duplicate.
+KICK_HEDGE_ENABLED = os.getenv("KICK_HEDGE_ENABLED", "1").strip() not in {"0", "false", "False"}
+KICK_HEDGE_PERCENTILE = float(os.getenv("KICK_HEDGE_PERCENTILE", "90"))
+KICK_HEDGE_MIN_SEC = float(os.getenv("KICK_HEDGE_MIN_SEC", "0.5"))
+KICK_HEDGE_MIN_SAMPLES = int(os.getenv("KICK_HEDGE_MIN_SAMPLES", "10"))
+
+# Optional push source: Kick's public websocket (Pusher protocol) announces stream start/stop/title
+# changes. Needs websocket-client and the numeric Kick channel id (KICK_CHANNEL_ID / "kick_channel_id").
+# While subscribed, offline Kick polling slows to KICK_PUSH_RECONCILE_SEC.
+KICK_PUSH_ENABLED = os.getenv("KICK_PUSH_ENABLED", "0").strip() in {"1", "true", "True"}
+KICK_PUSH_URL = os.getenv(
+    "KICK_PUSH_URL",
+    "wss://ws-us2.pusher.com/app/32cbd69e4b950bf97679?protocol=7&client=js&version=8.4.0&flash=false",
+).strip()
+KICK_PUSH_RECONCILE_SEC = int(os.getenv("KICK_PUSH_RECONCILE_SEC", "300"))
+KICK_PUSH_TRUST_SEC = int(os.getenv("KICK_PUSH_TRUST_SEC", "120"))  # a push event overrides a lagging API this long
+KICK_PUSH_PING_SEC = int(os.getenv("KICK_PUSH_PING_SEC", "60"))
+
+# HTTP transport. Pool sizes are per host (connections kept open to one host); the Kick/VK pool must
+# cover the fetch pool plus hedged duplicates or urllib3 discards connections. Keep-alive: a host idle
+# for HTTP_KEEPALIVE_SEC gets a cheap HEAD shortly before its next expected use, so START alerts don't
+# pay DNS + TCP + TLS again after a quiet stretch (0 disables).
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", str(max(10, 4 * CHANNEL_WORKERS))))
+TG_POOL_MAXSIZE = int(os.getenv("TG_POOL_MAXSIZE", "10"))
+HTTP_KEEPALIVE_SEC = int(os.getenv("HTTP_KEEPALIVE_SEC", "45"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0").strip() in {"1", "true", "True"}
+
+# Per-host circuit breaker for external hosts: after repeated failures, requests to that host fail fast
+# for a cool-down instead of burning the whole retry/timeout budget every tick.
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "1").strip() not in {"0", "false", "False"}
+BREAKER_WINDOW_SEC = int(os.getenv("BREAKER_WINDOW_SEC", "120"))
+BREAKER_MIN_FAILURES = int(os.getenv("BREAKER_MIN_FAILURES", "3"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_COOLDOWN_SEC = int(os.getenv("BREAKER_COOLDOWN_SEC", "60"))
+BREAKER_COOLDOWN_MAX_SEC = int(os.getenv("BREAKER_COOLDOWN_MAX_SEC", "600"))
+
 # Telegram retry strategy (keep smaller to avoid command loop stalls)
 TG_RETRIES = int(os.getenv("TG_RETRIES", "2"))
 TG_BACKOFF_BASE = float(os.getenv("TG_BACKOFF_BASE", "1.3"))
 TG_BACKOFF_MAX = float(os.getenv("TG_BACKOFF_MAX", "4"))
 
+# Fire-and-forget Telegram sends (PUBG duplicates, admin notices) are retried by a background scheduler
+# instead of sleeping in the caller: one attempt inline in a worker, then re-queued with a due time.
+RETRY_SCHED_ENABLED = os.getenv("RETRY_SCHED_ENABLED", "1").strip() not in {"0", "false", "False"}
+RETRY_WORKERS = int(os.getenv("RETRY_WORKERS", "2"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_MAX_DELAY_SEC = float(os.getenv("RETRY_MAX_DELAY_SEC", "60"))
+
+# Outbound queue: alerts are enqueued by the main loop and sent by OUTBOX_WORKERS sender threads in
+# priority order (start/end > change > PUBG duplicates > admin notices), first-in first-out per chat.
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "1").strip() not in {"0", "false", "False"}
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_JOB_DEADLINE_SEC = float(os.getenv("OUTBOX_JOB_DEADLINE_SEC", "90"))  # screenshot + upload, per attempt
+
+# Live card: the START alert is pinned and edited in place while the stream runs (viewers, running time,
+# title/category; the refresher's cached screenshot every LIVE_CARD_MEDIA_SEC, see SHOT_REFRESH_SEC) and becomes the
+# end report at END.
+# Title/category changes update the card instead of posting a new message.
+LIVE_CARD_ENABLED = os.getenv("LIVE_CARD_ENABLED", "0").strip() in {"1", "true", "True"}
+LIVE_CARD_PIN = os.getenv("LIVE_CARD_PIN", "1").strip() not in {"0", "false", "False"}
+LIVE_CARD_EDIT_SEC = int(os.getenv("LIVE_CARD_EDIT_SEC", "60"))
+LIVE_CARD_CHANGE_SEC = int(os.getenv("LIVE_CARD_CHANGE_SEC", "10"))  # min gap when title/category changed
+LIVE_CARD_MEDIA_SEC = int(os.getenv("LIVE_CARD_MEDIA_SEC", "300"))
+
+# Client-side Telegram rate limit (token buckets): global messages/sec, per group chat messages/min,
+# per private chat messages/sec; TG_CHAT_BURST messages may go out back to back. A 429's retry_after
+# blocks the chat's bucket even when TG_RATE_LIMIT_ENABLED=0. Waits up to TG_RATE_MAX_WAIT_SEC are slept
+# by the sender; a longer wait (or a blocked bucket) raises TgRateLimited and the message is re-queued.
+TG_RATE_LIMIT_ENABLED = os.getenv("TG_RATE_LIMIT_ENABLED", "1").strip() not in {"0", "false", "False"}
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_GROUP_RATE_PER_MIN = float(os.getenv("TG_GROUP_RATE_PER_MIN", "20"))
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_RATE_MAX_WAIT_SEC = float(os.getenv("TG_RATE_MAX_WAIT_SEC", "1"))
+
 LOOP_CRASH_SLEEP = int(os.getenv("LOOP_CRASH_SLEEP", "2"))
 
+# Opt-in asyncio runtime (needs aiohttp): Kick/VK polling, getUpdates long-polling, command replies, ffmpeg and
+# the commands watchdog are tasks on one event loop with an async HTTP client. Alerts still go out through the
+# outbound queue's sender threads. Without aiohttp the threaded runtime is used.
+ASYNC_RUNTIME = os.getenv("ASYNC_RUNTIME", "0").strip() in {"1", "true", "True"}
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", "256"))  # open connections and command handlers
+ASYNC_EXECUTOR_WORKERS = int(os.getenv("ASYNC_EXECUTOR_WORKERS", "8"))  # state, SQLite and parsing off the loop
+
+# Kick and VK are fetched in parallel; timings are logged every N fetches (and always when slow).
+FETCH_TIMING_LOG_EVERY = int(os.getenv("FETCH_TIMING_LOG_EVERY", "10"))
+FETCH_SLOW_LOG_SEC = float(os.getenv("FETCH_SLOW_LOG_SEC", "5"))
+# Conditional GET (ETag / Last-Modified) + skip re-parsing when the payload is byte-identical to the last one.
+FETCH_CONDITIONAL_ENABLED = os.getenv("FETCH_CONDITIONAL_ENABLED", "1").strip() not in {"0", "false", "False"}
+# Kick/VK bodies are streamed and read only until the needed fields are in; never more than the cap.
+FETCH_CHUNK_BYTES = int(os.getenv("FETCH_CHUNK_BYTES", "16384"))
+KICK_MAX_BYTES = int(os.getenv("KICK_MAX_BYTES", str(512 * 1024)))
+VK_MAX_BYTES = int(os.getenv("VK_MAX_BYTES", str(3 * 1024 * 1024)))
+
+# VK fast path: the public JSON stream-info endpoint ({slug} is the channel's VK slug). The HTML page
+# scrape is only the fallback when the JSON request or its parse fails.
+VK_JSON_ENABLED = os.getenv("VK_JSON_ENABLED", "1").strip() not in {"0", "false", "False"}
+VK_API_URL = os.getenv("VK_API_URL", "https://api.live.vkvideo.ru/v1/blog/{slug}/public_video_stream").strip()
+VK_API_MAX_BYTES = int(os.getenv("VK_API_MAX_BYTES", str(256 * 1024)))
+# One attempt with a short timeout; after a failure the JSON path is skipped for this long.
+VK_API_TIMEOUT_SEC = float(os.getenv("VK_API_TIMEOUT_SEC", "6"))
+VK_JSON_COOLDOWN_SEC = int(os.getenv("VK_JSON_COOLDOWN_SEC", "600"))
+
 # ffmpeg
 FFMPEG_ENABLED = os.getenv("FFMPEG_ENABLED", "1").strip() not in {"0", "false", "False"}
 FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg").strip()
@@ -110,13 +285,19 @@ FFMPEG_SCALE = os.getenv("FFMPEG_SCALE", "1280:-1").strip()
 MAX_TITLE_LEN = int(os.getenv("MAX_TITLE_LEN", "180"))
 MAX_GAME_LEN = int(os.getenv("MAX_GAME_LEN", "120"))
 END_CONFIRM_STREAK = int(os.getenv("END_CONFIRM_STREAK", "2"))
+# Transition probes: when any_live flips, the affected platforms are re-polled every CONFIRM_PROBE_SEC
+# (up to CONFIRM_PROBES times) instead of at the next regular tick (0 disables). END still needs
+# END_CONFIRM_STREAK offline polls, and they must span at least END_CONFIRM_MIN_SEC.
+CONFIRM_PROBE_SEC = int(os.getenv("CONFIRM_PROBE_SEC", "5"))
+CONFIRM_PROBES = int(os.getenv("CONFIRM_PROBES", "3"))
+END_CONFIRM_MIN_SEC = int(os.getenv("END_CONFIRM_MIN_SEC", "10"))
 
 # 409 notify dedup
 NOTIFY_409_EVERY_SEC = 6 * 60 * 60
 
 # Disk cleanup
 DISK_CHECK_INTERVAL = int(os.getenv("DISK_CHECK_INTERVAL", "100"))
-MAX_STATE_SIZE = 1024 * 50
+MAX_STATE_SIZE = 1024 * 50  # per configured channel
 TEMP_CLEANUP_AGE_SEC = 3600
 ERROR_DEDUP_SEC = 300
 
@@ -131,35 +312,311 @@ KICK_API_URL = f"https://kick.com/api/v1/channels/{KICK_SLUG}"
 KICK_PUBLIC_URL = f"https://kick.com/{KICK_SLUG}"
 VK_PUBLIC_URL = f"https://live.vkvideo.ru/{VK_SLUG}"
 
+
+# ========== CHANNELS ==========
+
+@dataclass(slots=True, frozen=True)
+class Channel:
+    """One watched streamer: where to poll and where to post."""
+    id: str
+    name: str
+    kick_slug: str
+    vk_slug: str
+    chat_id: int
+    topic_id: int | None = None
+    pubg_chat_id: int | None = None
+    pubg_topic_id: int | None = None
+    kick_channel_id: int | None = None  # numeric id for the websocket push source
+
+    @property
+    def is_main(self) -> bool:
+        return self.id == "main"
+
+    @property
+    def kick_api_url(self) -> str:
+        return f"https://kick.com/api/v1/channels/{self.kick_slug}"
+
+    @property
+    def kick_public_url(self) -> str:
+        return f"https://kick.com/{self.kick_slug}"
+
+    @property
+    def vk_public_url(self) -> str:
+        return f"https://live.vkvideo.ru/{self.vk_slug}"
+
+    @property
+    def vk_api_url(self) -> str:
+        return VK_API_URL.format(slug=self.vk_slug)
+
+
+MAIN_CHANNEL = Channel(
+    id="main",
+    name=STREAMER_NAME,
+    kick_slug=KICK_SLUG,
+    vk_slug=VK_SLUG,
+    chat_id=GROUP_ID,
+    topic_id=TOPIC_ID,
+    pubg_chat_id=PUBG_DUPLICATE_CHAT_ID,
+    pubg_topic_id=PUBG_DUPLICATE_TOPIC_ID,
+    kick_channel_id=int(os.getenv("KICK_CHANNEL_ID")) if os.getenv("KICK_CHANNEL_ID", "").strip() else None,
+)
+
+
+def _load_channels() -> list:
+    raw = CHANNELS_JSON
+    if not raw and CHANNELS_FILE:
+        with open(CHANNELS_FILE, "r", encoding="utf-8") as f:
+            raw = f.read()
+    out = [MAIN_CHANNEL]
+    if not raw:
+        return out
+    seen = {"main"}
+    for item in json.loads(raw):
+        cid = str(item.get("id") or item.get("kick") or item.get("vk") or "").strip()
+        if not cid or cid in seen:
+            raise ValueError(f"CHANNELS: missing or duplicate id: {item}")
+        seen.add(cid)
+        topic = item.get("topic_id")
+        out.append(
+            Channel(
+                id=cid,
+                name=str(item.get("name") or cid),
+                kick_slug=str(item.get("kick") or item.get("kick_slug") or cid),
+                vk_slug=str(item.get("vk") or item.get("vk_slug") or cid),
+                chat_id=int(item.get("chat_id") or GROUP_ID),
+                topic_id=int(topic) if topic is not None else None,
+                pubg_chat_id=int(item["pubg_chat_id"]) if item.get("pubg_chat_id") is not None else None,
+                pubg_topic_id=int(item["pubg_topic_id"]) if item.get("pubg_topic_id") is not None else None,
+                kick_channel_id=int(item["kick_channel_id"]) if item.get("kick_channel_id") is not None else None,
+            )
+        )
+    return out
+
+
+CHANNELS = _load_channels()
+
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
 HEADERS_JSON = {"User-Agent": UA, "Accept": "application/json,text/plain,*/*"}
 HEADERS_HTML = {"User-Agent": UA, "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"}
 
-STATE_LOCK = threading.Lock()
+# Concern locks: each one serializes read-modify-write of its own group of state fields.
+# Commits are field-level (see save_state), so different concerns never block each other.
+STATE_LOCK = threading.Lock()         # stream state: main loop + /stream cache miss
+TG_STATE_LOCK = threading.Lock()      # Telegram polling: updates_offset, poll/command ts, admin chat
+NOTIFY_STATE_LOCK = threading.Lock()  # notification anti-spam: 409 / quota
+
+FETCH_POOL = ThreadPoolExecutor(max_workers=max(4, 2 * CHANNEL_WORKERS), thread_name_prefix="fetch")  # main loop + /stream cache miss
+
+
+# ========== HTTP TRANSPORT ==========
+# Both sessions keep connections alive per host; TLS is negotiated once per pooled connection, so
+# reuse (plus the keep-alive pings) is what saves the handshake. transport_request() records whether a
+# request opened a new connection and how long the headers took, so /admin can show the difference.
+
+class _RawStream:
+    """File-like body for a requests.Response built from an httpx streaming response."""
+
+    def __init__(self, resp):
+        self._resp = resp
+        self._it = resp.iter_bytes()
+        self._buf = b""
+
+    def read(self, n=-1, **_kw) -> bytes:
+        while n < 0 or len(self._buf) < n:
+            try:
+                self._buf += next(self._it)
+            except StopIteration:
+                break
+        if n < 0:
+            out, self._buf = self._buf, b""
+        else:
+            out, self._buf = self._buf[:n], self._buf[n:]
+        return out
+
+    def close(self) -> None:
+        self._resp.close()
+
+    def release_conn(self) -> None:
+        self._resp.close()
+
+
+class _H2Adapter(BaseAdapter):
+    """requests transport adapter backed by an httpx HTTP/2 client (one multiplexed connection per host)."""
+
+    def __init__(self, max_connections: int):
+        super().__init__()
+        limits = httpx.Limits(max_connections=max_connections, keepalive_expiry=max(5, HTTP_KEEPALIVE_SEC * 2))
+        self.client = httpx.Client(http2=True, limits=limits, follow_redirects=False)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            to = httpx.Timeout(read, connect=connect)
+        else:
+            to = httpx.Timeout(timeout)
+        body = request.body
+        if body is not None and hasattr(body, "read"):
+            body = body.read()
+        t0 = time.monotonic()
+        try:
+            hreq = self.client.build_request(request.method, request.url, headers=dict(request.headers), content=body, timeout=to)
+            hresp = self.client.send(hreq, stream=True)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e), request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e), request=request)
+        r = requests.Response()
+        r.status_code = hresp.status_code
+        r.reason = hresp.reason_phrase
+        # iter_bytes() already undoes Content-Encoding; don't let anyone decode twice.
+        r.headers = requests.structures.CaseInsensitiveDict((k, v) for k, v in hresp.headers.items() if k.lower() != "content-encoding")
+        r.url = request.url
+        r.request = request
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.elapsed = timedelta(seconds=time.monotonic() - t0)
+        r.raw = _RawStream(hresp)
+        r.connection = self
+        if not stream:
+            try:
+                r.content
+            except httpx.TimeoutException as e:
+                raise requests.exceptions.Timeout(str(e), request=request)
+            except httpx.TransportError as e:
+                raise requests.exceptions.ChunkedEncodingError(str(e), request=request)
+        return r
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def _make_session(pool_maxsize: int, http2: bool = False) -> requests.Session:
+    s = requests.Session()
+    if http2:
+        s.mount("https://", _H2Adapter(pool_maxsize))
+    else:
+        # max_retries=0: http_request_ext/http_request_tg own the retry policy.
+        s.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=pool_maxsize, max_retries=0))
+    s.mount("http://", HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=pool_maxsize, max_retries=0))
+    return s
+
+
+_EXT_HTTP2 = HTTP2_ENABLED and httpx is not None
+EXT_SESSION = _make_session(HTTP_POOL_MAXSIZE, http2=_EXT_HTTP2)  # Kick/VK/images
+TG_SESSION = _make_session(TG_POOL_MAXSIZE)  # Telegram
+
+_TRANSPORT_LOCK = threading.Lock()
+_TRANSPORT_STATS = {}  # host -> {"new"/"reused"/"h2": [count, total seconds to headers]}
+_HOST_LAST_USE = {}  # host -> monotonic ts of the last request (keep-alive pings included)
+
+
+def _host_connections(session: requests.Session, url: str, host: str) -> int:
+    """Connections ever opened to host by this session's pool (-1 when the adapter doesn't pool)."""
+    pm = getattr(session.get_adapter(url), "poolmanager", None)
+    if pm is None:
+        return -1
+    n = 0
+    for key in pm.pools.keys():
+        if getattr(key, "key_host", None) == host:
+            pool = pm.pools.get(key)
+            n += pool.num_connections if pool is not None else 0
+    return n
+
+
+def transport_request(session: requests.Session, method: str, url: str, *, probe: bool = False, **kwargs) -> requests.Response:
+    """session.request() that notes whether a new connection was opened and the time to response headers."""
+    host = urlsplit(url).hostname or ""
+    before = _host_connections(session, url, host)
+    try:
+        r = session.request(method, url, **kwargs)
+    finally:
+        with _TRANSPORT_LOCK:
+            _HOST_LAST_USE[host] = time.monotonic()
+    if not probe:
+        if before < 0:
+            kind = "h2"
+        else:
+            kind = "new" if _host_connections(session, url, host) > before else "reused"
+        with _TRANSPORT_LOCK:
+            row = _TRANSPORT_STATS.setdefault(host, {})
+            acc = row.setdefault(kind, [0, 0.0])
+            acc[0] += 1
+            acc[1] += r.elapsed.total_seconds()
+    return r
+
+
+def transport_stats() -> dict:
+    """host -> {kind: (count, avg seconds to headers)}."""
+    with _TRANSPORT_LOCK:
+        return {
+            host: {kind: (n, total / n) for kind, (n, total) in row.items() if n}
+            for host, row in sorted(_TRANSPORT_STATS.items())
+        }
+
+
+def _keepalive_targets() -> list:
+    """(session, url, next expected use as wall-clock ts or None if it can come at any moment)."""
+    hosts = {}  # base url -> earliest next poll of any channel on that host
+    for ch in CHANNELS:
+        vk_url = ch.vk_api_url if VK_JSON_ENABLED else ch.vk_public_url
+        for platform, url in (("kick", ch.kick_api_url), ("vk", vk_url)):
+            base = urlsplit(url)
+            key = f"{base.scheme}://{base.netloc}/"
+            due = _POLL_NEXT_DUE.get(fetch_key(ch, platform))
+            if key not in hosts or (due is not None and (hosts[key] is None or due < hosts[key])):
+                hosts[key] = due
+    out = [(EXT_SESSION, url, due) for url, due in hosts.items()]
+    out.append((TG_SESSION, "https://api.telegram.org/", None))
+    return out
+
+
+def http_keepalive_once() -> int:
+    """HEAD every host that has been idle for HTTP_KEEPALIVE_SEC and is about to be used. Returns pings sent."""
+    sent = 0
+    now_mono, now_ts = time.monotonic(), time.time()
+    for session, url, next_use in _keepalive_targets():
+        host = urlsplit(url).hostname or ""
+        with _TRANSPORT_LOCK:
+            idle = now_mono - _HOST_LAST_USE.get(host, 0.0)
+        if idle < HTTP_KEEPALIVE_SEC:
+            continue
+        if next_use is not None and next_use - now_ts > HTTP_KEEPALIVE_SEC:
+            continue  # not needed soon; the next check is early enough
+        if BREAKER_ENABLED and breaker_for(url).snapshot()["state"] == "open":
+            continue
+        try:
+            transport_request(session, "HEAD", url, probe=True, headers={"User-Agent": UA}, timeout=(5, 5), allow_redirects=False).close()
+            sent += 1
+        except Exception:
+            pass  # best-effort: the real request will reconnect
+    return sent
 
-EXT_SESSION = requests.Session()  # Kick/VK/images
-TG_SESSION = requests.Session()   # Telegram
+
+def http_keepalive_forever() -> None:
+    while True:
+        time.sleep(max(5, HTTP_KEEPALIVE_SEC // 3))
+        try:
+            http_keepalive_once()
+        except Exception as e:
+            log_line(f"HTTP keep-alive error: {e}")
 
 
 
 # ========== FAST COMMANDS + FRESH SCREENSHOT (RAM cache) ==========
 # Commands reuse the last snapshot collected by main loop to avoid slow Kick/VK/HTML fetch on demand.
+# The main loop publishes an immutable StatusSnapshot once per tick; readers just take the reference.
 CACHE_MAX_AGE_SEC = int(os.getenv("CACHE_MAX_AGE_SEC", "30"))
-CACHED_AT_TS = 0
-CACHED_KICK = None
-CACHED_VK = None
-CACHED_STATE = None
+_SNAPSHOT = None
+_SNAPSHOT_VERSION = 0
 
-# Screenshot cache (bytes) stored in RAM.
+# Screenshot cache (bytes) stored in RAM, one frame per channel. While a channel is live on Kick the
+# refresher takes a new frame every SHOT_REFRESH_SEC (capped at SHOT_CACHE_MAX_AGE_SEC, so a fresh frame
+# is always there for alerts, /stream and live card photo edits). SHOT_REFRESH_ENABLED=0: frames are
+# only taken on demand by alerts and commands.
 SHOT_CACHE_MAX_AGE_SEC = int(os.getenv("SHOT_CACHE_MAX_AGE_SEC", "60"))
 SHOT_REFRESH_SEC = int(os.getenv("SHOT_REFRESH_SEC", "20"))
-CACHED_SHOT_AT_TS = 0
-CACHED_SHOT_BYTES = None
+SHOT_REFRESH_ENABLED = os.getenv("SHOT_REFRESH_ENABLED", "1").strip() not in {"0", "false", "False"}
+_SHOT_CACHE = {}  # channel id -> (taken_at_ts, jpeg bytes); each entry replaced as a whole
 
-# Shorter timeouts for command replies (so /stream won't hang 1-2 minutes).
-TG_CMD_SEND_TIMEOUT_SEC = int(os.getenv("TG_CMD_SEND_TIMEOUT_SEC", "12"))
-TG_CMD_PHOTO_URL_TIMEOUT_SEC = int(os.getenv("TG_CMD_PHOTO_URL_TIMEOUT_SEC", "15"))
-TG_CMD_PHOTO_UPLOAD_TIMEOUT_SEC = int(os.getenv("TG_CMD_PHOTO_UPLOAD_TIMEOUT_SEC", "18"))
 FFMPEG_CMD_TIMEOUT_SEC = int(os.getenv("FFMPEG_CMD_TIMEOUT_SEC", "8"))
 
 # Local log file (works even if platform doesn't show stdout)
@@ -192,36 +649,93 @@ def ts() -> int:
     return int(time.time())
 
 
-def _cache_set_snapshot(st: dict, kick: dict, vk: dict) -> None:
-    global CACHED_AT_TS, CACHED_KICK, CACHED_VK, CACHED_STATE
-    CACHED_AT_TS = ts()
-    CACHED_KICK = dict(kick or {})
-    CACHED_VK = dict(vk or {})
-    CACHED_STATE = dict(st or {})
+def _cache_set_snapshot(st, kick, vk) -> None:
+    """Publish a new snapshot (main loop only). A single reference assignment, so readers need no lock."""
+    global _SNAPSHOT, _SNAPSHOT_VERSION
+    _SNAPSHOT_VERSION += 1
+    _SNAPSHOT = StatusSnapshot(
+        version=_SNAPSHOT_VERSION,
+        at_ts=ts(),
+        state=st.copy() if st is not None else BotState(),
+        kick=kick or PlatformSnapshot(),
+        vk=vk or PlatformSnapshot(),
+    )
 
 
 def _cache_get_snapshot():
-    age = ts() - int(CACHED_AT_TS or 0)
-    if CACHED_STATE is None or CACHED_KICK is None or CACHED_VK is None:
+    """(state, kick, vk, age) of the latest snapshot, or None when it is older than CACHE_MAX_AGE_SEC.
+    The state is shared with every other reader: read-only, take load_state() for a copy to change."""
+    snap = _SNAPSHOT
+    if snap is None:
         return None
+    age = ts() - int(snap.at_ts or 0)
     if age > int(CACHE_MAX_AGE_SEC):
         return None
-    return dict(CACHED_STATE), dict(CACHED_KICK), dict(CACHED_VK), age
+    return snap.state, snap.kick, snap.vk, age
 
 
-def _shot_cache_set(img: bytes) -> None:
-    global CACHED_SHOT_AT_TS, CACHED_SHOT_BYTES
-    CACHED_SHOT_AT_TS = ts()
-    CACHED_SHOT_BYTES = img
+def _shot_cache_set(img: bytes, ch=None) -> None:
+    _SHOT_CACHE[(ch or MAIN_CHANNEL).id] = (ts(), img)
 
 
-def _shot_cache_get():
-    if not CACHED_SHOT_BYTES:
+def _shot_cache_get(ch=None):
+    """(jpeg bytes, age) of the channel's frame, or None when there is none from the last SHOT_CACHE_MAX_AGE_SEC."""
+    cached = _SHOT_CACHE.get((ch or MAIN_CHANNEL).id)
+    if not cached or not cached[1]:
         return None
-    age = ts() - int(CACHED_SHOT_AT_TS or 0)
+    age = ts() - int(cached[0] or 0)
     if age > int(SHOT_CACHE_MAX_AGE_SEC):
         return None
-    return CACHED_SHOT_BYTES, age
+    return cached[1], age
+
+
+# Telegram file_id of photos already uploaded, keyed by the JPEG's content hash. The same shot goes to
+# several chats and /stream replies; after the first upload they are sent by file_id (a small JSON
+# call). Entries live as long as a cached screenshot does (SHOT_CACHE_MAX_AGE_SEC).
+_MEDIA_CACHE = {}  # sha1 hex -> (file_id, recorded ts)
+_MEDIA_CACHE_LOCK = threading.Lock()
+_MEDIA_COUNTERS = {"uploads": 0, "reused": 0}
+
+
+def _media_key(img: bytes) -> str:
+    return hashlib.sha1(img).hexdigest()
+
+
+def media_cache_get(img: bytes) -> str | None:
+    now = ts()
+    with _MEDIA_CACHE_LOCK:
+        for k in [k for k, (_fid, at) in _MEDIA_CACHE.items() if now - at > int(SHOT_CACHE_MAX_AGE_SEC)]:
+            del _MEDIA_CACHE[k]
+        hit = _MEDIA_CACHE.get(_media_key(img))
+    return hit[0] if hit else None
+
+
+def media_cache_put(img: bytes, message: dict) -> None:
+    """Remember the file_id of the largest size Telegram made from the uploaded photo."""
+    sizes = (message or {}).get("photo") or []
+    if not sizes:
+        return
+    best = max(sizes, key=lambda p: int(p.get("file_size") or 0) or int(p.get("width") or 0))
+    if best.get("file_id"):
+        with _MEDIA_CACHE_LOCK:
+            _MEDIA_CACHE[_media_key(img)] = (best["file_id"], ts())
+
+
+def media_cache_drop(img: bytes) -> None:
+    with _MEDIA_CACHE_LOCK:
+        _MEDIA_CACHE.pop(_media_key(img), None)
+
+
+def media_cache_stats() -> dict:
+    with _MEDIA_CACHE_LOCK:
+        out = dict(_MEDIA_COUNTERS)
+        out["entries"] = len(_MEDIA_CACHE)
+    return out
+
+
+def _media_count(key: str) -> None:
+    with _MEDIA_CACHE_LOCK:
+        _MEDIA_COUNTERS[key] += 1
 
 
 # ========== MSK TIME + STREAM STATS ==========
@@ -321,12 +835,14 @@ def stats_tick(st: dict, kick: dict, vk: dict, any_live: bool, now_ts: int | Non
 
     if not isinstance(stats, dict):
         return
+    # Copy-on-write: state copies share stream_stats with the committed in-memory state.
+    stats = _copy_tree(stats)
 
     last_tick = int(stats.get("last_tick_ts") or now_ts)
     delta = now_ts - last_tick
     if delta < 0:
         delta = 0
-    delta = min(delta, int(POLL_INTERVAL) * 5)
+    delta = min(delta, max(int(POLL_INTERVAL), int(POLL_LIVE_SEC)) * 5)
 
     if delta > 0:
 
@@ -392,6 +908,7 @@ def stats_finalize_end(st: dict, now_ts: int | None = None) -> None:
     stats = st.get("stream_stats")
     if not isinstance(stats, dict):
         return
+    stats = dict(stats)
     stats["end_ts"] = int(now_ts)
     st["stream_stats"] = stats
 
@@ -407,7 +924,8 @@ def _top_durations(d: dict) -> list[tuple[str, int]]:
     items.sort(key=lambda x: x[1], reverse=True)
     return items
 
-def build_end_report(st: dict) -> str:
+def build_end_report(st: dict, ch=None) -> str:
+    ch = ch or MAIN_CHANNEL
     start_dt = dt_from_iso(st.get("started_at"))
     stats = st.get("stream_stats") if isinstance(st.get("stream_stats"), dict) else {}
 
@@ -426,7 +944,7 @@ def build_end_report(st: dict) -> str:
         pass
 
     lines: list[str] = []
-    lines.append("🏁 <b>Паток окончен</b> — Глад Валакас")
+    lines.append(f"🏁 <b>Паток окончен</b> — {esc(ch.name)}")
     lines.append("")
     lines.append(f"🕒 <b>Начало (МСК):</b> {fmt_msk(start_dt)}")
     lines.append(f"🕒 <b>Конец (МСК):</b> {fmt_msk(end_dt)}")
@@ -498,9 +1016,9 @@ def build_end_report(st: dict) -> str:
         out.append(f"🔗 <b>Ссылка:</b> {url}")
         return out
 
-    lines += plat_block("🎥 <b>Kick</b>", "kick", KICK_PUBLIC_URL)
+    lines += plat_block("🎥 <b>Kick</b>", "kick", ch.kick_public_url)
     lines.append("")
-    lines += plat_block("🎮 <b>VK Play</b>", "vk", VK_PUBLIC_URL)
+    lines += plat_block("🎮 <b>VK Play</b>", "vk", ch.vk_public_url)
 
     out = "\n".join(lines)
     return out[:3900] + ("…" if len(out) > 3900 else "")
@@ -637,69 +1155,239 @@ def fmt_running_line(st: dict) -> str:
     return f"Идёт: {fmt_duration(sec)}"
 
 
-def _sleep_backoff(attempt: int, base: float, cap: float, jitter: bool) -> None:
+class DeadlineExceeded(TimeoutError):
+    """The tick's time budget ran out before the next attempt."""
+
+
+class Deadline:
+    """Absolute time budget passed down the call chain; clamps timeouts and backoff sleeps to what is left."""
+
+    __slots__ = ("at",)
+
+    def __init__(self, seconds: float):
+        self.at = time.monotonic() + float(seconds)
+
+    def remaining(self) -> float:
+        return max(0.0, self.at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def child(self, seconds: float) -> "Deadline":
+        """A sub-budget that also ends no later than this one."""
+        d = Deadline(seconds)
+        d.at = min(d.at, self.at)
+        return d
+
+    def check(self, what: str) -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"{what}: tick deadline exceeded")
+
+    def clamp(self, timeout):
+        """Clamp a requests-style timeout (seconds or (connect, read)) to the remaining budget."""
+        left = max(0.1, self.remaining())
+        if isinstance(timeout, tuple):
+            return tuple(min(float(t), left) for t in timeout)
+        return min(float(timeout), left)
+
+
+def _backoff_delay(attempt: int, base: float, cap: float, jitter: bool) -> float:
     delay = min((base ** attempt), cap)
     if jitter:
         delay *= random.uniform(0.85, 1.35)
-    time.sleep(delay)
+    return delay
+
+
+def _backoff_wait(attempt: int, base: float, cap: float, jitter: bool, deadline: Deadline | None = None) -> float:
+    delay = _backoff_delay(attempt, base, cap, jitter)
+    if deadline is not None:
+        delay = min(delay, deadline.remaining())
+    return delay
+
+
+def _sleep_backoff(attempt: int, base: float, cap: float, jitter: bool, deadline: Deadline | None = None) -> None:
+    time.sleep(_backoff_wait(attempt, base, cap, jitter, deadline))
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of a request while the host's circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """closed -> open after too many failures in the window; open -> half-open after the cool-down;
+    half-open lets one probe through: success closes, failure re-opens with a doubled cool-down."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.state = "closed"
+        self.events = deque()  # (ts, ok) within BREAKER_WINDOW_SEC
+        self.opened_at = 0.0
+        self.cooldown = BREAKER_COOLDOWN_SEC
+        self.opens = 0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    def _set(self, new_state: str, why: str) -> None:
+        log_line(f"[breaker] {self.host}: {self.state} -> {new_state} ({why})")
+        self.state = new_state
+
+    def allow(self) -> None:
+        with self.lock:
+            if self.state == "closed":
+                return
+            if self.state == "open":
+                if time.time() - self.opened_at < self.cooldown:
+                    raise CircuitOpenError(f"{self.host}: circuit open")
+                self._set("half-open", f"cool-down {self.cooldown}s over")
+            if self.probe_in_flight:
+                raise CircuitOpenError(f"{self.host}: circuit half-open, probe in flight")
+            self.probe_in_flight = True
+
+    def record(self, ok: bool) -> None:
+        now = time.time()
+        with self.lock:
+            if self.state == "half-open":
+                self.probe_in_flight = False
+                if ok:
+                    self.events.clear()
+                    self.cooldown = BREAKER_COOLDOWN_SEC
+                    self._set("closed", "probe ok")
+                else:
+                    self.cooldown = min(self.cooldown * 2, BREAKER_COOLDOWN_MAX_SEC)
+                    self.opened_at = now
+                    self.opens += 1
+                    self._set("open", f"probe failed, cool-down {self.cooldown}s")
+                return
+            if self.state != "closed":
+                return
+            self.events.append((now, ok))
+            while self.events and now - self.events[0][0] > BREAKER_WINDOW_SEC:
+                self.events.popleft()
+            failures = sum(1 for _t, good in self.events if not good)
+            if failures >= BREAKER_MIN_FAILURES and failures / len(self.events) >= BREAKER_FAILURE_RATE:
+                self.opened_at = now
+                self.opens += 1
+                self._set("open", f"{failures}/{len(self.events)} failed in {BREAKER_WINDOW_SEC}s")
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            now = time.time()
+            failures = sum(1 for t, good in self.events if not good and now - t <= BREAKER_WINDOW_SEC)
+            left = max(0, int(self.cooldown - (now - self.opened_at))) if self.state == "open" else 0
+            return {"state": self.state, "failures": failures, "opens": self.opens, "retry_in": left}
+
 
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
 
-def http_request_ext(method: str, url: str, *, headers=None, json_body=None, data=None, files=None, timeout=25, allow_redirects=True) -> requests.Response:
+
+def breaker_for(url: str) -> CircuitBreaker:
+    host = urlsplit(url).hostname or ""
+    with _BREAKERS_LOCK:
+        b = _BREAKERS.get(host)
+        if b is None:
+            b = _BREAKERS[host] = CircuitBreaker(host)
+        return b
+
+
+def breaker_states() -> dict:
+    with _BREAKERS_LOCK:
+        items = list(_BREAKERS.items())
+    return {host: b.snapshot() for host, b in sorted(items)}
+
+
+def _raise_closed(r: requests.Response) -> None:
+    """raise_for_status() for a failed response, releasing its connection first (stream=True keeps it)."""
+    r.close()
+    r.raise_for_status()
+
+
+def http_request_ext(method: str, url: str, *, headers=None, json_body=None, data=None, files=None, timeout=25, allow_redirects=True, stream=False, deadline: Deadline | None = None, retries: int | None = None) -> requests.Response:
+    breaker = breaker_for(url) if BREAKER_ENABLED else None
     last_exc = None
-    for attempt in range(1, HTTP_RETRIES + 1):
+    retries = HTTP_RETRIES if retries is None else max(1, int(retries))
+    for attempt in range(1, retries + 1):
+        if deadline is not None and deadline.expired():
+            raise last_exc or DeadlineExceeded(f"{method} {url}: tick deadline exceeded")
+        if breaker is not None:
+            breaker.allow()
         try:
-            r = EXT_SESSION.request(
+            r = transport_request(
+                EXT_SESSION,
                 method,
                 url,
                 headers=headers,
                 json=json_body,
                 data=data,
                 files=files,
-                timeout=timeout,
+                timeout=deadline.clamp(timeout) if deadline is not None else timeout,
                 allow_redirects=allow_redirects,
+                stream=stream,
             )
+            # Other 4xx are the server's final answer: the host is up (a breaker success) and a retry
+            # would get the same reply, so _raise_closed() below raises it without backoff.
+            if breaker is not None:
+                breaker.record(r.status_code not in (429, 500, 502, 503, 504))
             if r.status_code in (429, 500, 502, 503, 504):
-                if attempt == HTTP_RETRIES:
-                    r.raise_for_status()
-                _sleep_backoff(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_JITTER)
+                if attempt == retries:
+                    _raise_closed(r)
+                r.close()
+                _sleep_backoff(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_JITTER, deadline)
                 continue
-            r.raise_for_status()
+            if r.status_code >= 400:
+                _raise_closed(r)
             return r
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
             last_exc = e
-            if attempt == HTTP_RETRIES:
-                raise
-            _sleep_backoff(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_JITTER)
-        except requests.exceptions.HTTPError as e:
-            last_exc = e
-            if attempt == HTTP_RETRIES:
+            if breaker is not None:
+                breaker.record(False)
+            if attempt == retries:
                 raise
-            _sleep_backoff(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_JITTER)
+            _sleep_backoff(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_JITTER, deadline)
+        except requests.exceptions.HTTPError:
+            raise
+        except Exception:
+            # Anything else (bad URL, too many redirects): still settle a half-open probe.
+            if breaker is not None:
+                breaker.record(False)
+            raise
     raise last_exc
 
 
-def http_request_tg(method: str, url: str, *, json_body=None, data=None, files=None, timeout=(5, 15)) -> requests.Response:
-    """Telegram requests with smaller retry budget to avoid long stalls in command loop."""
+def http_request_tg(method: str, url: str, *, json_body=None, data=None, files=None, timeout=(5, 15), retries: int | None = None) -> requests.Response:
+    """Telegram requests with smaller retry budget to avoid long stalls in command loop.
+
+    retries=1 makes a single attempt (the retry scheduler re-queues failures itself).
+    """
     last_exc = None
-    for attempt in range(1, TG_RETRIES + 1):
+    retries = TG_RETRIES if retries is None else max(1, int(retries))
+    for attempt in range(1, retries + 1):
+        tg_rate_acquire(url, json_body, data)  # raises TgRateLimited: the caller re-queues, we don't sleep
         try:
-            r = TG_SESSION.request(method, url, json=json_body, data=data, files=files, timeout=timeout)
+            r = transport_request(TG_SESSION, method, url, json=json_body, data=data, files=files, timeout=timeout)
             # Telegram can rate limit; retry a bit
             if r.status_code in (429, 500, 502, 503, 504):
-                if attempt == TG_RETRIES:
+                retry_after = tg_response_retry_after(r)
+                if retry_after is not None:
+                    tg_rate_penalize(url, json_body, data, retry_after)
+                if attempt == retries:
                     r.raise_for_status()
-                _sleep_backoff(attempt, TG_BACKOFF_BASE, TG_BACKOFF_MAX, True)
+                if retry_after is None:
+                    _sleep_backoff(attempt, TG_BACKOFF_BASE, TG_BACKOFF_MAX, True)
+                else:
+                    # The bucket is blocked now: don't sleep retry_after out here.
+                    raise TgRateLimited(_tg_rate_target(url, json_body, data)[1], retry_after)
                 continue
             r.raise_for_status()
             return r
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
             last_exc = e
-            if attempt == TG_RETRIES:
+            if attempt == retries:
                 raise
             _sleep_backoff(attempt, TG_BACKOFF_BASE, TG_BACKOFF_MAX, True)
         except requests.exceptions.HTTPError as e:
             last_exc = e
-            if attempt == TG_RETRIES:
+            if attempt == retries:
                 raise
             _sleep_backoff(attempt, TG_BACKOFF_BASE, TG_BACKOFF_MAX, True)
     raise last_exc
@@ -835,60 +1523,262 @@ def notify_admin_dedup(key: str, text: str) -> None:
 
 # ========== STATE (SAFE + ATOMIC) ==========
 
-def default_state() -> dict:
-    return {
-        "any_live": False,
-        "kick_live": False,
-        "vk_live": False,
-        "started_at": None,
-        "startup_ping_sent": False,
-        "kick_title": None,
-        "kick_cat": None,
-        "vk_title": None,
-        "vk_cat": None,
-        "kick_viewers": None,
-        "vk_viewers": None,
-        "last_start_sent_ts": 0,
-        "last_change_sent_ts": 0,
-        "last_boot_status_ts": 0,
-        "last_no_stream_start_ts": 0,
-        "updates_offset": 0,
-        # commands watchdog
-        "last_command_seen_ts": 0,
-        "last_commands_recover_ts": 0,
-        "last_updates_poll_ts": 0,
-        # end confirmation
-        "end_streak": 0,
-        # end notification anti-loss
-        "end_sent_for_started_at": None,
-        "end_sent_ts": 0,
-        # anti-spam for 409
-        "last_409_notify_ts": 0,
-        # remember your private chat id once seen
-        "admin_private_chat_id": 0,
-        # disk cleanup tracking
-        "last_disk_check_ts": 0,
-        "last_temp_cleanup_ts": 0,
-        # quota alert anti-spam
-        "last_quota_notify_ts": 0,
-
-        # per-stream aggregated stats (lightweight)
-        "stream_stats": None,
-    }
+STATE_SCHEMA_VERSION = 1
 
 
-def load_state() -> dict:
+def _copy_tree(obj):
+    # Copy of plain JSON-like data (dict/list/scalars); much cheaper than copy.deepcopy.
+    if isinstance(obj, dict):
+        return {k: _copy_tree(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_copy_tree(v) for v in obj]
+    return obj
+
+
+class _RecordMixin:
+    """Dict-style read access (`.get()`, `[]`, `in`) for the slots dataclasses below."""
+    __slots__ = ()
+
+    def get(self, key: str, default=None):
+        if key in self._FIELDS:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key: str):
+        if key not in self._FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._FIELDS
+
+    def keys(self):
+        return list(self._FIELDS)
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self._FIELDS}
+
+
+class _StateBase(_RecordMixin):
+    # _base: the committed state this copy was made from; save_state() commits only fields changed since.
+    __slots__ = ("_base",)
+
+
+@dataclass(slots=True)
+class BotState(_StateBase):
+    any_live: bool = False
+    kick_live: bool = False
+    vk_live: bool = False
+    started_at: str | None = None
+    startup_ping_sent: bool = False
+    kick_title: str | None = None
+    kick_cat: str | None = None
+    vk_title: str | None = None
+    vk_cat: str | None = None
+    kick_viewers: int | None = None
+    vk_viewers: int | None = None
+    last_start_sent_ts: int = 0
+    last_change_sent_ts: int = 0
+    last_boot_status_ts: int = 0
+    last_no_stream_start_ts: int = 0
+    updates_offset: int = 0
+    # commands watchdog
+    last_command_seen_ts: int = 0
+    last_commands_recover_ts: int = 0
+    last_updates_poll_ts: int = 0
+    # end confirmation
+    end_streak: int = 0
+    # end notification anti-loss
+    end_sent_for_started_at: str | None = None
+    end_sent_ts: int = 0
+    # anti-spam for 409
+    last_409_notify_ts: int = 0
+    # remember your private chat id once seen
+    admin_private_chat_id: int = 0
+    # disk cleanup tracking
+    last_disk_check_ts: int = 0
+    last_temp_cleanup_ts: int = 0
+    # quota alert anti-spam
+    last_quota_notify_ts: int = 0
+
+    # per-stream aggregated stats (lightweight)
+    stream_stats: dict | None = None
+    # stream starts per hour of week (168 buckets, MSK, Monday 00:00 first); drives the poll scheduler
+    start_hist: list | None = None
+    # pinned live status message of the running stream (LIVE_CARD_ENABLED): chat_id, message_id, photo
+    live_card: dict | None = None
+    # stream state of the extra channels (CHANNELS_JSON): channel id -> {CHANNEL_STATE_FIELDS}
+    channels: dict | None = None
+
+    def __setitem__(self, key: str, value) -> None:
+        if key not in self._FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def copy(self) -> "BotState":
+        # Shallow: stream_stats is shared and copied on write by stats_tick()/stats_finalize_end().
+        new = BotState.__new__(BotState)
+        for k in self._FIELDS:
+            setattr(new, k, getattr(self, k))
+        new._base = self
+        return new
+
+    def to_dict(self) -> dict:
+        d = {k: getattr(self, k) for k in self._FIELDS}
+        d["_schema"] = STATE_SCHEMA_VERSION
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "BotState":
+        d = _migrate_state_dict(dict(d or {}))
+        st = cls()
+        for k in cls._FIELDS:
+            if k in d:
+                setattr(st, k, d[k])
+        return st
+
+
+BotState._FIELDS = tuple(f.name for f in fields(BotState))
+
+
+@dataclass(slots=True, frozen=True)
+class PlatformSnapshot(_RecordMixin):
+    """One platform's status as returned by kick_fetch()/vk_fetch_best_effort(). Never mutated."""
+    live: bool = False
+    title: str | None = None
+    category: str | None = None
+    viewers: int | None = None
+    thumb: str | None = None
+    created_at: str | None = None
+    playback_url: str | None = None
+
+
+PlatformSnapshot._FIELDS = tuple(f.name for f in fields(PlatformSnapshot))
+
+
+@dataclass(slots=True, frozen=True)
+class StatusSnapshot:
+    """What the main loop saw on one tick. Published whole and shared by reference between threads.
+    The dataclass is frozen but state is a plain BotState copy: readers must never mutate it."""
+    version: int
+    at_ts: int
+    state: BotState
+    kick: PlatformSnapshot
+    vk: PlatformSnapshot
+
+
+def _migrate_state_v0(d: dict) -> dict:
+    # v0: untyped dict from default_state(); drop keys the model no longer knows.
+    known = set(BotState._FIELDS)
+    return {k: v for k, v in d.items() if k in known}
+
+
+_STATE_MIGRATIONS = {0: _migrate_state_v0}
+
+
+def _migrate_state_dict(d: dict) -> dict:
+    ver = int(d.pop("_schema", 0) or 0)
+    while ver < STATE_SCHEMA_VERSION:
+        d = _STATE_MIGRATIONS[ver](d)
+        ver += 1
+    return d
+
+
+def default_state() -> BotState:
+    return BotState()
+
+
+# Marks a msgpack state file, so it is never mistaken for (or silently replaces) a JSON one.
+STATE_MSGPACK_MAGIC = b"\x00BOTSTATE-MSGPACK\x00"
+
+
+def _state_serializer() -> str:
+    if STATE_SERIALIZER in {"auto", "orjson"} and orjson is not None:
+        return "orjson"
+    if STATE_SERIALIZER == "msgpack" and msgpack is not None:
+        return "msgpack"
+    return "json"
+
+
+def state_dumps(obj: dict, serializer: str | None = None) -> bytes:
+    kind = serializer or _state_serializer()
+    if kind == "orjson":
+        return orjson.dumps(obj)
+    if kind == "msgpack":
+        return STATE_MSGPACK_MAGIC + msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def state_loads(raw: bytes):
+    # msgpack snapshots carry STATE_MSGPACK_MAGIC; everything else is JSON.
+    if raw.startswith(STATE_MSGPACK_MAGIC):
+        if msgpack is None:
+            raise ValueError("state file is msgpack (STATE_SERIALIZER=msgpack) but msgpack is not installed")
+        return msgpack.unpackb(raw[len(STATE_MSGPACK_MAGIC):], raw=False, strict_map_key=False)
+    head = raw.lstrip()[:1]
+    if head not in (b"{", b"[") and msgpack is not None:
+        # Written by an earlier version that chose msgpack without a header.
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    return orjson.loads(raw) if orjson is not None else json.loads(raw.decode("utf-8"))
+
+
+def _journal_dumps(rec: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(rec).decode("utf-8")
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+
+
+# Durability tier of each state field:
+#   critical  - written and fsynced before save_state() returns (losing them re-sends alerts or commands)
+#   lazy      - written by the background flusher (every field not listed below)
+#   ephemeral - RAM only, never written; back to defaults after a restart
+STATE_CRITICAL_FIELDS = frozenset({
+    "any_live",
+    "kick_live",
+    "vk_live",
+    "started_at",
+    "startup_ping_sent",
+    "last_start_sent_ts",
+    "updates_offset",
+    "end_sent_for_started_at",
+    "end_sent_ts",
+    "admin_private_chat_id",
+    "live_card",
+})
+STATE_EPHEMERAL_FIELDS = frozenset({
+    "last_updates_poll_ts",
+    "kick_viewers",
+    "vk_viewers",
+})
+
+# Authoritative in-memory state (write-behind). Committed objects are never mutated, so the
+# reference can be read without a lock; replacing it happens under _STATE_MEM_LOCK (held for microseconds).
+_STATE_MEM = None
+_STATE_MEM_LOCK = threading.Lock()
+_STATE_DIRTY = False
+# What the written + pending batches add up to, and the last journal batch number. Guarded by _STATE_MEM_LOCK.
+_STATE_PERSISTED = None
+_JOURNAL_SEQ = 0
+# Batches waiting for disk, oldest first: (seq, journal lines or None for a snapshot, persisted dict).
+_STATE_PENDING: list = []
+# Serializes disk writes. Its holder must never wait for _STATE_MEM_LOCK.
+STATE_IO_LOCK = threading.Lock()
+
+
+def _read_state_file() -> dict:
+    """Raw state dict from disk, filled up with defaults (schema migration happens in BotState.from_dict)."""
     if not os.path.exists(STATE_FILE):
-        return default_state()
+        return default_state().to_dict()
     try:
-        if os.path.getsize(STATE_FILE) > MAX_STATE_SIZE:
+        # Each extra channel keeps its own session and stream_stats: the limit grows with the channel count.
+        if os.path.getsize(STATE_FILE) > MAX_STATE_SIZE * max(1, len(CHANNELS)):
             notify_admin_dedup("state_file_large", f"⚠️ state.json слишком большой: {os.path.getsize(STATE_FILE)} bytes")
             # keep only important fields
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
+            with open(STATE_FILE, "rb") as f:
                 raw = f.read()
             if not raw.strip():
-                return default_state()
-            st = json.loads(raw)
+                return default_state().to_dict()
+            st = state_loads(raw)
             important = {
                 "any_live",
                 "kick_live",
@@ -899,39 +1789,284 @@ def load_state() -> dict:
                 "last_updates_poll_ts",
                 "end_streak",
                 "end_sent_for_started_at",
-        "stream_stats",
+                "stream_stats",
+                "start_hist",
+                "live_card",
+                "channels",
+                "_journal_seq",
+                "_schema",
             }
             st = {k: v for k, v in (st or {}).items() if k in important}
         else:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
+            with open(STATE_FILE, "rb") as f:
                 raw = f.read()
             if not raw.strip():
-                return default_state()
-            st = json.loads(raw)
+                return default_state().to_dict()
+            st = state_loads(raw)
         if not isinstance(st, dict):
-            return default_state()
+            return default_state().to_dict()
     except Exception:
-        return default_state()
+        return default_state().to_dict()
 
-    base = default_state()
+    base = default_state().to_dict()
     base.update(st)
     return base
 
 
-def save_state(state: dict) -> None:
-    d = os.path.dirname(STATE_FILE) or "."
-    os.makedirs(d, exist_ok=True)
-    tmp_path = os.path.join(d, ".state_tmp.json")
+def _state_diff(old, new, path: list, out: list) -> None:
+    # Field-level diff: {"p": path, "v": value} sets a value, {"p": path, "d": 1} deletes a dict key.
+    # Lists that only grew (timelines) are diffed per index, so appends stay small.
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k, v in new.items():
+            if k in old:
+                _state_diff(old[k], v, path + [k], out)
+            else:
+                out.append({"p": path + [k], "v": v})
+        for k in old:
+            if k not in new:
+                out.append({"p": path + [k], "d": 1})
+        return
+    if isinstance(old, list) and isinstance(new, list) and len(new) >= len(old):
+        for i, v in enumerate(new):
+            if i < len(old):
+                _state_diff(old[i], v, path + [i], out)
+            else:
+                out.append({"p": path + [i], "v": v})
+        return
+    if type(old) is not type(new) or old != new:
+        out.append({"p": path, "v": new})
 
-    def _write_once() -> None:
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, separators=(",", ":"))
-            f.flush()
-            os.fsync(f.fileno())
-        os.replace(tmp_path, STATE_FILE)
 
+def _state_apply(st: dict, rec: dict) -> None:
+    path = rec.get("p")
+    if not isinstance(path, list) or not path:
+        return
+    cur = st
+    for k in path[:-1]:
+        cur = cur[k]
+    last = path[-1]
+    if rec.get("d"):
+        if isinstance(cur, dict):
+            cur.pop(last, None)
+        return
+    if isinstance(cur, list):
+        if last == len(cur):
+            cur.append(rec.get("v"))
+        elif 0 <= last < len(cur):
+            cur[last] = rec.get("v")
+        return
+    cur[last] = rec.get("v")
+
+
+def _replay_state_journal(st: dict, after_seq: int) -> int:
+    """Apply journal records newer than the snapshot to `st`. Returns the last batch number seen."""
+    last_seq = after_seq
+    if not os.path.exists(STATE_JOURNAL_FILE):
+        return last_seq
+    try:
+        with open(STATE_JOURNAL_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                # A torn line (crash mid-append) is skipped; later lines are still valid.
+                try:
+                    rec = json.loads(line)
+                    seq = int(rec.get("s") or 0)
+                except Exception:
+                    continue
+                if seq <= after_seq:
+                    continue
+                try:
+                    _state_apply(st, rec)
+                except Exception:
+                    continue
+                last_seq = max(last_seq, seq)
+    except Exception as e:
+        log_line(f"state journal replay failed: {e}")
+    return last_seq
+
+
+def _state_init_locked() -> None:
+    global _STATE_MEM, _STATE_PERSISTED, _JOURNAL_SEQ
+    if _STATE_MEM is None:
+        raw = _read_state_file()
+        snap_seq = int(raw.pop("_journal_seq", 0) or 0)
+        _JOURNAL_SEQ = _replay_state_journal(raw, snap_seq)
+        # Ephemeral fields left by older versions must not survive a restart.
+        for k in STATE_EPHEMERAL_FIELDS:
+            raw.pop(k, None)
+        st = BotState.from_dict(raw)
+        _STATE_PERSISTED = _persistable(st.to_dict())
+        _STATE_MEM = st
+
+
+def state_view() -> BotState:
+    """The committed in-memory state itself: no lock, no copy. Read-only — never mutate it."""
+    st = _STATE_MEM
+    if st is None:
+        with _STATE_MEM_LOCK:
+            _state_init_locked()
+            st = _STATE_MEM
+    return st
+
+
+def load_state() -> BotState:
+    """Return a private copy of the in-memory state. Disk is read only once, on first use.
+
+    Mutate the copy freely and commit it with save_state(). Hold the concern lock
+    (STATE_LOCK / TG_STATE_LOCK / NOTIFY_STATE_LOCK) around the whole read-modify-write.
+    """
+    return state_view().copy()
+
+
+# Stream fields each channel keeps for itself. "main" uses the top-level BotState fields, the extra
+# channels a plain dict per channel under BotState.channels, so state.json stays compatible.
+CHANNEL_STATE_FIELDS = (
+    "live_card",
+    "any_live",
+    "kick_live",
+    "vk_live",
+    "started_at",
+    "kick_title",
+    "kick_cat",
+    "vk_title",
+    "vk_cat",
+    "kick_viewers",
+    "vk_viewers",
+    "last_start_sent_ts",
+    "last_change_sent_ts",
+    "last_boot_status_ts",
+    "last_no_stream_start_ts",
+    "end_streak",
+    "end_sent_for_started_at",
+    "end_sent_ts",
+    "stream_stats",
+    "start_hist",
+)
+
+
+def _channel_state_from(st: BotState, ch) -> BotState:
+    rec = (st.channels or {}).get(ch.id) or {}
+    out = BotState()
+    for k in CHANNEL_STATE_FIELDS:
+        if k in rec:
+            setattr(out, k, rec[k])
+    return out
+
+
+def channel_view(ch) -> BotState:
+    """Read-only state of one channel (see state_view)."""
+    if ch.is_main:
+        return state_view()
+    return _channel_state_from(state_view(), ch)
+
+
+def channel_load(ch) -> BotState:
+    """Private copy of one channel's state; to commit it call channel_save() under STATE_LOCK."""
+    if ch.is_main:
+        return load_state()
+    return _channel_state_from(state_view(), ch)
+
+
+def channel_save(ch, st: BotState) -> None:
+    """Commit a channel's state. Extra channels store the whole record, so hold STATE_LOCK across load+save."""
+    if ch.is_main:
+        save_state(st)
+        return
+    g = load_state()
+    chans = dict(g.channels or {})
+    chans[ch.id] = {k: getattr(st, k) for k in CHANNEL_STATE_FIELDS}
+    g.channels = chans
+    save_state(g)
+
+
+def state_peek(key: str, default=None):
+    """Lock-free read of one field that never triggers the first disk load (safe from any thread)."""
+    st = _STATE_MEM
+    if st is None:
+        return default
+    return st.get(key, default)
+
+
+def _persistable(d: dict) -> dict:
+    out = {k: v for k, v in d.items() if k not in STATE_EPHEMERAL_FIELDS}
+    if out.get("channels"):
+        out["channels"] = {
+            cid: {k: v for k, v in rec.items() if k not in STATE_EPHEMERAL_FIELDS} for cid, rec in out["channels"].items()
+        }
+    return out
+
+
+def _field_tier(k: str) -> str:
+    if k in STATE_CRITICAL_FIELDS:
+        return "critical"
+    if k in STATE_EPHEMERAL_FIELDS:
+        return "ephemeral"
+    return "lazy"
+
+
+def _changed_tiers(old: BotState | None, new: BotState) -> set:
+    if old is None:
+        return {"lazy"}
+    tiers = set()
+    for k in BotState._FIELDS:
+        a = getattr(old, k)
+        b = getattr(new, k)
+        # stream_stats is copy-on-write, so identity is enough to tell it is unchanged.
+        if a is b or (k != "stream_stats" and a == b):
+            continue
+        if k == "channels":
+            # Per-channel records use the same tiers as the main channel's top-level fields.
+            a = a or {}
+            for cid, rec in (b or {}).items():
+                prev = a.get(cid) or {}
+                for f, v in rec.items():
+                    pv = prev.get(f)
+                    if pv is not v and (f == "stream_stats" or pv != v):
+                        tiers.add(_field_tier(f))
+            if set(a) - set(b or {}):
+                tiers.add("lazy")
+            continue
+        tiers.add(_field_tier(k))
+    return tiers
+
+
+def save_state(state: BotState) -> None:
+    """Commit the fields of `state` changed since it was loaded.
+
+    Fields committed meanwhile by other threads are kept. Critical fields are on disk when this
+    returns; lazy ones are written by the background flusher; ephemeral ones stay in RAM.
+    Don't mutate `state` after saving.
+    """
+    global _STATE_MEM, _STATE_DIRTY
+    with _STATE_MEM_LOCK:
+        _state_init_locked()
+        cur = _STATE_MEM
+        base = getattr(state, "_base", None)
+        if base is None or base is cur:
+            new = state
+        else:
+            new = cur.copy()
+            for k in BotState._FIELDS:
+                a = getattr(base, k)
+                b = getattr(state, k)
+                if a is b or (k != "stream_stats" and a == b):
+                    continue
+                setattr(new, k, b)
+        new._base = None
+        tiers = _changed_tiers(cur, new)
+        _STATE_MEM = new
+        if tiers - {"ephemeral"}:
+            _STATE_DIRTY = True
+        if "critical" in tiers:
+            _state_take_batch_locked()
+    if "critical" in tiers:
+        _state_drain_pending()
+
+
+def _write_with_enospc_retry(write_once, tmp_path: str | None = None) -> bool:
+    """Run a disk write; on ENOSPC clean temp files once and retry. False if the disk is still full."""
     try:
-        _write_once()
+        write_once()
+        return True
     except OSError as e:
         if getattr(e, "errno", None) == 28:
             try:
@@ -941,22 +2076,38 @@ def save_state(state: dict) -> None:
             except Exception:
                 pass
             try:
-                if os.path.exists(tmp_path):
+                if tmp_path and os.path.exists(tmp_path):
                     os.remove(tmp_path)
             except Exception:
                 pass
             try:
-                _write_once()
-                return
+                write_once()
+                return True
             except OSError as e2:
                 if getattr(e2, "errno", None) == 28:
                     notify_admin_dedup(
                         "no_space",
                         "❌ No space left: не могу сохранить state.json. Освободи место (state_*.json, __pycache__, /tmp ffmpeg-*).",
                     )
-                    return
+                    return False
                 raise
         raise
+
+
+def _write_state_file(payload: bytes) -> bool:
+    d = os.path.dirname(STATE_FILE) or "."
+    os.makedirs(d, exist_ok=True)
+    tmp_path = os.path.join(d, ".state_tmp.json")
+
+    def _write_once() -> None:
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, STATE_FILE)
+
+    try:
+        return _write_with_enospc_retry(_write_once, tmp_path)
     finally:
         try:
             if os.path.exists(tmp_path):
@@ -965,221 +2116,1125 @@ def save_state(state: dict) -> None:
             pass
 
 
-# ========== TELEGRAM ==========
-
-def tg_api_url(method: str) -> str:
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN is empty. Set BOT_TOKEN env var on host.")
-    return f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+def _append_state_journal(lines: list[str]) -> bool:
+    data = ("\n".join(lines) + "\n").encode("utf-8")
 
+    def _append_once() -> None:
+        with open(STATE_JOURNAL_FILE, "ab") as f:
+            pos = f.tell()
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError:
+                # Don't leave a torn record in front of the retry.
+                try:
+                    f.truncate(pos)
+                except Exception:
+                    pass
+                raise
 
-def tg_call(method: str, payload: dict, *, timeout=(5, 15)) -> dict:
-    """Return Telegram 'result'. Raises on network/API errors."""
-    url = tg_api_url(method)
-    r = http_request_tg("POST", url, json_body=payload, timeout=timeout)
-    data = r.json()
-    if not data.get("ok"):
-        raise RuntimeError(f"Telegram API error: {data}")
-    return data["result"]
+    return _write_with_enospc_retry(_append_once)
 
 
-def notify_admin(text: str) -> None:
-    text = _mask_secrets(text)
-    # Admin notify should never break the main logic.
+def _truncate_state_journal() -> None:
     try:
-        with STATE_LOCK:
-            st = load_state()
-        chat_id = int(st.get("admin_private_chat_id") or 0)
-        target = chat_id if chat_id != 0 else ADMIN_ID
-        tg_call("sendMessage", {"chat_id": target, "text": text[:3500]}, timeout=(5, 15))
+        if _journal_size() > 0:
+            with open(STATE_JOURNAL_FILE, "wb") as f:
+                f.flush()
+                os.fsync(f.fileno())
     except Exception as e:
-        log_line(f"notify_admin failed: {e}")
+        log_line(f"state journal truncate failed: {e}")
 
 
-def notify_409_dedup(text: str) -> None:
-    now = ts()
-    with STATE_LOCK:
-        st = load_state()
-        last = int(st.get("last_409_notify_ts") or 0)
-        if now - last < NOTIFY_409_EVERY_SEC:
-            return
-        st["last_409_notify_ts"] = now
-        save_state(st)
-    notify_admin(text)
+def _compact_state_journal(st: dict, seq: int) -> bool:
+    # Snapshot first, then drop the log: replay skips batches <= _journal_seq, so a crash in between is harmless.
+    payload = state_dumps({**st, "_journal_seq": int(seq)})
+    if not _write_state_file(payload):
+        return False
+    _truncate_state_journal()
+    return True
 
 
-def tg_drop_pending_updates_safe() -> None:
+def _journal_size() -> int:
     try:
-        tg_call("deleteWebhook", {"drop_pending_updates": True}, timeout=(5, 15))
-    except Exception as e:
-        log_line(f"tg_drop_pending_updates_safe failed: {e}")
-
+        return os.path.getsize(STATE_JOURNAL_FILE)
+    except OSError:
+        return 0
 
-def tg_get_webhook_info() -> dict:
-    return tg_call("getWebhookInfo", {}, timeout=(5, 15))
 
-
-def tg_set_my_commands(commands: list, scope: dict | None = None) -> None:
-    payload = {"commands": commands}
-    if scope is not None:
-        payload["scope"] = scope
-    tg_call("setMyCommands", payload, timeout=(5, 15))
+def _state_take_batch_locked() -> None:
+    """Under _STATE_MEM_LOCK: queue everything changed since the previous batch for writing."""
+    global _STATE_DIRTY, _STATE_PERSISTED, _JOURNAL_SEQ
+    if not _STATE_DIRTY or _STATE_MEM is None:
+        return
+    cur = _persistable(_STATE_MEM.copy().to_dict())
+    _STATE_DIRTY = False
+    lines = None
+    if STATE_JOURNAL_ENABLED:
+        recs: list = []
+        _state_diff(_STATE_PERSISTED or {}, cur, [], recs)
+        if not recs:
+            return
+        _JOURNAL_SEQ += 1
+        lines = [_journal_dumps({"s": _JOURNAL_SEQ, **r}) for r in recs]
+    _STATE_PERSISTED = cur
+    _STATE_PENDING.append((_JOURNAL_SEQ, lines, cur))
+
+
+def _state_drain_pending() -> None:
+    """Write queued batches in order. A failed batch stays queued and is retried by the next flush."""
+    with STATE_IO_LOCK:
+        while _STATE_PENDING:
+            seq, lines, cur = _STATE_PENDING[0]
+            if lines is None:
+                # Snapshot mode: only the newest snapshot matters.
+                n = len(_STATE_PENDING)
+                seq, lines, cur = _STATE_PENDING[n - 1]
+                if not _write_state_file(state_dumps(cur)):
+                    return
+                # A leftover log from journal mode must not be replayed over this snapshot.
+                _truncate_state_journal()
+                del _STATE_PENDING[:n]
+                continue
+            if not _append_state_journal(lines):
+                return
+            _STATE_PENDING.pop(0)
+            if _journal_size() > STATE_JOURNAL_MAX_BYTES:
+                _compact_state_journal(cur, seq)
 
 
-def setup_commands_visibility() -> None:
-    public_cmds = [
-        {"command": "stream", "description": "Текущий статус патока"},
-        {"command": "status", "description": "Текущий статус патока"},
-        {"command": "patok", "description": "Текущий статус патока"},
-        {"command": "state", "description": "Состояние бота"},
-    ]
-    admin_cmds = [
-        {"command": "admin", "description": "Диагностика (только админ)"},
-        {"command": "admin_reset_offset", "description": "Сброс offset polling (только админ)"},
-    ]
-    tg_set_my_commands(public_cmds, scope={"type": "all_group_chats"})
+def flush_state() -> None:
+    """Persist lazy changes made since the last flush.
 
-    with STATE_LOCK:
-        st = load_state()
-    admin_chat = int(st.get("admin_private_chat_id") or 0)
-    if admin_chat != 0:
-        tg_set_my_commands(public_cmds + admin_cmds, scope={"type": "chat", "chat_id": admin_chat})
+    Journal mode appends only the changed fields (fsynced) and compacts the log into state.json
+    when it gets large; otherwise the whole state is rewritten atomically.
+    """
+    with _STATE_MEM_LOCK:
+        _state_take_batch_locked()
+    _state_drain_pending()
 
 
-def tg_get_updates(offset: int, timeout: int) -> list:
-    url = tg_api_url("getUpdates")
-    payload = {"offset": int(offset), "timeout": int(timeout), "allowed_updates": ["message"]}
-    # timeout for HTTP read MUST be > longpoll timeout
-    eff_read = max(int(COMMAND_HTTP_TIMEOUT), int(timeout) + 15)
-    r = http_request_tg("POST", url, json_body=payload, timeout=(5, eff_read))
-    data = r.json()
-    if not data.get("ok"):
-        raise RuntimeError(f"Telegram getUpdates error: {data}")
-    return data.get("result", [])
+def state_flusher_forever() -> None:
+    while True:
+        time.sleep(max(1, int(STATE_FLUSH_SEC)))
+        try:
+            flush_state()
+        except Exception as e:
+            log_line(f"state flush error: {e}")
 
 
-def tg_send_chat_action(chat_id: int, thread_id: int | None, action: str) -> None:
+def _flush_state_on_exit() -> None:
     try:
-        payload = {"chat_id": int(chat_id), "action": action}
-        if thread_id is not None:
-            payload["message_thread_id"] = int(thread_id)
-        tg_call("sendChatAction", payload, timeout=(5, 10))
-    except Exception:
-        pass
-
-
-def tg_send_to(chat_id: int, thread_id: int | None, text: str, reply_to: int | None = None) -> int:
-    payload = {"chat_id": chat_id, "text": text[:4000], "disable_web_page_preview": True, "parse_mode": "HTML"}
-    if thread_id is not None:
-        payload["message_thread_id"] = int(thread_id)
-    if reply_to is not None:
-        payload["reply_to_message_id"] = int(reply_to)
-    res = tg_call("sendMessage", payload, timeout=(5, 15))
-    return int(res["message_id"])
-
-
-def tg_send(text: str) -> int:
-    return tg_send_to(GROUP_ID, TOPIC_ID, text, reply_to=None)
-
-
-def maybe_send_to_pubg_topic(text: str, st: dict, kick: dict) -> None:
+        flush_state()
+    except Exception as e:
+        log_line(f"state flush on exit failed: {e}")
+
+
+# ========== STREAM HISTORY (SQLite) ==========
+
+HISTORY_LOCK = threading.Lock()
+_HISTORY_DB = None
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    session_key TEXT NOT NULL UNIQUE,
+    start_ts INTEGER NOT NULL,
+    end_ts INTEGER NOT NULL,
+    duration_sec INTEGER NOT NULL,
+    both_live_sec INTEGER NOT NULL DEFAULT 0,
+    kick_live INTEGER NOT NULL DEFAULT 0,
+    vk_live INTEGER NOT NULL DEFAULT 0,
+    kick_min INTEGER, kick_avg INTEGER, kick_max INTEGER,
+    vk_min INTEGER, vk_avg INTEGER, vk_max INTEGER,
+    kick_title_changes INTEGER NOT NULL DEFAULT 0,
+    kick_cat_changes INTEGER NOT NULL DEFAULT 0,
+    vk_title_changes INTEGER NOT NULL DEFAULT 0,
+    vk_cat_changes INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_start ON sessions(start_ts);
+
+CREATE TABLE IF NOT EXISTS timeline (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    platform TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    start_ts INTEGER NOT NULL,
+    end_ts INTEGER NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_timeline_session ON timeline(session_id);
+CREATE INDEX IF NOT EXISTS idx_timeline_value ON timeline(kind, value COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS viewer_samples (
+    session_key TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    viewers INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_samples_session ON viewer_samples(session_key, ts);
+"""
+
+
+def _history_db():
+    """Lazily open the shared connection. Call under HISTORY_LOCK."""
+    global _HISTORY_DB
+    if _HISTORY_DB is None:
+        d = os.path.dirname(HISTORY_DB_FILE) or "."
+        os.makedirs(d, exist_ok=True)
+        conn = sqlite3.connect(HISTORY_DB_FILE, timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(_HISTORY_SCHEMA)
+        # Older archives predate multi-channel support: everything in them belongs to "main".
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(sessions)")}
+        if "channel" not in cols:
+            conn.execute("ALTER TABLE sessions ADD COLUMN channel TEXT NOT NULL DEFAULT 'main'")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_channel ON sessions(channel, start_ts)")
+        conn.commit()
+        _HISTORY_DB = conn
+    return _HISTORY_DB
+
+
+def history_session_key(started_at: str, ch=None) -> str:
+    # The main channel keeps plain started_at keys, so archives from before multi-channel still match.
+    return started_at if ch is None or ch.is_main else f"{ch.id}:{started_at}"
+
+
+def history_record_samples(started_at: str | None, kick: dict, vk: dict, now_ts: int, ch=None) -> None:
+    """Store this tick's viewer counts for the running session (best-effort)."""
+    if not HISTORY_ENABLED or not started_at:
+        return
+    key = history_session_key(started_at, ch)
+    rows = []
+    for plat, data in (("kick", kick), ("vk", vk)):
+        v = (data or {}).get("viewers")
+        if (data or {}).get("live") and isinstance(v, int):
+            rows.append((key, plat, int(now_ts), int(v)))
+    if not rows:
+        return
     try:
-        cat = (kick or {}).get("category")
-        if cat and cat.strip() == PUBG_CATEGORY_MATCH:
-            tg_send_to(PUBG_DUPLICATE_CHAT_ID, PUBG_DUPLICATE_TOPIC_ID, text, reply_to=None)
+        with HISTORY_LOCK:
+            conn = _history_db()
+            with conn:
+                conn.executemany("INSERT INTO viewer_samples(session_key, platform, ts, viewers) VALUES (?, ?, ?, ?)", rows)
     except Exception as e:
-        log_line(f"PUBG duplicate send error: {e}")
+        log_line(f"history samples write failed: {e}")
 
 
-def tg_send_main_and_maybe_pubg(text: str, st: dict, kick: dict) -> None:
-    tg_send(text)
-    maybe_send_to_pubg_topic(text, st, kick)
+def _plat_avg(p: dict):
+    samples = int(p.get("samples", 0) or 0)
+    if samples <= 0:
+        return None
+    return int(round(int(p.get("sum", 0) or 0) / samples))
 
 
-def tg_send_photo_url_to(chat_id: int, thread_id: int | None, photo_url: str, caption: str, reply_to: int | None = None) -> int:
-    payload = {"chat_id": chat_id, "photo": bust(photo_url), "caption": caption[:1024], "parse_mode": "HTML"}
-    if thread_id is not None:
-        payload["message_thread_id"] = int(thread_id)
-    if reply_to is not None:
-        payload["reply_to_message_id"] = int(reply_to)
-    res = tg_call("sendPhoto", payload, timeout=(5, 25))
-    return int(res["message_id"])
+def history_archive_session(st: dict, ch=None) -> None:
+    """Archive a finished session (summary + category/title timelines). Safe to call twice for one session."""
+    if not HISTORY_ENABLED:
+        return
+    started_at = st.get("started_at")
+    stats = st.get("stream_stats") if isinstance(st.get("stream_stats"), dict) else {}
+    if not started_at:
+        return
+    session_key = history_session_key(started_at, ch)
+    start_dt = dt_from_iso(started_at)
+    start_ts = int(start_dt.timestamp()) if start_dt else int(stats.get("start_ts") or ts())
+    end_ts = int(stats.get("end_ts") or st.get("end_sent_ts") or ts())
+    kick_p = stats.get("kick") if isinstance(stats.get("kick"), dict) else {}
+    vk_p = stats.get("vk") if isinstance(stats.get("vk"), dict) else {}
+
+    row = {
+        "session_key": session_key,
+        "channel": (ch or MAIN_CHANNEL).id,
+        "start_ts": start_ts,
+        "end_ts": end_ts,
+        "duration_sec": max(0, end_ts - start_ts),
+        "both_live_sec": int(stats.get("both_live_sec", 0) or 0),
+        "kick_live": int(bool(stats.get("kick_ever_live"))),
+        "vk_live": int(bool(stats.get("vk_ever_live"))),
+        "kick_min": kick_p.get("min"),
+        "kick_avg": _plat_avg(kick_p),
+        "kick_max": kick_p.get("max"),
+        "vk_min": vk_p.get("min"),
+        "vk_avg": _plat_avg(vk_p),
+        "vk_max": vk_p.get("max"),
+        "kick_title_changes": int(kick_p.get("title_changes", 0) or 0),
+        "kick_cat_changes": int(kick_p.get("cat_changes", 0) or 0),
+        "vk_title_changes": int(vk_p.get("title_changes", 0) or 0),
+        "vk_cat_changes": int(vk_p.get("cat_changes", 0) or 0),
+    }
+    segments = []
+    for plat in ("kick", "vk"):
+        for kind, key in (("category", f"{plat}_cat_timeline"), ("title", f"{plat}_title_timeline")):
+            for seg in stats.get(key) or []:
+                if not isinstance(seg, dict):
+                    continue
+                s = int(seg.get("start_ts") or 0)
+                e = int(seg.get("end_ts") or 0)
+                if e > s:
+                    segments.append((plat, kind, s, e, _norm_key(seg.get("value"))))
+
+    cols = list(row.keys())
+    updates = ", ".join(f"{c}=excluded.{c}" for c in cols if c != "session_key")
+    sql = (
+        f"INSERT INTO sessions({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)}) "
+        f"ON CONFLICT(session_key) DO UPDATE SET {updates}"
+    )
+    try:
+        with HISTORY_LOCK:
+            conn = _history_db()
+            with conn:
+                conn.execute(sql, [row[c] for c in cols])
+                sid = conn.execute("SELECT id FROM sessions WHERE session_key = ?", (session_key,)).fetchone()["id"]
+                conn.execute("DELETE FROM timeline WHERE session_id = ?", (sid,))
+                conn.executemany(
+                    "INSERT INTO timeline(session_id, platform, kind, start_ts, end_ts, value) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(sid, *seg) for seg in segments],
+                )
+    except Exception as e:
+        log_line(f"history archive failed: {e}")
+
+
+def _history_top_categories(conn, session_ids: list[int]) -> dict:
+    if not session_ids:
+        return {}
+    marks = ", ".join("?" for _ in session_ids)
+    rows = conn.execute(
+        f"SELECT session_id, value, SUM(end_ts - start_ts) AS dur FROM timeline "
+        f"WHERE kind = 'category' AND session_id IN ({marks}) "
+        f"GROUP BY session_id, value ORDER BY session_id, dur DESC",
+        session_ids,
+    ).fetchall()
+    out: dict = {}
+    for r in rows:
+        out.setdefault(r["session_id"], []).append((r["value"], int(r["dur"] or 0)))
+    return out
+
+
+def history_last_sessions(limit: int, ch=None) -> tuple[list, dict]:
+    with HISTORY_LOCK:
+        conn = _history_db()
+        rows = conn.execute(
+            "SELECT * FROM sessions WHERE channel = ? ORDER BY start_ts DESC LIMIT ?", ((ch or MAIN_CHANNEL).id, int(limit))
+        ).fetchall()
+        cats = _history_top_categories(conn, [r["id"] for r in rows])
+    return rows, cats
+
+
+def history_sessions_in_category(category: str, limit: int, ch=None) -> tuple[list, dict]:
+    channel = (ch or MAIN_CHANNEL).id
+    with HISTORY_LOCK:
+        conn = _history_db()
+        rows = conn.execute(
+            "SELECT s.* FROM sessions s WHERE s.channel = ? AND s.id IN ("
+            "  SELECT session_id FROM timeline WHERE kind = 'category' AND value = ? COLLATE NOCASE"
+            ") ORDER BY s.start_ts DESC LIMIT ?",
+            (channel, category, int(limit)),
+        ).fetchall()
+        if not rows:
+            # Partial name ("pubg"): slower LIKE scan, only when the exact lookup found nothing.
+            rows = conn.execute(
+                "SELECT s.* FROM sessions s WHERE s.channel = ? AND s.id IN ("
+                "  SELECT session_id FROM timeline WHERE kind = 'category' AND value LIKE ?"
+                ") ORDER BY s.start_ts DESC LIMIT ?",
+                (channel, f"%{category}%", int(limit)),
+            ).fetchall()
+        cats = _history_top_categories(conn, [r["id"] for r in rows])
+    return rows, cats
+
+
+def build_history_text(rows: list, cats: dict, header: str) -> str:
+    lines: list[str] = [header, ""]
+    if not rows:
+        lines.append("—")
+        return "\n".join(lines)
+    for i, r in enumerate(rows, 1):
+        start_dt = datetime.fromtimestamp(int(r["start_ts"]), tz=timezone.utc)
+        lines.append(f"{i}) <b>{fmt_msk(start_dt)}</b> • ⏱ {fmt_duration(int(r['duration_sec']))}")
+        views = []
+        if r["kick_live"]:
+            views.append(f"Kick avg/max <b>{fmt_viewers(r['kick_avg'])} / {fmt_viewers(r['kick_max'])}</b>")
+        if r["vk_live"]:
+            views.append(f"VK avg/max <b>{fmt_viewers(r['vk_avg'])} / {fmt_viewers(r['vk_max'])}</b>")
+        if views:
+            lines.append("👥 " + " • ".join(views))
+        top = cats.get(r["id"]) or []
+        if top:
+            names = ", ".join(f"{esc(v)} ({fmt_hhmm(d)})" for v, d in top[:3])
+            lines.append(f"🏷 {names}")
+        lines.append("")
+    out = "\n".join(lines).rstrip()
+    return out[:3900] + ("…" if len(out) > 3900 else "")
 
 
-def tg_send_photo_upload_to(chat_id: int, thread_id: int | None, image_bytes: bytes, caption: str, filename: str, reply_to: int | None = None) -> int:
-    url = tg_api_url("sendPhoto")
-    data = {"chat_id": str(chat_id), "caption": caption[:1024], "parse_mode": "HTML"}
-    if thread_id is not None:
-        data["message_thread_id"] = str(thread_id)
-    if reply_to is not None:
-        data["reply_to_message_id"] = str(reply_to)
-    files = {"photo": (filename, image_bytes)}
-    # Upload may take longer
-    r = http_request_tg("POST", url, data=data, files=files, timeout=(10, 45))
-    out = r.json()
-    if not out.get("ok"):
-        raise RuntimeError(f"Telegram API error: {out}")
-    return int(out["result"]["message_id"])
+def history_channel(args: str, chat_id=None) -> tuple:
+    """(channel, rest of args) for /history: a leading channel id picks the channel, otherwise the
+    first channel posting to this chat, otherwise the main one."""
+    head, _sep, rest = (args or "").strip().partition(" ")
+    for ch in CHANNELS:
+        if head and head.lower() == ch.id.lower():
+            return ch, rest.strip()
+    for ch in CHANNELS:
+        if chat_id is not None and ch.chat_id == chat_id:
+            return ch, (args or "").strip()
+    return MAIN_CHANNEL, (args or "").strip()
+
+
+def history_reply_text(args: str, chat_id=None) -> str:
+    """Answer /history [channel] [N | category]."""
+    if not HISTORY_ENABLED:
+        return "История патоков выключена."
+    ch, args = history_channel(args, chat_id)
+    who = f" {esc(ch.name)}" if len(CHANNELS) > 1 else ""
+    if not args or args.isdigit():
+        limit = int(args) if args else HISTORY_DEFAULT_LIMIT
+        limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+        rows, cats = history_last_sessions(limit, ch)
+        return build_history_text(rows, cats, f"📚 <b>Последние патоки{who}</b> ({len(rows)})")
+    rows, cats = history_sessions_in_category(args, HISTORY_MAX_LIMIT, ch)
+    return build_history_text(rows, cats, f"📚 <b>Патоки{who} в категории</b> «{esc(args)}» ({len(rows)})")
+
+
+# ========== TELEGRAM RATE LIMIT ==========
+# Every message-sending Telegram request first takes a token from the global bucket and from its
+# chat's bucket, so bursts (start alert + PUBG duplicate + /stream replies) are spread out client-side
+# instead of being rejected. A short wait for the next token is slept; a longer one raises
+# TgRateLimited without taking anything, and the outbound queue / retry scheduler run the send again
+# when the tokens are there. A 429's retry_after blocks the chat's bucket (the global one if the
+# chat is unknown) for that long; nothing is sent to a blocked bucket.
+_TG_LIMITED_METHODS = frozenset({
+    "sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument", "sendVideo", "sendAnimation",
+    "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption", "editMessageMedia",
+    "pinChatMessage", "unpinChatMessage",
+})
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(1e-6, float(rate))
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def blocked_for(self, now: float) -> float:
+        return max(0.0, self.blocked_until - now)
+
+    def wait_for(self, now: float) -> float:
+        """Seconds until a token is available (nothing is taken)."""
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        # While a retry_after block lasts, updated is in the future: refill starts from there.
+        return (self.updated - now) + ((1.0 - self.tokens) / self.rate if self.tokens < 1.0 else 0.0)
+
+    def take(self) -> None:
+        """Take a token after wait_for(); the bucket may go negative by the part the caller sleeps out."""
+        self.tokens -= 1.0
+
+    def block(self, now: float, sec: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + sec)
+        # Telegram's retry_after is authoritative: one message may go when it ends, no refill before.
+        self.tokens = 1.0
+        self.updated = max(self.updated, self.blocked_until)
+
+
+_TG_RATE_LOCK = threading.Lock()
+_TG_GLOBAL_BUCKET = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+_TG_CHAT_BUCKETS = {}
+_TG_RATE_COUNTERS = {"waits": 0, "wait_sec": 0.0, "deferred": 0, "rejected": 0}
+
+
+class TgRateLimited(RuntimeError):
+    """Not sent: the chat's (or the global) bucket has no token for retry_after seconds. Retryable."""
+
+    def __init__(self, chat_id, retry_after: float):
+        super().__init__(f"Telegram rate limit: chat {chat_id if chat_id is not None else '?'} busy for {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def _tg_chat_bucket(chat_id: int) -> TokenBucket:
+    b = _TG_CHAT_BUCKETS.get(chat_id)
+    if b is None:
+        rate = TG_GROUP_RATE_PER_MIN / 60.0 if chat_id < 0 else TG_PRIVATE_RATE
+        b = _TG_CHAT_BUCKETS[chat_id] = TokenBucket(rate, TG_CHAT_BURST)
+    return b
+
+
+def _tg_rate_target(url: str, json_body, data) -> tuple[bool, int | None]:
+    """(is a rate-limited method, numeric chat_id or None)."""
+    if url.rsplit("/", 1)[-1] not in _TG_LIMITED_METHODS:
+        return False, None
+    body = json_body if isinstance(json_body, dict) else data if isinstance(data, dict) else {}
+    try:
+        return True, int(body.get("chat_id"))
+    except (TypeError, ValueError):
+        return True, None  # "@channel" usernames: only the global bucket applies
+
+
+def _tg_rate_take(url: str, json_body, data, defer: bool) -> float:
+    """Take the send's tokens; returns how long to wait before sending. defer: raise TgRateLimited
+    instead of taking anything when the bucket is blocked or the wait is over TG_RATE_MAX_WAIT_SEC."""
+    limited, chat_id = _tg_rate_target(url, json_body, data)
+    if not limited:
+        return 0.0
+    with _TG_RATE_LOCK:
+        now = time.monotonic()
+        buckets = [_TG_GLOBAL_BUCKET] + ([_tg_chat_bucket(chat_id)] if chat_id is not None else [])
+        blocked = max(b.blocked_for(now) for b in buckets)
+        wait = max(b.wait_for(now) for b in buckets) if TG_RATE_LIMIT_ENABLED else blocked
+        if defer and (blocked > 0 or wait > TG_RATE_MAX_WAIT_SEC):
+            _TG_RATE_COUNTERS["deferred"] += 1
+            raise TgRateLimited(chat_id, max(wait, blocked))
+        wait = max(wait, blocked)
+        if TG_RATE_LIMIT_ENABLED:
+            for b in buckets:
+                b.take()
+        if wait > 0:
+            _TG_RATE_COUNTERS["waits"] += 1
+            _TG_RATE_COUNTERS["wait_sec"] += wait
+    return wait
+
+
+def tg_rate_acquire(url: str, json_body=None, data=None) -> None:
+    """Take the send's tokens, sleeping out a short wait; raise TgRateLimited instead of a long one."""
+    wait = _tg_rate_take(url, json_body, data, defer=True)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def tg_rate_penalize(url: str, json_body, data, retry_after: float) -> None:
+    _limited, chat_id = _tg_rate_target(url, json_body, data)
+    with _TG_RATE_LOCK:
+        bucket = _tg_chat_bucket(chat_id) if chat_id is not None else _TG_GLOBAL_BUCKET
+        bucket.block(time.monotonic(), retry_after)
+        _TG_RATE_COUNTERS["rejected"] += 1
+    log_line(f"[tg-rate] 429 for chat {chat_id if chat_id is not None else '?'}: retry_after={retry_after:g}s")
+
+
+def tg_response_retry_after(resp) -> float | None:
+    """parameters.retry_after from a Telegram 429 response, if any."""
+    if int(getattr(resp, "status_code", 0) or 0) != 429:
+        return None
+    try:
+        return float(((resp.json() or {}).get("parameters") or {}).get("retry_after"))
+    except Exception:
+        return None
 
 
-def download_image(url: str) -> bytes:
-    u = bust(url) or url
-    headers = {
-        "User-Agent": UA,
-        "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
-        "Cache-Control": "no-cache",
-        "Pragma": "no-cache",
-    }
-    r = http_request_ext("GET", u, headers=headers, timeout=25)
-    return r.content
+def tg_rate_stats() -> dict:
+    with _TG_RATE_LOCK:
+        return dict(_TG_RATE_COUNTERS)
+
+
+# ========== RETRY SCHEDULER ==========
+# A heap of (due, seq, job). One thread sleeps until the earliest job is due and hands it to a small
+# worker pool; a failed attempt is pushed back with its backoff (or Telegram's retry_after) as the
+# new due time. Nothing sleeps in the thread that queued the work.
+
+def tg_retry_after(exc: Exception) -> float | None:
+    """Telegram's parameters.retry_after from a 429 response (or our own limiter's), if any."""
+    if isinstance(exc, TgRateLimited):
+        return exc.retry_after
+    resp = getattr(exc, "response", None)
+    return tg_response_retry_after(resp) if resp is not None else None
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, TgRateLimited):
+        return True
+    if isinstance(exc, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(exc, requests.exceptions.HTTPError) and getattr(exc, "response", None) is not None:
+        return int(exc.response.status_code or 0) in (429, 500, 502, 503, 504)
+    return False
+
+
+@dataclass(slots=True)
+class _RetryJob:
+    name: str
+    fn: object
+    max_attempts: int
+    base: float
+    cap: float
+    attempt: int = 0
+
+
+class RetryScheduler:
+    def __init__(self, workers: int):
+        self.heap = []
+        self.cv = threading.Condition()
+        self.seq = itertools.count()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="retry")
+        self.counters = {"queued": 0, "attempts": 0, "retries": 0, "delay_sec": 0.0, "gave_up": 0}
+        self.thread = None
+
+    def submit(self, name: str, fn, *, max_attempts: int = RETRY_MAX_ATTEMPTS, base: float = TG_BACKOFF_BASE, cap: float = RETRY_MAX_DELAY_SEC) -> None:
+        """Run fn() soon; retry it on transient errors without blocking the caller."""
+        with self.cv:
+            self.counters["queued"] += 1
+        self._push(_RetryJob(name, fn, max(1, int(max_attempts)), base, cap), 0.0)
+
+    def _push(self, job: _RetryJob, delay: float) -> None:
+        with self.cv:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), job))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._dispatch_forever, daemon=True, name="retry-sched")
+                self.thread.start()
+            self.cv.notify()
+
+    def call_later(self, delay: float, fn) -> None:
+        """Run fn() on a worker after delay seconds. No retries or counters: the caller has its own policy."""
+        self._push(fn, delay)
+
+    def _dispatch_forever(self) -> None:
+        while True:
+            with self.cv:
+                while True:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.cv.wait(timeout=(self.heap[0][0] - now) if self.heap else None)
+                _due, _seq, job = heapq.heappop(self.heap)
+            self.pool.submit(self._attempt, job) if isinstance(job, _RetryJob) else self.pool.submit(job)
+
+    def _attempt(self, job: _RetryJob) -> None:
+        job.attempt += 1
+        with self.cv:
+            self.counters["attempts"] += 1
+        try:
+            job.fn()
+            return
+        except Exception as e:
+            if isinstance(e, TgRateLimited):
+                job.attempt -= 1  # nothing was sent: waiting for a token is not a failed attempt
+            if job.attempt >= job.max_attempts or not _is_retryable(e):
+                with self.cv:
+                    self.counters["gave_up"] += 1
+                log_line(f"[retry] {job.name}: giving up after {job.attempt} attempt(s): {e}")
+                return
+            delay = tg_retry_after(e)
+            delay = min(job.cap, delay if delay is not None else _backoff_delay(job.attempt, job.base, job.cap, True))
+        with self.cv:
+            self.counters["retries"] += 1
+            self.counters["delay_sec"] += delay
+        self._push(job, delay)
+
+    def stats(self) -> dict:
+        with self.cv:
+            out = dict(self.counters)
+            out["pending"] = len(self.heap)
+        return out
+
+
+RETRY_SCHED = RetryScheduler(RETRY_WORKERS)
+
+
+# ========== OUTBOUND QUEUE ==========
+# Per-chat FIFO queues plus a heap of chats whose head message can go now, keyed by the best priority
+# waiting in that chat. A chat has at most one message in flight, so per-chat order holds while
+# urgent chats jump ahead of busy ones. A transient failure keeps the message at the head and makes
+# the chat ready again after its backoff (a RETRY_SCHED timer); other chats keep flowing meanwhile.
+PRIO_ALERT, PRIO_CHANGE, PRIO_DUPLICATE, PRIO_ADMIN = range(4)
+
+
+@dataclass(slots=True)
+class _OutMsg:
+    name: str
+    fn: object  # fn(deadline) does the actual send(s)
+    prio: int
+    attempt: int = 0
+    on_drop: object = None  # on_drop() once the message is given up on
+
+
+class Outbox:
+    def __init__(self, workers: int):
+        self.cv = threading.Condition()
+        self.chats = {}  # chat key -> deque of _OutMsg
+        self.ready = []  # heap of (best prio, seq, chat key); stale entries are skipped on pop
+        self.busy = set()  # chats with a message in flight or waiting out a retry delay
+        self.seq = itertools.count()
+        self.workers = max(1, workers)
+        self.started = False
+        self.counters = {"queued": 0, "sent": 0, "retries": 0, "dropped": 0}
+
+    def put(self, chat_key, name: str, fn, prio: int, on_drop=None) -> None:
+        with self.cv:
+            q = self.chats.setdefault(chat_key, deque())
+            q.append(_OutMsg(name, fn, prio, on_drop=on_drop))
+            self.counters["queued"] += 1
+            if chat_key not in self.busy:
+                heapq.heappush(self.ready, (min(m.prio for m in q), next(self.seq), chat_key))
+            if not self.started:
+                self.started = True
+                for i in range(self.workers):
+                    threading.Thread(target=self._worker_forever, daemon=True, name=f"outbox-{i}").start()
+            self.cv.notify()
+
+    def _worker_forever(self) -> None:
+        while True:
+            with self.cv:
+                while True:
+                    while self.ready and (self.ready[0][2] in self.busy or not self.chats.get(self.ready[0][2])):
+                        heapq.heappop(self.ready)
+                    if self.ready:
+                        break
+                    self.cv.wait()
+                _prio, _seq, key = heapq.heappop(self.ready)
+                self.busy.add(key)
+                msg = self.chats[key][0]
+            self._send(key, msg)
+
+    def _send(self, key, msg: _OutMsg) -> None:
+        msg.attempt += 1
+        try:
+            msg.fn(Deadline(OUTBOX_JOB_DEADLINE_SEC))
+            outcome = "sent"
+        except Exception as e:
+            if isinstance(e, TgRateLimited):
+                msg.attempt -= 1  # nothing was sent: waiting for a token is not a failed attempt
+            if msg.attempt < RETRY_MAX_ATTEMPTS and _is_retryable(e):
+                delay = tg_retry_after(e)
+                delay = min(RETRY_MAX_DELAY_SEC, delay if delay is not None else _backoff_delay(msg.attempt, TG_BACKOFF_BASE, RETRY_MAX_DELAY_SEC, True))
+                with self.cv:
+                    self.counters["retries"] += 1
+                RETRY_SCHED.call_later(delay, lambda: self._release(key))
+                return
+            log_line(f"[outbox] {msg.name}: dropped after {msg.attempt} attempt(s): {e}")
+            outcome = "dropped"
+            if msg.on_drop is not None:
+                try:
+                    msg.on_drop()
+                except Exception as drop_err:
+                    log_line(f"[outbox] {msg.name}: on_drop failed: {drop_err}")
+        with self.cv:
+            self.chats[key].popleft()
+            self.counters[outcome] += 1
+        self._release(key)
+
+    def _release(self, key) -> None:
+        with self.cv:
+            self.busy.discard(key)
+            q = self.chats.get(key)
+            if q:
+                heapq.heappush(self.ready, (min(m.prio for m in q), next(self.seq), key))
+                self.cv.notify()
+            elif q is not None:
+                del self.chats[key]
+            self.cv.notify_all()  # drain() waiters
+
+    def drain(self, timeout: float) -> bool:
+        """Wait until every queue is empty (used at exit). Returns False on timeout."""
+        end = time.monotonic() + timeout
+        with self.cv:
+            while self.chats:
+                left = end - time.monotonic()
+                if left <= 0:
+                    return False
+                self.cv.wait(left)
+        return True
+
+    def stats(self) -> dict:
+        with self.cv:
+            out = dict(self.counters)
+            out["pending"] = sum(len(q) for q in self.chats.values())
+        return out
+
+
+OUTBOX = Outbox(OUTBOX_WORKERS)
+
+
+def outbox_send(chat_id, name: str, prio: int, fn, deadline: Deadline | None = None, on_drop=None) -> None:
+    """Queue fn(deadline) for the sender workers; with OUTBOX_ENABLED=0 run it inline (errors propagate).
+
+    on_drop() runs if the message is given up on (inline: when fn raises), so the caller can re-arm it.
+    """
+    if OUTBOX_ENABLED:
+        OUTBOX.put(chat_id, name, fn, prio, on_drop)
+        return
+    try:
+        fn(deadline)
+    except Exception:
+        if on_drop is not None:
+            on_drop()
+        raise
+
+
+def outbox_drain_on_exit() -> None:
+    if OUTBOX_ENABLED and not OUTBOX.drain(10):
+        log_line(f"[outbox] exit with {OUTBOX.stats()['pending']} message(s) unsent")
 
 
-def tg_send_photo_best_to(chat_id: int, thread_id: int | None, photo_url: str, caption: str, reply_to: int | None = None) -> int:
+def send_later(name: str, fn, chat_id=None, prio: int = PRIO_ADMIN) -> None:
+    """Fire-and-forget send: through the outbound queue (or the retry scheduler), never sleeping here."""
+    if OUTBOX_ENABLED:
+        OUTBOX.put(chat_id if chat_id is not None else "admin", name, lambda _deadline: fn(), prio)
+        return
+    if RETRY_SCHED_ENABLED:
+        RETRY_SCHED.submit(name, fn)
+        return
     try:
-        img = download_image(photo_url)
-        return tg_send_photo_upload_to(chat_id, thread_id, img, caption, filename=f"thumb_{ts()}.jpg", reply_to=reply_to)
+        fn()
     except Exception as e:
-        log_line(f"Photo upload fallback to URL. Reason: {e}")
-        return tg_send_photo_url_to(chat_id, thread_id, photo_url, caption, reply_to=reply_to)
+        log_line(f"{name} failed: {e}")
+
+
+# ========== TELEGRAM ==========
+
+def tg_api_url(method: str) -> str:
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN is empty. Set BOT_TOKEN env var on host.")
+    return f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+
+
+def tg_call(method: str, payload: dict, *, timeout=(5, 15), retries: int | None = None) -> dict:
+    """Return Telegram 'result'. Raises on network/API errors."""
+    url = tg_api_url(method)
+    r = http_request_tg("POST", url, json_body=payload, timeout=timeout, retries=retries)
+    return _tg_result(r)
+
+
+def _tg_result(r: requests.Response):
+    data = r.json()
+    if not data.get("ok"):
+        raise RuntimeError(f"Telegram API error: {data}")
+    return data["result"]
+
+
+def notify_admin(text: str) -> None:
+    text = _mask_secrets(text)
+    # Admin notify should never break the main logic.
+    try:
+        chat_id = int(state_peek("admin_private_chat_id") or 0)
+        target = chat_id if chat_id != 0 else ADMIN_ID
+        payload = {"chat_id": target, "text": text[:3500]}
+        send_later("notify_admin", lambda: tg_call("sendMessage", payload, timeout=(5, 15), retries=1))
+    except Exception as e:
+        log_line(f"notify_admin failed: {e}")
+
+
+def notify_409_dedup(text: str) -> None:
+    now = ts()
+    with NOTIFY_STATE_LOCK:
+        st = load_state()
+        last = int(st.get("last_409_notify_ts") or 0)
+        if now - last < NOTIFY_409_EVERY_SEC:
+            return
+        st["last_409_notify_ts"] = now
+        save_state(st)
+    notify_admin(text)
+
+
+def tg_drop_pending_updates_safe() -> None:
+    try:
+        tg_call("deleteWebhook", {"drop_pending_updates": True}, timeout=(5, 15))
+    except Exception as e:
+        log_line(f"tg_drop_pending_updates_safe failed: {e}")
+
+
+def tg_get_webhook_info(retries: int | None = None) -> dict:
+    return tg_call("getWebhookInfo", {}, timeout=(5, 15), retries=retries)
+
+
+def tg_set_my_commands(commands: list, scope: dict | None = None, retries: int | None = None) -> None:
+    payload = {"commands": commands}
+    if scope is not None:
+        payload["scope"] = scope
+    tg_call("setMyCommands", payload, timeout=(5, 15), retries=retries)
+
+
+def setup_commands_visibility(retries: int | None = None) -> None:
+    public_cmds = [
+        {"command": "stream", "description": "Текущий статус патока"},
+        {"command": "status", "description": "Текущий статус патока"},
+        {"command": "patok", "description": "Текущий статус патока"},
+        {"command": "state", "description": "Состояние бота"},
+        {"command": "history", "description": "История патоков"},
+    ]
+    admin_cmds = [
+        {"command": "admin", "description": "Диагностика (только админ)"},
+        {"command": "admin_reset_offset", "description": "Сброс offset polling (только админ)"},
+    ]
+    tg_set_my_commands(public_cmds, scope={"type": "all_group_chats"}, retries=retries)
+
+    admin_chat = int(state_view().get("admin_private_chat_id") or 0)
+    if admin_chat != 0:
+        tg_set_my_commands(public_cmds + admin_cmds, scope={"type": "chat", "chat_id": admin_chat}, retries=retries)
+
+
+def _get_updates_request(offset: int, timeout: int) -> tuple[dict, tuple]:
+    """(payload, HTTP timeout) of a getUpdates long-poll."""
+    payload = {"offset": int(offset), "timeout": int(timeout), "allowed_updates": ["message"]}
+    # timeout for HTTP read MUST be > longpoll timeout
+    eff_read = max(int(COMMAND_HTTP_TIMEOUT), int(timeout) + 15)
+    return payload, (5, eff_read)
+
+
+def _get_updates_result(r: requests.Response) -> list:
+    data = r.json()
+    if not data.get("ok"):
+        raise RuntimeError(f"Telegram getUpdates error: {data}")
+    return data.get("result", [])
 
 
-# ---------- FAST send helpers for command replies ----------
+def tg_get_updates(offset: int, timeout: int) -> list:
+    payload, http_timeout = _get_updates_request(offset, timeout)
+    return _get_updates_result(http_request_tg("POST", tg_api_url("getUpdates"), json_body=payload, timeout=http_timeout))
+
+
+def tg_send_chat_action(chat_id: int, thread_id: int | None, action: str) -> None:
+    try:
+        payload = _tg_payload(int(chat_id), thread_id, None, action=action)
+        tg_call("sendChatAction", payload, timeout=(5, 10), retries=1)  # cosmetic: never worth a backoff
+    except Exception:
+        pass
+
 
-def tg_send_to_cmd(chat_id: int, thread_id: int | None, text: str, reply_to: int | None = None) -> int:
-    payload = {"chat_id": chat_id, "text": text[:4000], "disable_web_page_preview": True, "parse_mode": "HTML"}
+def _tg_payload(chat_id: int, thread_id: int | None, reply_to: int | None, **fields) -> dict:
+    payload = {"chat_id": chat_id, **fields}
     if thread_id is not None:
         payload["message_thread_id"] = int(thread_id)
     if reply_to is not None:
         payload["reply_to_message_id"] = int(reply_to)
-    res = tg_call("sendMessage", payload, timeout=(4, TG_CMD_SEND_TIMEOUT_SEC))
+    return payload
+
+
+def _tg_text_payload(chat_id: int, thread_id: int | None, text: str, reply_to: int | None) -> dict:
+    return _tg_payload(chat_id, thread_id, reply_to, text=text[:4000], disable_web_page_preview=True, parse_mode="HTML")
+
+
+def _tg_photo_payload(chat_id: int, thread_id: int | None, photo, caption: str, reply_to: int | None) -> dict:
+    """sendPhoto fields; photo=None gives the form fields of an upload (the file goes separately)."""
+    payload = _tg_payload(chat_id, thread_id, reply_to, caption=caption[:1024], parse_mode="HTML")
+    if photo is None:
+        return {k: str(v) for k, v in payload.items()}
+    payload["photo"] = photo
+    return payload
+
+
+def _tg_photo_uploaded(image_bytes: bytes, out: dict) -> int:
+    """message_id of an answered upload; its file_id goes into the media cache."""
+    if not out.get("ok"):
+        raise RuntimeError(f"Telegram API error: {out}")
+    _media_count("uploads")
+    media_cache_put(image_bytes, out["result"])
+    return int(out["result"]["message_id"])
+
+
+def tg_send_to(chat_id: int, thread_id: int | None, text: str, reply_to: int | None = None, retries: int | None = None) -> int:
+    res = tg_call("sendMessage", _tg_text_payload(chat_id, thread_id, text, reply_to), timeout=(5, 15), retries=retries)
     return int(res["message_id"])
 
 
-def tg_send_photo_url_to_cmd(chat_id: int, thread_id: int | None, photo_url: str, caption: str, reply_to: int | None = None) -> int:
-    payload = {"chat_id": chat_id, "photo": bust(photo_url), "caption": caption[:1024], "parse_mode": "HTML"}
-    if thread_id is not None:
-        payload["message_thread_id"] = int(thread_id)
-    if reply_to is not None:
-        payload["reply_to_message_id"] = int(reply_to)
-    res = tg_call("sendPhoto", payload, timeout=(4, TG_CMD_PHOTO_URL_TIMEOUT_SEC))
+def tg_send(text: str, ch=None) -> int:
+    ch = ch or MAIN_CHANNEL
+    return tg_send_to(ch.chat_id, ch.topic_id, text, reply_to=None)
+
+
+# ---------- fan-out: one rendered message to several chats ----------
+
+@dataclass(slots=True, frozen=True)
+class FanLeg:
+    label: str
+    chat_id: int
+    fn: object  # fn() -> message_id
+    primary: bool = True  # the caller waits for primary legs; the others are sent in the background
+
+
+FANOUT_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="fanout")
+
+
+class FanOut:
+    """One message to several destinations at once, with a result per destination.
+
+    Secondary legs (duplicates) start on FANOUT_POOL right away and never block the caller; only a
+    retryable failure hands them to the outbound queue, so they never wait behind another leg's
+    upload or retries in the same chat. Primary legs run concurrently here and the first error is
+    raised after all of them finished. Calling send() again (a retry of the whole alert) skips legs
+    already sent or started.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.results = {}  # label -> message_id, "queued" or the exception
+        self.done = set()
+        self.lock = threading.Lock()  # results are also written by secondary legs on FANOUT_POOL
+
+    def send(self, legs) -> dict:
+        with self.lock:
+            todo = [leg for leg in legs if leg is not None and leg.label not in self.done]
+            for leg in todo:
+                if not leg.primary:
+                    self.results[leg.label] = "queued"
+                    self.done.add(leg.label)
+        for leg in todo:
+            if not leg.primary:
+                FANOUT_POOL.submit(self._send_secondary, leg)
+        primary = [leg for leg in todo if leg.primary]
+        futs = [(leg, FANOUT_POOL.submit(_timed_call, leg.fn)) for leg in primary[1:]]
+        finished = [(primary[0], _timed_call(primary[0].fn))] if primary else []
+        finished += [(leg, f.result()) for leg, f in futs]
+        first_err = None
+        with self.lock:
+            for leg, (res, err, _sec) in finished:
+                self.results[leg.label] = res if err is None else err
+                if err is None:
+                    self.done.add(leg.label)
+                elif first_err is None:
+                    first_err = err
+            results = dict(self.results)
+        if first_err is not None:
+            raise first_err
+        return results
+
+    def result(self, label: str):
+        with self.lock:
+            return self.results.get(label)
+
+    def _send_secondary(self, leg: FanLeg) -> None:
+        name = f"{self.name} -> {leg.label}"
+        res, err, _sec = _timed_call(leg.fn)
+        with self.lock:
+            self.results[leg.label] = res if err is None else err
+        if err is None:
+            return
+        if _is_retryable(err):
+            log_line(f"{name}: {err}; queued for retry")
+            send_later(name, leg.fn, chat_id=leg.chat_id, prio=PRIO_DUPLICATE)
+        else:
+            log_line(f"{name} failed: {err}")
+
+
+def pubg_leg(text: str, kick: dict, ch=None) -> FanLeg | None:
+    """The PUBG-topic duplicate of text, if this channel has one and the Kick category matches."""
+    ch = ch or MAIN_CHANNEL
+    if ch.pubg_chat_id is None:
+        return None
+    cat = (kick or {}).get("category")
+    if not (cat and cat.strip() == PUBG_CATEGORY_MATCH):
+        return None
+    return FanLeg(
+        "pubg",
+        ch.pubg_chat_id,
+        lambda: tg_send_to(ch.pubg_chat_id, ch.pubg_topic_id, text, reply_to=None, retries=1),
+        primary=False,
+    )
+
+
+def tg_send_main_and_maybe_pubg(text: str, st: dict, kick: dict, ch=None, fan: FanOut | None = None) -> dict:
+    ch = ch or MAIN_CHANNEL
+    fan = fan or FanOut("message")
+    return fan.send([pubg_leg(text, kick, ch), FanLeg("main", ch.chat_id, lambda: tg_send(text, ch))])
+
+
+def tg_send_photo_url_to(chat_id: int, thread_id: int | None, photo_url: str, caption: str, reply_to: int | None = None, retries: int | None = None) -> int:
+    payload = _tg_photo_payload(chat_id, thread_id, bust(photo_url), caption, reply_to)
+    res = tg_call("sendPhoto", payload, timeout=(5, 25), retries=retries)
     return int(res["message_id"])
 
 
-def tg_send_photo_upload_to_cmd(chat_id: int, thread_id: int | None, image_bytes: bytes, caption: str, filename: str, reply_to: int | None = None) -> int:
+def _tg_send_photo_bytes(chat_id: int, thread_id: int | None, image_bytes: bytes, caption: str, filename: str, reply_to: int | None, json_timeout, upload_timeout, retries: int | None = None) -> int:
+    """sendPhoto by cached file_id if these exact bytes went up recently; upload (and remember) otherwise."""
+    file_id = media_cache_get(image_bytes)
+    if file_id:
+        try:
+            res = tg_call("sendPhoto", _tg_photo_payload(chat_id, thread_id, file_id, caption, reply_to), timeout=json_timeout, retries=retries)
+            _media_count("reused")
+            return int(res["message_id"])
+        except Exception as e:
+            if _is_retryable(e):
+                raise  # network trouble: an upload would not fare better
+            # Telegram rejected the file_id (expired / other bot): forget it and upload.
+            log_line(f"Cached file_id rejected, uploading again: {e}")
+            media_cache_drop(image_bytes)
+
     url = tg_api_url("sendPhoto")
-    data = {"chat_id": str(chat_id), "caption": caption[:1024], "parse_mode": "HTML"}
-    if thread_id is not None:
-        data["message_thread_id"] = str(thread_id)
-    if reply_to is not None:
-        data["reply_to_message_id"] = str(reply_to)
+    data = _tg_photo_payload(chat_id, thread_id, None, caption, reply_to)
     files = {"photo": (filename, image_bytes)}
-    r = http_request_tg("POST", url, data=data, files=files, timeout=(6, TG_CMD_PHOTO_UPLOAD_TIMEOUT_SEC))
+    r = http_request_tg("POST", url, data=data, files=files, timeout=upload_timeout, retries=retries)
+    return _tg_photo_uploaded(image_bytes, r.json())
+
+
+def tg_send_photo_upload_to(chat_id: int, thread_id: int | None, image_bytes: bytes, caption: str, filename: str, reply_to: int | None = None, retries: int | None = None) -> int:
+    # Upload may take longer
+    return _tg_send_photo_bytes(chat_id, thread_id, image_bytes, caption, filename, reply_to, (5, 25), (10, 45), retries)
+
+
+def tg_error_text(exc: Exception) -> str:
+    """Telegram's description of a failed call (HTTPError bodies carry it), else str(exc)."""
+    resp = getattr(exc, "response", None)
+    if resp is not None:
+        try:
+            return str((resp.json() or {}).get("description") or exc)
+        except Exception:
+            pass
+    return str(exc)
+
+
+def tg_edit_caption(chat_id: int, message_id: int, caption: str) -> None:
+    payload = {"chat_id": chat_id, "message_id": int(message_id), "caption": caption[:1024], "parse_mode": "HTML"}
+    tg_call("editMessageCaption", payload, timeout=(5, 15), retries=1)
+
+
+def tg_edit_text(chat_id: int, message_id: int, text: str) -> None:
+    payload = {"chat_id": chat_id, "message_id": int(message_id), "text": text[:4000], "parse_mode": "HTML", "disable_web_page_preview": True}
+    tg_call("editMessageText", payload, timeout=(5, 15), retries=1)
+
+
+def tg_edit_photo(chat_id: int, message_id: int, image_bytes: bytes, caption: str) -> None:
+    """editMessageMedia with new JPEG bytes (by cached file_id if they went up before)."""
+    media = {"type": "photo", "caption": caption[:1024], "parse_mode": "HTML"}
+    file_id = media_cache_get(image_bytes)
+    if file_id:
+        media["media"] = file_id
+        tg_call("editMessageMedia", {"chat_id": chat_id, "message_id": int(message_id), "media": media}, timeout=(5, 15), retries=1)
+        _media_count("reused")
+        return
+    media["media"] = "attach://shot"
+    data = {"chat_id": str(chat_id), "message_id": str(message_id), "media": json.dumps(media, ensure_ascii=False)}
+    r = http_request_tg("POST", tg_api_url("editMessageMedia"), data=data, files={"shot": (f"live_{ts()}.jpg", image_bytes)}, timeout=(10, 45), retries=1)
     out = r.json()
     if not out.get("ok"):
         raise RuntimeError(f"Telegram API error: {out}")
-    return int(out["result"]["message_id"])
+    _media_count("uploads")
+    if isinstance(out.get("result"), dict):
+        media_cache_put(image_bytes, out["result"])
+
+
+def tg_pin(chat_id: int, message_id: int) -> None:
+    tg_call("pinChatMessage", {"chat_id": chat_id, "message_id": int(message_id), "disable_notification": True}, timeout=(5, 15))
+
+
+def tg_unpin(chat_id: int, message_id: int) -> None:
+    tg_call("unpinChatMessage", {"chat_id": chat_id, "message_id": int(message_id)}, timeout=(5, 15))
+
+
+HEADERS_IMAGE = {
+    "User-Agent": UA,
+    "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
+    "Cache-Control": "no-cache",
+    "Pragma": "no-cache",
+}
+
+
+def download_image(url: str, deadline: Deadline | None = None, retries: int | None = None) -> bytes:
+    r = http_request_ext("GET", bust(url) or url, headers=HEADERS_IMAGE, timeout=25, deadline=deadline, retries=retries)
+    return r.content
 
 
+def tg_send_photo_best_to(chat_id: int, thread_id: int | None, photo_url: str, caption: str, reply_to: int | None = None, deadline: Deadline | None = None, retries: int | None = None) -> int:
+    try:
+        img = download_image(photo_url, deadline, retries)
+        return tg_send_photo_upload_to(chat_id, thread_id, img, caption, filename=f"thumb_{ts()}.jpg", reply_to=reply_to, retries=retries)
+    except Exception as e:
+        log_line(f"Photo upload fallback to URL. Reason: {e}")
+        return tg_send_photo_url_to(chat_id, thread_id, photo_url, caption, reply_to=reply_to, retries=retries)
+
 
 # ========== FFMPEG SCREENSHOT ==========
 
@@ -1191,10 +3246,8 @@ def ffmpeg_available() -> bool:
         return False
 
 
-def screenshot_from_m3u8(playback_url: str) -> bytes | None:
-    if not FFMPEG_ENABLED or not playback_url or not ffmpeg_available():
-        return None
-    cmd = [
+def ffmpeg_screenshot_cmd(playback_url: str) -> list:
+    return [
         FFMPEG_BIN,
         "-hide_banner",
         "-loglevel",
@@ -1214,8 +3267,20 @@ def screenshot_from_m3u8(playback_url: str) -> bytes | None:
         "mjpeg",
         "pipe:1",
     ]
+
+
+def screenshot_from_m3u8(playback_url: str, deadline: Deadline | None = None) -> bytes | None:
+    if not FFMPEG_ENABLED or not playback_url or not ffmpeg_available():
+        return None
+    timeout = FFMPEG_TIMEOUT_SEC
+    if deadline is not None:
+        # Not worth starting ffmpeg with less than a couple of seconds left; thumbnails are the fallback.
+        if deadline.remaining() < 2:
+            return None
+        timeout = deadline.clamp(timeout)
+    cmd = ffmpeg_screenshot_cmd(playback_url)
     try:
-        p = subprocess.run(cmd, capture_output=True, timeout=FFMPEG_TIMEOUT_SEC)
+        p = subprocess.run(cmd, capture_output=True, timeout=timeout)
         if p.returncode != 0 or not p.stdout:
             return None
         return p.stdout
@@ -1227,26 +3292,7 @@ def screenshot_from_m3u8_fast(playback_url: str) -> bytes | None:
     # Same as screenshot_from_m3u8 but with shorter timeout for commands.
     if not FFMPEG_ENABLED or not playback_url or not ffmpeg_available():
         return None
-    cmd = [
-        FFMPEG_BIN,
-        "-hide_banner",
-        "-loglevel",
-        "error",
-        "-nostdin",
-        "-ss",
-        str(FFMPEG_SEEK_SEC),
-        "-i",
-        playback_url,
-        "-vframes",
-        "1",
-        "-vf",
-        f"scale={FFMPEG_SCALE}",
-        "-f",
-        "image2pipe",
-        "-vcodec",
-        "mjpeg",
-        "pipe:1",
-    ]
+    cmd = ffmpeg_screenshot_cmd(playback_url)
     try:
         p = subprocess.run(cmd, capture_output=True, timeout=min(int(FFMPEG_TIMEOUT_SEC), int(FFMPEG_CMD_TIMEOUT_SEC)))
         if p.returncode != 0 or not p.stdout:
@@ -1257,68 +3303,559 @@ def screenshot_from_m3u8_fast(playback_url: str) -> bytes | None:
 
 
 
-# ========== KICK ==========
+# ========== HEDGED REQUESTS ==========
+# A duplicate request is sent when the first one is slower than the recent latency percentile;
+# whichever answers first wins, the loser's response is closed when it arrives.
+HEDGE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hedge")
+HEDGE_LOCK = threading.Lock()
+_HEDGE_LATENCY = {}  # name -> deque of recent successful request latencies (sec)
+_HEDGE_STATS = {}  # name -> {"requests", "hedged", "hedge_won"}
 
-def kick_fetch() -> dict:
-    r = http_request_ext("GET", KICK_API_URL, headers=HEADERS_JSON, timeout=25)
-    data = r.json()
-    ls = data.get("livestream") or {}
 
-    is_live = bool(ls.get("is_live"))
-    title = ls.get("session_title") or ls.get("stream_title") or None
-    viewers = ls.get("viewer_count") or ls.get("viewers") or None
+def _hedge_threshold(name: str) -> float | None:
+    with HEDGE_LOCK:
+        samples = sorted(_HEDGE_LATENCY.get(name) or ())
+    if len(samples) < KICK_HEDGE_MIN_SAMPLES:
+        return None
+    idx = min(len(samples) - 1, int(len(samples) * KICK_HEDGE_PERCENTILE / 100.0))
+    return max(KICK_HEDGE_MIN_SEC, samples[idx])
 
-    cat = None
-    cats = ls.get("categories") or []
-    if isinstance(cats, list) and cats:
-        cat = (cats[0] or {}).get("name") or None
 
-    created_at = ls.get("created_at")
+def _hedge_record(name: str, sec: float | None, hedged: bool = False, won: bool = False) -> None:
+    with HEDGE_LOCK:
+        if sec is not None:
+            _HEDGE_LATENCY.setdefault(name, deque(maxlen=50)).append(sec)
+        st = _HEDGE_STATS.setdefault(name, {"requests": 0, "hedged": 0, "hedge_won": 0})
+        st["requests"] += 1
+        st["hedged"] += int(hedged)
+        st["hedge_won"] += int(won)
 
-    thumb = None
-    th = ls.get("thumbnail") or {}
-    if isinstance(th, dict):
-        thumb = th.get("url") or th.get("src") or None
-    if not thumb:
-        thumb = ls.get("thumbnail_url") or None
+
+def hedge_stats() -> dict:
+    with HEDGE_LOCK:
+        return {name: dict(v) for name, v in _HEDGE_STATS.items()}
+
+
+def _close_hedge_loser(fut) -> None:
+    try:
+        res = fut.result()[0]
+        if res is not None:
+            res.close()
+    except Exception:
+        pass
+
+
+def hedged_call(name: str, fn):
+    """Call fn(); past the latency percentile, race a duplicate call and return the first success."""
+    threshold = _hedge_threshold(name)
+    if threshold is None:
+        res, err, sec = _timed_call(fn)
+        _hedge_record(name, sec if err is None else None)
+        if err is not None:
+            raise err
+        return res
+
+    first = HEDGE_POOL.submit(_timed_call, fn)
+    done, _ = wait([first], timeout=threshold)
+    if done:
+        res, err, sec = first.result()
+        _hedge_record(name, sec if err is None else None)
+        if err is not None:
+            raise err
+        return res
+
+    second = HEDGE_POOL.submit(_timed_call, fn)
+    pending = {first, second}
+    last_err = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            res, err, sec = fut.result()
+            if err is None:
+                _hedge_record(name, sec, hedged=True, won=fut is second)
+                for other in pending:
+                    other.add_done_callback(_close_hedge_loser)
+                return res
+            last_err = err
+    _hedge_record(name, None, hedged=True)
+    raise last_err
+
+
+# ========== CONDITIONAL FETCH ==========
+# Per-URL validators and the last parsed snapshot. Snapshots are frozen, so reusing one is safe.
+FETCH_CACHE_LOCK = threading.Lock()
+_FETCH_CACHE = {}  # name -> (etag, last_modified, body_hash, PlatformSnapshot)
+_FETCH_COUNTERS = {}  # name -> {"fetches", "not_modified", "same_body", "parsed"}
+
+
+def _fetch_count(name: str, key: str) -> None:
+    with FETCH_CACHE_LOCK:
+        c = _FETCH_COUNTERS.setdefault(name, {"fetches": 0, "not_modified": 0, "same_body": 0, "parsed": 0})
+        c["fetches"] += 1
+        c[key] += 1
+
+
+def fetch_cache_stats() -> dict:
+    with FETCH_CACHE_LOCK:
+        return {name: dict(c) for name, c in _FETCH_COUNTERS.items()}
+
+
+def _feed_chunk(buf: bytearray, chunk: bytes, scan, max_bytes: int, name: str) -> bool:
+    """Append a body chunk; True once nothing more needs reading (scan.feed() is done or max_bytes)."""
+    buf += chunk
+    if len(buf) >= max_bytes:
+        del buf[max_bytes:]
+        if not scan.feed(buf):
+            log_line(f"[fetch] {name}: response cut at {fmt_bytes(max_bytes)}")
+        return True
+    return scan.feed(buf)
+
+
+def read_streamed(r: requests.Response, scan, max_bytes: int, name: str, deadline: Deadline | None = None) -> bytearray:
+    """Read a stream=True body chunk by chunk until scan.feed() has what it needs, EOF or max_bytes."""
+    buf = bytearray()
+    for chunk in r.iter_content(chunk_size=max(1024, int(FETCH_CHUNK_BYTES))):
+        if deadline is not None:
+            deadline.check(f"{name} body")
+        if chunk and _feed_chunk(buf, chunk, scan, max_bytes, name):
+            break
+    return buf
+
+
+def fetch_conditional(name: str, url: str, headers: dict, scan, max_bytes: int, deadline: Deadline | None = None, hedge: bool = False, **kwargs) -> PlatformSnapshot:
+    """GET url with If-None-Match / If-Modified-Since; reuse the previous parse on 304 or an identical body.
+
+    scan is a streaming extractor (feed(buf) -> done, result(buf) -> PlatformSnapshot). The body is read
+    only until feed() reports done, so "identical" means identical up to that point.
+    """
+    cached, req_headers = _conditional_headers(name, headers)
+
+    def request():
+        return http_request_ext("GET", url, headers=req_headers, stream=True, deadline=deadline, **kwargs)
+
+    r = hedged_call(name, request) if hedge else request()
+    try:
+        if r.status_code == 304 and cached is not None:
+            _fetch_count(name, "not_modified")
+            return cached[3]
+        buf = read_streamed(r, scan, max_bytes, name, deadline)
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+    finally:
+        r.close()
+    return _conditional_settle(name, cached, buf, etag, last_modified, scan)
+
+
+def _conditional_headers(name: str, headers: dict) -> tuple:
+    """(cached entry or None, request headers with the validators of the cached entry)."""
+    cached = None
+    req_headers = dict(headers)
+    if FETCH_CONDITIONAL_ENABLED:
+        with FETCH_CACHE_LOCK:
+            cached = _FETCH_CACHE.get(name)
+        if cached is not None:
+            if cached[0]:
+                req_headers["If-None-Match"] = cached[0]
+            if cached[1]:
+                req_headers["If-Modified-Since"] = cached[1]
+    return cached, req_headers
+
+
+def _conditional_settle(name: str, cached, buf: bytearray, etag, last_modified, scan) -> PlatformSnapshot:
+    """Parse a 200 body (or reuse the cached parse of an identical one) and remember the validators."""
+    if not FETCH_CONDITIONAL_ENABLED:
+        return scan.result(buf)
+
+    body_hash = hashlib.blake2b(buf, digest_size=16).digest()
+    if cached is not None and cached[2] == body_hash:
+        snap = cached[3]
+        _fetch_count(name, "same_body")
+    else:
+        snap = scan.result(buf)
+        _fetch_count(name, "parsed")
+
+    with FETCH_CACHE_LOCK:
+        _FETCH_CACHE[name] = (etag, last_modified, body_hash, snap)
+    return snap
+
+
+# ========== KICK ==========
+
+_KICK_MEMBERS = {b"livestream": "livestream", b"streamer_channel": "streamer_channel"}
+KICK_MEMBER_MAX_BYTES = 64 * 1024  # a bigger member is still decoded, but logged and counted (payload drift)
+_JSON_STRUCT = re.compile(rb'["{}\[\]]')
+_JSON_STRING_REST = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"', re.S)  # unrolled: linear, no backtracking blowup
+_JSON_NONSPACE = re.compile(rb"\S")
+_JSON_LITERAL = re.compile(rb"[^,}\]\s]+")
+_JSON_FLAT = re.compile(rb'[\[{][^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*[\]}]', re.S)  # no nested containers
+_KICK_SCAN_LOCK = threading.Lock()
+_KICK_SCAN_COUNTERS = {"large_members": 0}
+_KICK_LARGE_LOGGED = set()  # member names already logged as large
+
+
+def kick_scan_stats() -> dict:
+    with _KICK_SCAN_LOCK:
+        return dict(_KICK_SCAN_COUNTERS)
+
+
+class _KickScan:
+    """Decodes only the top-level members kick_parse() needs, as soon as each is complete in the buffer.
+
+    A small tokenizer walks the structural bytes (strings are skipped whole) and tracks the nesting
+    depth, so a "livestream" key nested deeper never matches. Each member is decoded once, from its
+    exact byte span; the scan resumes where the previous chunk ended.
+    """
+
+    __slots__ = ("members", "_pos", "_depth", "_value", "_closed")
+
+    def __init__(self):
+        self.members = {}
+        self._pos = 0
+        self._depth = 0
+        self._value = None  # (name, start) of a wanted object/array member not complete yet
+        self._closed = False  # the top-level object ended: absent members stay absent
+
+    def feed(self, buf: bytearray) -> bool:
+        pos, depth = self._pos, self._depth
+        while not self._closed and len(self.members) < len(_KICK_MEMBERS):
+            m = _JSON_STRUCT.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            if buf[m.start()] == 0x22:  # a string: a key if a colon follows at depth 1
+                end = _JSON_STRING_REST.match(buf, m.end())
+                if end is None:
+                    pos = m.start()  # the string goes on in the next chunk
+                    break
+                pos = end.end()
+                if depth != 1 or self._value is not None:
+                    continue
+                name = _KICK_MEMBERS.get(bytes(buf[m.end() : end.end() - 1]))
+                colon = _JSON_NONSPACE.search(buf, pos)
+                vstart = _JSON_NONSPACE.search(buf, colon.end()) if colon is not None and buf[colon.start()] == 0x3A else None
+                if colon is None or (buf[colon.start()] == 0x3A and vstart is None):
+                    pos = m.start()  # the colon or the value is not here yet
+                    break
+                if name is None or vstart is None or name in self.members:
+                    continue
+                first = buf[vstart.start()]
+                if first in b"{[":
+                    self._value = (name, vstart.start())
+                    pos = vstart.start()
+                elif first == 0x22:
+                    vend = _JSON_STRING_REST.match(buf, vstart.end())
+                    if vend is None:
+                        pos = m.start()
+                        break
+                    self._decode(name, buf, vstart.start(), vend.end())
+                    pos = vend.end()
+                else:
+                    lit = _JSON_LITERAL.match(buf, vstart.start())
+                    if lit.end() >= len(buf):
+                        pos = m.start()  # null/true/number may go on in the next chunk
+                        break
+                    self._decode(name, buf, vstart.start(), lit.end())
+                    pos = lit.end()
+                continue
+            pos = m.end()
+            if buf[m.start()] in b"{[":
+                flat = _JSON_FLAT.match(buf, m.start()) if depth >= 1 else None
+                if flat is None:
+                    depth += 1
+                    continue
+                pos = flat.end()  # skipped in one regex match: most of the document is flat containers
+                if depth == 1 and self._value is not None:
+                    self._decode(self._value[0], buf, self._value[1], pos)
+                    self._value = None
+                continue
+            depth -= 1
+            if depth == 1 and self._value is not None:
+                self._decode(self._value[0], buf, self._value[1], pos)
+                self._value = None
+            elif depth <= 0:
+                self._closed = True
+        self._pos, self._depth = pos, depth
+        return self._closed or len(self.members) == len(_KICK_MEMBERS)
+
+    def _decode(self, name: str, buf: bytearray, start: int, end: int) -> None:
+        if end - start > KICK_MEMBER_MAX_BYTES:
+            with _KICK_SCAN_LOCK:
+                _KICK_SCAN_COUNTERS["large_members"] += 1
+                first = name not in _KICK_LARGE_LOGGED
+                _KICK_LARGE_LOGGED.add(name)
+            if first:
+                log_line(f"[kick] top-level {name!r} is {fmt_bytes(end - start)} (> {fmt_bytes(KICK_MEMBER_MAX_BYTES)}); decoded anyway")
+        try:
+            self.members[name] = json.loads(bytes(buf[start:end]))
+        except ValueError as e:
+            log_line(f"[kick] top-level {name!r} is not valid JSON: {e}")
+
+    def result(self, buf: bytearray) -> PlatformSnapshot:
+        self.feed(buf)
+        return kick_parse(self.members)
+
+
+def fetch_key(ch, platform: str) -> str:
+    """Name for per-channel fetch caches and counters: "kick"/"vk" for the main channel, "kick@<id>" otherwise."""
+    return platform if ch is None or ch.is_main else f"{platform}@{ch.id}"
+
+
+def _kick_request(ch) -> dict:
+    """fetch_conditional() arguments for the channel's Kick API call (both runtimes)."""
+    return dict(
+        name=fetch_key(ch, "kick"),
+        url=ch.kick_api_url,
+        headers=HEADERS_JSON,
+        scan=_KickScan(),
+        max_bytes=KICK_MAX_BYTES,
+        hedge=KICK_HEDGE_ENABLED,
+        timeout=25,
+    )
+
+
+def kick_fetch(deadline: Deadline | None = None, ch=None) -> PlatformSnapshot:
+    return fetch_conditional(**_kick_request(ch or MAIN_CHANNEL), deadline=deadline)
+
+
+def kick_parse(data: dict) -> PlatformSnapshot:
+    ls = data.get("livestream") or {}
+
+    is_live = bool(ls.get("is_live"))
+    title = ls.get("session_title") or ls.get("stream_title") or None
+    viewers = ls.get("viewer_count") or ls.get("viewers") or None
+
+    cat = None
+    cats = ls.get("categories") or []
+    if isinstance(cats, list) and cats:
+        cat = (cats[0] or {}).get("name") or None
+
+    created_at = ls.get("created_at")
+
+    thumb = None
+    th = ls.get("thumbnail") or {}
+    if isinstance(th, dict):
+        thumb = th.get("url") or th.get("src") or None
+    if not thumb:
+        thumb = ls.get("thumbnail_url") or None
 
     playback_url = None
     sc = data.get("streamer_channel") or {}
     if isinstance(sc, dict):
         playback_url = sc.get("playback_url") or None
 
-    return {
-        "live": is_live,
-        "title": trim(title, MAX_TITLE_LEN),
-        "category": trim(cat, MAX_GAME_LEN),
-        "viewers": viewers,
-        "thumb": thumb,
-        "created_at": created_at,
-        "playback_url": playback_url,
-    }
+    return PlatformSnapshot(
+        live=is_live,
+        title=trim(title, MAX_TITLE_LEN),
+        category=trim(cat, MAX_GAME_LEN),
+        viewers=viewers,
+        thumb=thumb,
+        created_at=created_at,
+        playback_url=playback_url,
+    )
 
 
 # ========== VK (best-effort HTML parse) ==========
 
-def _find_container_with_streaminfo(obj):
+# Key path (dict keys / list indices) to the streamInfo container, learned on the first full walk.
+_VK_STREAMINFO_PATH = None
+_VK_LAYOUT_RELEARNS = 0  # full walks after the remembered path stopped matching (VK changed markup)
+
+
+def _is_streaminfo_container(obj) -> bool:
+    return isinstance(obj, dict) and isinstance(obj.get("streamInfo"), dict)
+
+
+def _find_container_with_streaminfo(obj, path=()):
+    """Depth-first search; returns (container, path) or (None, None)."""
     if isinstance(obj, dict):
-        if "streamInfo" in obj and isinstance(obj.get("streamInfo"), dict):
-            return obj
-        for v in obj.values():
-            found = _find_container_with_streaminfo(v)
+        if _is_streaminfo_container(obj):
+            return obj, path
+        for k, v in obj.items():
+            found, found_path = _find_container_with_streaminfo(v, path + (k,))
             if found:
-                return found
+                return found, found_path
     elif isinstance(obj, list):
-        for v in obj:
-            found = _find_container_with_streaminfo(v)
+        for i, v in enumerate(obj):
+            found, found_path = _find_container_with_streaminfo(v, path + (i,))
             if found:
-                return found
-    return None
+                return found, found_path
+    return None, None
 
 
-def vk_fetch_best_effort() -> dict:
-    r = http_request_ext("GET", VK_PUBLIC_URL, headers=HEADERS_HTML, timeout=25, allow_redirects=True)
-    html = r.text
+def _follow_path(obj, path):
+    for p in path:
+        if isinstance(obj, dict):
+            obj = obj.get(p)
+        elif isinstance(obj, list) and isinstance(p, int) and 0 <= p < len(obj):
+            obj = obj[p]
+        else:
+            return None
+    return obj
+
+
+def vk_locate_streaminfo(data):
+    """Try the remembered path first (O(depth)); walk the whole tree and re-learn it only if that misses."""
+    global _VK_STREAMINFO_PATH, _VK_LAYOUT_RELEARNS
+    path = _VK_STREAMINFO_PATH
+    if path is not None:
+        container = _follow_path(data, path)
+        if _is_streaminfo_container(container):
+            return container
+
+    container, found_path = _find_container_with_streaminfo(data)
+    if found_path is not None and found_path != path:
+        if path is not None:
+            _VK_LAYOUT_RELEARNS += 1
+            log_line(f"[vk] streamInfo moved: {'/'.join(map(str, path))} -> {'/'.join(map(str, found_path))}")
+        _VK_STREAMINFO_PATH = found_path
+    return container
+
+
+_VK_NEXT_DATA_RE = re.compile(rb'<script[^>]+id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL | re.IGNORECASE)
+_VK_OG_IMAGE_RE = re.compile(rb'property="og:image"[^>]+content="([^"]+)"', re.IGNORECASE)
+_VK_OG_TITLE_RE = re.compile(rb'property="og:title"[^>]+content="([^"]+)"', re.IGNORECASE)
+
+
+class _VkScan:
+    """Done once the __NEXT_DATA__ script is closed (og tags live in <head>, before it)."""
+
+    __slots__ = ("_start", "_from")
+
+    def __init__(self):
+        self._start = -1
+        self._from = 0
+
+    def feed(self, buf: bytearray) -> bool:
+        if self._start < 0:
+            self._start = buf.find(b'id="__NEXT_DATA__"', self._from)
+            if self._start < 0:
+                self._from = max(0, len(buf) - 24)
+                return False
+            self._from = self._start
+        end = buf.find(b"</script>", self._from)
+        if end < 0:
+            self._from = max(self._start, len(buf) - 16)
+            return False
+        return True
+
+    def result(self, buf: bytearray) -> PlatformSnapshot:
+        return vk_parse_html(buf)
+
+
+class _VkApiScan:
+    """The JSON answer is small: read it whole, then parse."""
+
+    __slots__ = ()
+
+    def feed(self, buf: bytearray) -> bool:
+        return False
+
+    def result(self, buf: bytearray) -> PlatformSnapshot:
+        return vk_parse_api(buf)
+
+
+def vk_parse_api(body: bytes) -> PlatformSnapshot:
+    """Parse the public_video_stream JSON. Raises ValueError if it doesn't look like one (API drift)."""
+    data = json.loads(bytes(body))
+    if isinstance(data, dict) and isinstance(data.get("data"), dict):
+        data = data["data"]
+    if not isinstance(data, dict) or not ({"isOnline", "title", "count"} & data.keys()):
+        raise ValueError(f"unexpected VK API answer: {sorted(data)[:10] if isinstance(data, dict) else type(data).__name__}")
+
+    cnt = data.get("count") or {}
+    viewers = cnt.get("viewers") if isinstance(cnt, dict) else None
+    catobj = data.get("category") or {}
+    category = catobj.get("title") if isinstance(catobj, dict) else None
+    live = bool(data.get("isOnline"))
+    if isinstance(viewers, int) and viewers > 0:
+        live = True
+
+    return PlatformSnapshot(
+        live=live,
+        title=trim(data.get("title"), MAX_TITLE_LEN),
+        category=trim(category, MAX_GAME_LEN),
+        viewers=viewers,
+        thumb=data.get("previewUrl") or None,
+    )
+
+
+_VK_PATH_LOCK = threading.Lock()
+_VK_PATH_COUNTERS = {"json": 0, "html": 0}
+_VK_JSON_FAILING = False  # log the JSON path failing once, not every tick
+_VK_JSON_SKIP_UNTIL = {}  # channel id -> monotonic time until which the JSON path is not tried
+
+
+def vk_path_stats() -> dict:
+    with _VK_PATH_LOCK:
+        return dict(_VK_PATH_COUNTERS)
+
+
+def _vk_path_count(path: str) -> None:
+    with _VK_PATH_LOCK:
+        _VK_PATH_COUNTERS[path] += 1
+
+
+def _vk_json_due(ch) -> bool:
+    return VK_JSON_ENABLED and time.monotonic() >= _VK_JSON_SKIP_UNTIL.get(ch.id, 0.0)
+
+
+def _vk_api_request(ch) -> dict:
+    # A single short attempt: the HTML fallback needs what is left of the fetch budget.
+    return dict(
+        name=fetch_key(ch, "vk_api"),
+        url=ch.vk_api_url,
+        headers=HEADERS_JSON,
+        scan=_VkApiScan(),
+        max_bytes=VK_API_MAX_BYTES,
+        timeout=(min(5.0, VK_API_TIMEOUT_SEC), VK_API_TIMEOUT_SEC),
+        retries=1,
+    )
+
+
+def _vk_html_request(ch) -> dict:
+    if VK_JSON_ENABLED:
+        _vk_path_count("html")
+    return dict(
+        name=fetch_key(ch, "vk"),
+        url=ch.vk_public_url,
+        headers=HEADERS_HTML,
+        scan=_VkScan(),
+        max_bytes=VK_MAX_BYTES,
+        timeout=25,
+        allow_redirects=True,
+    )
+
+
+def _vk_json_result(ch, err: Exception | None) -> None:
+    """Log the JSON path coming back or failing (once), and start its cool-down on failure."""
+    global _VK_JSON_FAILING
+    if err is None:
+        _vk_path_count("json")
+        if _VK_JSON_FAILING:
+            _VK_JSON_FAILING = False
+            log_line("[vk] JSON endpoint is back")
+        return
+    _VK_JSON_SKIP_UNTIL[ch.id] = time.monotonic() + VK_JSON_COOLDOWN_SEC
+    if not _VK_JSON_FAILING:
+        _VK_JSON_FAILING = True
+        log_line(f"[vk] JSON endpoint failed, using the HTML page for {VK_JSON_COOLDOWN_SEC}s: {err}")
+
+
+def vk_fetch_best_effort(deadline: Deadline | None = None, ch=None) -> PlatformSnapshot:
+    ch = ch or MAIN_CHANNEL
+    if _vk_json_due(ch):
+        try:
+            snap = fetch_conditional(**_vk_api_request(ch), deadline=deadline)
+            _vk_json_result(ch, None)
+            return snap
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            _vk_json_result(ch, e)
+    return fetch_conditional(**_vk_html_request(ch), deadline=deadline)
+
+
+def vk_parse_html(html: bytes) -> PlatformSnapshot:
 
     title = None
     category = None
@@ -1327,11 +3864,11 @@ def vk_fetch_best_effort() -> dict:
     live = False
 
     # Parse __NEXT_DATA__ for live info (best-effort)
-    m = re.search(r'<script[^>]+id="__NEXT_DATA__"[^>]*>(.*?)</script>', html, re.DOTALL | re.IGNORECASE)
+    m = _VK_NEXT_DATA_RE.search(html)
     if m:
         try:
             data = json.loads(m.group(1))
-            container = _find_container_with_streaminfo(data)
+            container = vk_locate_streaminfo(data)
             if container:
                 ch = container.get("channelInfo") or {}
                 si = container.get("streamInfo") or {}
@@ -1353,26 +3890,443 @@ def vk_fetch_best_effort() -> dict:
             pass
 
     # Fallback: og tags
-    m_img = re.search(r'property="og:image"[^>]+content="([^"]+)"', html, re.IGNORECASE)
+    m_img = _VK_OG_IMAGE_RE.search(html)
     if m_img:
-        thumb = m_img.group(1).strip()
-    m_title = re.search(r'property="og:title"[^>]+content="([^"]+)"', html, re.IGNORECASE)
+        thumb = m_img.group(1).decode("utf-8", "replace").strip()
+    m_title = _VK_OG_TITLE_RE.search(html)
     if m_title and not title:
-        title = m_title.group(1).strip()
+        title = m_title.group(1).decode("utf-8", "replace").strip()
+
+    return PlatformSnapshot(
+        live=bool(live),
+        title=trim(title, MAX_TITLE_LEN),
+        category=trim(category, MAX_GAME_LEN),
+        viewers=viewers,
+        thumb=thumb,
+    )
 
-    return {
-        "live": bool(live),
-        "title": trim(title, MAX_TITLE_LEN),
-        "category": trim(category, MAX_GAME_LEN),
-        "viewers": viewers,
-        "thumb": thumb,
-    }
+
+# ========== PARALLEL FETCH ==========
+
+_FETCH_TIMING_N = 0
+
+
+def _timed_call(fn):
+    t0 = time.monotonic()
+    try:
+        return fn(), None, time.monotonic() - t0
+    except Exception as e:
+        return None, e, time.monotonic() - t0
+
+
+def _log_fetch_timing(where: str, kick_sec: float, vk_sec: float, total_sec: float) -> None:
+    global _FETCH_TIMING_N
+    _FETCH_TIMING_N += 1
+    if total_sec < FETCH_SLOW_LOG_SEC and (FETCH_TIMING_LOG_EVERY <= 0 or _FETCH_TIMING_N % FETCH_TIMING_LOG_EVERY):
+        return
+    log_line(
+        f"[fetch] {where}: kick={kick_sec:.2f}s vk={vk_sec:.2f}s total={total_sec:.2f}s "
+        f"(sequential would be {kick_sec + vk_sec:.2f}s)"
+    )
+
+
+_LAST_FETCHED = {}  # fetch_key -> what the platform's last fetch gave the tick (offline after an error)
+
+
+def _skipped_fetch(key: str):
+    return _LAST_FETCHED.get(key) or PlatformSnapshot(), None, 0.0
+
+
+def fetch_platforms(where: str = "tick", platforms=("kick", "vk"), deadline: Deadline | None = None, ch=None) -> tuple[PlatformSnapshot, PlatformSnapshot]:
+    """Fetch Kick and VK concurrently. A failed platform comes back as an empty (offline) snapshot.
+
+    A platform not listed in platforms is not fetched; the result of its last fetch is returned instead.
+    Both fetches share one budget: FETCH_DEADLINE_SEC, within deadline if given.
+    """
+    ch = ch or MAIN_CHANNEL
+    t0 = time.monotonic()
+    fd = deadline.child(FETCH_DEADLINE_SEC) if deadline is not None else Deadline(FETCH_DEADLINE_SEC)
+    fk = FETCH_POOL.submit(_timed_call, lambda: kick_fetch(fd, ch)) if "kick" in platforms else None
+    fv = FETCH_POOL.submit(_timed_call, lambda: vk_fetch_best_effort(fd, ch)) if "vk" in platforms else None
+    return _fetch_settle(where, ch, t0, fk.result() if fk is not None else None, fv.result() if fv is not None else None)
+
+
+def _fetch_settle(where: str, ch, t0: float, kick_res, vk_res) -> tuple[PlatformSnapshot, PlatformSnapshot]:
+    """The common end of a fetch: errors -> offline snapshots, logging, last-fetched and push overlay.
+    kick_res / vk_res are _timed_call() results, None for a platform that was not fetched."""
+    kick_key, vk_key = fetch_key(ch, "kick"), fetch_key(ch, "vk")
+    kick, kick_err, kick_sec = kick_res if kick_res is not None else _skipped_fetch(kick_key)
+    vk, vk_err, vk_sec = vk_res if vk_res is not None else _skipped_fetch(vk_key)
+    total = time.monotonic() - t0
+
+    label = {"init": " init fetch", "tick": " fetch", "command": " fetch (command)"}.get(where, f" fetch ({where})")
+    if not ch.is_main:
+        label += f" [{ch.id}]"
+    # Open breakers are logged on state change, not on every fast-failed fetch.
+    if kick_err is not None:
+        kick = PlatformSnapshot()
+        if not isinstance(kick_err, CircuitOpenError):
+            log_line(f"Kick{label} error: {kick_err}")
+    if vk_err is not None:
+        vk = PlatformSnapshot()
+        if not isinstance(vk_err, CircuitOpenError):
+            log_line(f"VK{label} error: {vk_err}")
+    # A skipped platform must repeat what this tick used, not an older success: a failed fetch
+    # counted as offline here, and reusing a stale live snapshot next tick would flip any_live back.
+    if kick_res is not None:
+        _LAST_FETCHED[kick_key] = kick
+    if vk_res is not None:
+        _LAST_FETCHED[vk_key] = vk
+    _log_fetch_timing(where if ch.is_main else f"{where} [{ch.id}]", kick_sec, vk_sec, total)
+    if KICK_PUSH_ENABLED:
+        kick = kick_push_overlay(kick_key, kick)
+    return kick, vk
+
+
+# ========== POLL SCHEDULER ==========
+# Each (channel, platform) has its own next-due time. Cadence: POLL_LIVE_SEC while the stream is on,
+# POLL_HOT_SEC in hours of the week when streams have started before, POLL_IDLE_SEC after a long
+# offline stretch, POLL_INTERVAL otherwise. Channels start at staggered offsets across POLL_INTERVAL,
+# and the main loop sleeps until the earliest entry is due. Keys are fetch_key() names.
+_POLL_NEXT_DUE = {}
+_POLL_LAST_LIVE = {}  # unknown at boot: treated as "recently live"
+_POLL_CADENCE = {}
+_POLL_BOOT_TS = time.time()
+
+
+def _hour_of_week(ts_int: int) -> int:
+    dt = datetime.fromtimestamp(int(ts_int), tz=timezone.utc).astimezone(MSK_TZ)
+    return dt.weekday() * 24 + dt.hour
+
+
+def start_hist_add(st: dict, started_ts: int) -> None:
+    hist = list(st.get("start_hist") or [0] * 168)  # copy: committed state is shared
+    hist[_hour_of_week(started_ts)] += 1
+    st["start_hist"] = hist
+
+
+def start_hist_seed(st: dict, ch=None) -> bool:
+    """Fill start_hist from the SQLite archive once (first run with this field). Returns True if seeded."""
+    if st.get("start_hist") is not None:
+        return False
+    hist = [0] * 168
+    if HISTORY_ENABLED:
+        try:
+            with HISTORY_LOCK:
+                rows = _history_db().execute(
+                    "SELECT start_ts FROM sessions WHERE channel = ?", ((ch or MAIN_CHANNEL).id,)
+                ).fetchall()
+            for r in rows:
+                hist[_hour_of_week(r[0])] += 1
+        except Exception as e:
+            log_line(f"start_hist seed from history failed: {e}")
+    st["start_hist"] = hist
+    return True
+
+
+def _is_hot_hour(hist, now_ts: float) -> bool:
+    if not hist:
+        return False
+    h = _hour_of_week(int(now_ts))
+    return (hist[(h - 1) % 168] + hist[h] + hist[(h + 1) % 168]) >= POLL_HOT_MIN_STARTS
+
+
+def _poll_cadence(key: str, snap, stream_on: bool, hist, now_ts: float) -> tuple[str, int]:
+    if not POLL_SCHED_ENABLED:
+        return "steady", POLL_INTERVAL
+    if snap.get("live"):
+        return "live", POLL_LIVE_SEC
+    if stream_on:
+        return "steady", POLL_INTERVAL
+    if key in _PUSH_CONNECTED:
+        return "push", KICK_PUSH_RECONCILE_SEC
+    if _is_hot_hour(hist, now_ts):
+        return "hot", POLL_HOT_SEC
+    if now_ts - _POLL_LAST_LIVE.get(key, _POLL_BOOT_TS) >= POLL_IDLE_AFTER_SEC:
+        return "idle", POLL_IDLE_SEC
+    return "steady", POLL_INTERVAL
+
+
+def poll_stagger(channels) -> None:
+    """Shift the channels' next polls by i/n of POLL_INTERVAL so they don't all fire in the same second."""
+    now_ts = time.time()
+    n = max(1, len(channels))
+    for i, ch in enumerate(channels):
+        for platform in ("kick", "vk"):
+            key = fetch_key(ch, platform)
+            _POLL_NEXT_DUE[key] = _POLL_NEXT_DUE.get(key, now_ts) + POLL_INTERVAL * i / n
+
+
+def poll_due_platforms(ch=None, now_ts: float | None = None) -> tuple:
+    now_ts = time.time() if now_ts is None else now_ts
+    return tuple(p for p in ("kick", "vk") if _POLL_NEXT_DUE.get(fetch_key(ch, p), 0.0) <= now_ts)
+
+
+def poll_schedule(polled, kick, vk, stream_on: bool, now_ts: float | None = None, ch=None) -> None:
+    """Set the next due time of every platform polled this tick."""
+    now_ts = time.time() if now_ts is None else now_ts
+    hist = channel_view(ch or MAIN_CHANNEL).get("start_hist")
+    for name, snap in (("kick", kick), ("vk", vk)):
+        key = fetch_key(ch, name)
+        if snap.get("live"):
+            _POLL_LAST_LIVE[key] = now_ts
+        if name not in polled:
+            continue
+        cadence, sec = _poll_cadence(key, snap, stream_on, hist, now_ts)
+        prev = _POLL_CADENCE.get(key, "steady")
+        if cadence != prev:
+            log_line(f"[sched] {key}: {prev} -> {cadence} ({sec}s)")
+        _POLL_CADENCE[key] = cadence
+        _POLL_NEXT_DUE[key] = now_ts + max(1, int(sec))
+
+
+_PROBES_LEFT = {}  # fetch key -> short-interval confirmation probes still to run
+_OFFLINE_SINCE = {}  # channel id -> wall ts of the first offline poll of an unconfirmed END
+_END_FRESH = {}  # channel id -> platforms re-fetched while offline since the last end_streak step
+
+
+def poll_transition(ch, polled, prev_any: bool, any_live: bool, kick, vk, end_pending: bool, now_ts: float | None = None) -> None:
+    """After poll_schedule(): pull the next poll of the platforms that decide a live/offline flip forward.
+
+    A START seen on one platform probes the other; an offline flip probes both until END is confirmed.
+    """
+    if CONFIRM_PROBE_SEC <= 0:
+        return
+    now_ts = time.time() if now_ts is None else now_ts
+    if prev_any != any_live:
+        if any_live:
+            targets = [p for p, snap in (("kick", kick), ("vk", vk)) if not snap.get("live")]
+        else:
+            targets = ["kick", "vk"] if end_pending else []
+        for p in ("kick", "vk"):
+            _PROBES_LEFT[fetch_key(ch, p)] = max(1, CONFIRM_PROBES) if p in targets else 0
+    elif not any_live and not end_pending:
+        for p in ("kick", "vk"):
+            _PROBES_LEFT.pop(fetch_key(ch, p), None)  # END is out (or there was no session)
+    for p in polled:
+        key = fetch_key(ch, p)
+        left = _PROBES_LEFT.get(key, 0)
+        if left <= 0:
+            continue
+        _PROBES_LEFT[key] = left - 1
+        _POLL_NEXT_DUE[key] = min(_POLL_NEXT_DUE.get(key, now_ts), now_ts + CONFIRM_PROBE_SEC)
+
+
+def end_streak_step(ch, polled, any_live: bool, end_streak: int) -> int:
+    """end_streak after this tick. Ticks reuse the snapshot of a platform that is not due, so a step
+    is counted only once both platforms have been re-fetched offline since the previous step."""
+    if any_live:
+        _END_FRESH.pop(ch.id, None)
+        return 0
+    fresh = _END_FRESH.setdefault(ch.id, set())
+    fresh.update(polled)
+    if not fresh.issuperset(("kick", "vk")):
+        return end_streak
+    fresh.clear()
+    return end_streak + 1
+
+
+def end_confirmed(ch, any_live: bool, end_streak: int, now_ts: float | None = None) -> bool:
+    """END_CONFIRM_STREAK consecutive offline polls (end_streak counts this one) spanning END_CONFIRM_MIN_SEC."""
+    now_ts = time.time() if now_ts is None else now_ts
+    if any_live:
+        _OFFLINE_SINCE.pop(ch.id, None)
+        return False
+    since = _OFFLINE_SINCE.setdefault(ch.id, now_ts)
+    return end_streak >= END_CONFIRM_STREAK and now_ts - since >= END_CONFIRM_MIN_SEC
+
+
+def poll_sleep_sec() -> float:
+    if not _POLL_NEXT_DUE:
+        return POLL_INTERVAL
+    return max(1.0, min(_POLL_NEXT_DUE.values()) - time.time())
+
+
+# ========== KICK PUSH ==========
+# One websocket per channel with a kick_channel_id, subscribed to "channel.<id>". Events don't bypass
+# the main loop: they leave a hint for kick_push_overlay() and make the channel's Kick poll due now,
+# so START/CHANGE/END run exactly as for a polled change. HTTP polling stays as reconciliation and
+# returns to its normal cadence whenever the socket is down.
+KICK_PUSH_EVENTS = {
+    "App\\Events\\StreamerIsLive": "start",
+    "App\\Events\\StopStreamBroadcast": "stop",
+    "App\\Events\\LivestreamUpdated": "update",
+}
+_PUSH_CONTROL = {
+    "pusher:ping": "ping",
+    "pusher:error": "error",
+    "pusher_internal:subscription_succeeded": "subscribed",
+}
+POLL_WAKE = threading.Event()  # set to cut the main loop's sleep short
+_PUSH_LOCK = threading.Lock()
+_PUSH_HINTS = {}  # fetch key -> (kind, title, category, created_at, monotonic ts)
+_PUSH_CONNECTED = set()
+_PUSH_COUNTERS = {"start": 0, "stop": 0, "update": 0}
+
+
+def kick_push_parse(frame) -> tuple[str, dict] | None:
+    """Decode one Pusher frame into (kind, data); None for frames the bot doesn't act on."""
+    try:
+        msg = json.loads(frame)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(msg, dict):
+        return None
+    event = msg.get("event")
+    kind = KICK_PUSH_EVENTS.get(event) or _PUSH_CONTROL.get(event)
+    if kind is None:
+        return None
+    data = msg.get("data")
+    if isinstance(data, str):  # Pusher double-encodes event payloads
+        try:
+            data = json.loads(data)
+        except ValueError:
+            data = None
+    return kind, data if isinstance(data, dict) else {}
+
+
+def _push_hint(kind: str, data: dict) -> tuple:
+    ls = data.get("livestream") if isinstance(data.get("livestream"), dict) else data
+    cat = None
+    cats = ls.get("categories") or []
+    if isinstance(cats, list) and cats:
+        cat = (cats[0] or {}).get("name")
+    elif isinstance(ls.get("category"), dict):
+        cat = ls["category"].get("name")
+    title = ls.get("session_title") or ls.get("title")
+    return kind, trim(title, MAX_TITLE_LEN), trim(cat, MAX_GAME_LEN), ls.get("created_at"), time.monotonic()
+
+
+def kick_push_event(ch, kind: str, data: dict) -> None:
+    """Record a stream event from the websocket and make the channel's Kick poll due now."""
+    key = fetch_key(ch, "kick")
+    with _PUSH_LOCK:
+        _PUSH_HINTS[key] = _push_hint(kind, data)
+        _PUSH_COUNTERS[kind] += 1
+    log_line(f"[push] {key}: {kind}")
+    _POLL_NEXT_DUE[key] = 0.0
+    POLL_WAKE.set()
+
+
+def kick_push_overlay(key: str, snap: PlatformSnapshot) -> PlatformSnapshot:
+    """Apply a recent push event on top of a polled snapshot: the API can lag a start/stop by a minute."""
+    with _PUSH_LOCK:
+        hint = _PUSH_HINTS.get(key)
+        if hint is not None and time.monotonic() - hint[4] > KICK_PUSH_TRUST_SEC:
+            del _PUSH_HINTS[key]
+            hint = None
+    if hint is None:
+        return snap
+    kind, title, cat, created_at, _at = hint
+    if kind == "start" and not snap.live:
+        return replace(
+            snap,
+            live=True,
+            title=title or snap.title,
+            category=cat or snap.category,
+            created_at=created_at or snap.created_at,
+        )
+    if kind == "stop" and snap.live:
+        return replace(snap, live=False, viewers=None)
+    if kind == "update" and snap.live:
+        return replace(snap, title=title or snap.title, category=cat or snap.category)
+    return snap
+
+
+def kick_push_stats() -> dict:
+    with _PUSH_LOCK:
+        out = dict(_PUSH_COUNTERS)
+        out["connected"] = len(_PUSH_CONNECTED)
+    out["channels"] = sum(1 for ch in CHANNELS if ch.kick_channel_id is not None)
+    return out
+
+
+def _kick_ws_connect(url: str, timeout: float):
+    return websocket.create_connection(url, timeout=timeout, header=[f"User-Agent: {UA}"])
+
+
+def kick_push_session(ch, connect=None) -> None:
+    """One websocket session: subscribe and dispatch events until the socket drops (always ends by raising).
+
+    connect(url, timeout) returns an object with send(str), recv() -> str and close().
+    """
+    key = fetch_key(ch, "kick")
+    ws = (connect or _kick_ws_connect)(KICK_PUSH_URL, KICK_PUSH_PING_SEC)
+    try:
+        ws.send(json.dumps({"event": "pusher:subscribe", "data": {"auth": "", "channel": f"channel.{ch.kick_channel_id}"}}))
+        pinged = False
+        while True:
+            try:
+                frame = ws.recv()
+            except _WS_TIMEOUTS:
+                if pinged:
+                    raise TimeoutError("no frames after ping")
+                ws.send(json.dumps({"event": "pusher:ping", "data": {}}))
+                pinged = True
+                continue
+            pinged = False
+            if not frame:
+                raise ConnectionError("websocket closed")
+            parsed = kick_push_parse(frame)
+            if parsed is None:
+                continue
+            kind, data = parsed
+            if kind == "ping":
+                ws.send(json.dumps({"event": "pusher:pong", "data": {}}))
+            elif kind == "error":
+                raise ConnectionError(f"pusher error: {data}")
+            elif kind == "subscribed":
+                with _PUSH_LOCK:
+                    _PUSH_CONNECTED.add(key)
+                log_line(f"[push] {key}: subscribed to channel.{ch.kick_channel_id}")
+            else:
+                kick_push_event(ch, kind, data)
+    finally:
+        with _PUSH_LOCK:
+            was_connected = key in _PUSH_CONNECTED
+            _PUSH_CONNECTED.discard(key)
+        if was_connected:
+            # Poll now: events may have been missed while the socket was going down.
+            _POLL_NEXT_DUE[key] = 0.0
+            POLL_WAKE.set()
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+
+def kick_push_forever(ch, connect=None) -> None:
+    attempt = 0
+    while True:
+        t0 = time.monotonic()
+        try:
+            kick_push_session(ch, connect)
+        except Exception as e:
+            log_line(f"[push] {fetch_key(ch, 'kick')}: disconnected: {e}")
+        if time.monotonic() - t0 >= KICK_PUSH_RECONCILE_SEC:
+            attempt = 0  # the session was healthy for a while; reconnect quickly
+        time.sleep(_backoff_delay(attempt, HTTP_BACKOFF_BASE, max(HTTP_BACKOFF_MAX, 60), True))
+        attempt += 1
+
+
+def start_kick_push() -> None:
+    if not KICK_PUSH_ENABLED:
+        return
+    if websocket is None:
+        log_line("[push] KICK_PUSH_ENABLED=1 but websocket-client is not installed; Kick is polled only")
+        return
+    for ch in CHANNELS:
+        if ch.kick_channel_id is None:
+            log_line(f"[push] {ch.id}: no kick_channel_id; Kick is polled only")
+            continue
+        threading.Thread(target=kick_push_forever, args=(ch,), daemon=True, name=f"kick-push-{ch.id}").start()
 
 
 # ========== MESSAGES ==========
 
-def build_caption(prefix: str, st: dict, kick: dict, vk: dict) -> str:
+def build_caption(prefix: str, st: dict, kick: dict, vk: dict, ch=None) -> str:
     # Telegram parse_mode is HTML.
+    ch = ch or MAIN_CHANNEL
     running = fmt_running_line(st)
 
     lines: list[str] = []
@@ -1408,54 +4362,64 @@ def build_caption(prefix: str, st: dict, kick: dict, vk: dict) -> str:
         lines.append("⚫ OFF")
 
     lines.append("")
-    lines.append(f"🔗 <b>Kick:</b> {KICK_PUBLIC_URL}")
-    lines.append(f"🔗 <b>VK Play:</b> {VK_PUBLIC_URL}")
+    lines.append(f"🔗 <b>Kick:</b> {ch.kick_public_url}")
+    lines.append(f"🔗 <b>VK Play:</b> {ch.vk_public_url}")
 
     return "\n".join(lines)
 
-def build_end_text(st: dict) -> str:
-    return build_end_report(st)
+def build_end_text(st: dict, ch=None) -> str:
+    return build_end_report(st, ch)
 
 
 
-def build_no_stream_text(prefix: str = "⚫ <b>Патока сейчас нет</b>") -> str:
+def build_no_stream_text(prefix: str = "⚫ <b>Патока сейчас нет</b>", ch=None) -> str:
+    ch = ch or MAIN_CHANNEL
     return "\n".join([
         prefix,
         "",
-        f"🔗 <b>Kick:</b> {KICK_PUBLIC_URL}",
-        f"🔗 <b>VK Play:</b> {VK_PUBLIC_URL}",
+        f"🔗 <b>Kick:</b> {ch.kick_public_url}",
+        f"🔗 <b>VK Play:</b> {ch.vk_public_url}",
     ])
 
 def set_started_at_from_kick(st: dict, kick: dict, force: bool = False) -> None:
     # Use Kick created_at to keep stream start time accurate across restarts and between streams.
     sync_kick_session(st, kick, force=force)
 
-def send_status_with_screen_to(prefix: str, st: dict, kick: dict, vk: dict, chat_id: int, thread_id: int | None, reply_to: int | None) -> None:
-    caption = build_caption(prefix, st, kick, vk)
+def send_status_with_screen_to(prefix: str, st: dict, kick: dict, vk: dict, chat_id: int, thread_id: int | None, reply_to: int | None, shot: bytes | None = None, deadline: Deadline | None = None, ch=None, fan: FanOut | None = None, retries: int | None = None) -> str:
+    # shot: screenshot already taken by the caller (b"" = tried and failed), None = take it here.
+    # retries=1: single attempts, for a job whose queue does the retrying.
+    # Returns "photo" or "text": what the main message turned out to be.
+    caption = build_caption(prefix, st, kick, vk, ch)
+    fan = fan or FanOut("status")
+    # The duplicate is text only: queue it now instead of after the screenshot and upload.
+    fan.send([pubg_leg(caption, kick, ch)])
 
     # show user bot is working
     tg_send_chat_action(chat_id, thread_id, "upload_photo")
 
-    # 1) real screenshot from m3u8 (main feature)
-    shot = screenshot_from_m3u8(kick.get("playback_url")) if kick.get("live") else None
+    # 1) real screenshot from m3u8 (main feature). The channel's frame from the last
+    # SHOT_CACHE_MAX_AGE_SEC is reused as is: same bytes, so it goes out by its uploaded file_id.
+    if shot is None and kick.get("live"):
+        cached = _shot_cache_get(ch)
+        if cached:
+            shot = cached[0]
+        else:
+            shot = screenshot_from_m3u8(kick.get("playback_url"), deadline)
+            if shot:
+                _shot_cache_set(shot, ch)
+    kind = "photo"
     if shot:
-        tg_send_photo_upload_to(chat_id, thread_id, shot, caption, filename=f"kick_live_{ts()}.jpg", reply_to=reply_to)
-        maybe_send_to_pubg_topic(caption, st, kick)
-        return
-
+        send_main = lambda: tg_send_photo_upload_to(chat_id, thread_id, shot, caption, filename=f"kick_live_{ts()}.jpg", reply_to=reply_to, retries=retries)
     # 2) fallbacks
-    if kick.get("live") and kick.get("thumb"):
-        tg_send_photo_best_to(chat_id, thread_id, kick["thumb"], caption, reply_to=reply_to)
-        maybe_send_to_pubg_topic(caption, st, kick)
-        return
-
-    if vk.get("live") and vk.get("thumb"):
-        tg_send_photo_best_to(chat_id, thread_id, vk["thumb"], caption, reply_to=reply_to)
-        maybe_send_to_pubg_topic(caption, st, kick)
-        return
-
-    tg_send_to(chat_id, thread_id, caption, reply_to=reply_to)
-    maybe_send_to_pubg_topic(caption, st, kick)
+    elif kick.get("live") and kick.get("thumb"):
+        send_main = lambda: tg_send_photo_best_to(chat_id, thread_id, kick["thumb"], caption, reply_to=reply_to, deadline=deadline, retries=retries)
+    elif vk.get("live") and vk.get("thumb"):
+        send_main = lambda: tg_send_photo_best_to(chat_id, thread_id, vk["thumb"], caption, reply_to=reply_to, deadline=deadline, retries=retries)
+    else:
+        kind = "text"
+        send_main = lambda: tg_send_to(chat_id, thread_id, caption, reply_to=reply_to, retries=retries)
+    fan.send([pubg_leg(caption, kick, ch), FanLeg("main", chat_id, send_main)])
+    return kind
 
 
 
@@ -1464,7 +4428,8 @@ def send_status_with_screen_to(prefix: str, st: dict, kick: dict, vk: dict, chat
 
 def build_change_caption(st: dict, kick: dict, vk: dict,
                          kick_title_changed: bool, kick_cat_changed: bool,
-                         vk_title_changed: bool, vk_cat_changed: bool) -> str:
+                         vk_title_changed: bool, vk_cat_changed: bool, ch=None) -> str:
+    ch = ch or MAIN_CHANNEL
     lines: list[str] = []
     lines.append("🟡 <b>Обновление патока</b>")
     lines.append("")
@@ -1505,68 +4470,180 @@ def build_change_caption(st: dict, kick: dict, vk: dict,
         lines.append(f"👥 Зрители: <b>{fmt_viewers(vk.get('viewers'))}</b>")
         lines.append("")
 
-    lines.append(f"🔗 {KICK_PUBLIC_URL}")
-    lines.append(f"🔗 {VK_PUBLIC_URL}")
+    lines.append(f"🔗 {ch.kick_public_url}")
+    lines.append(f"🔗 {ch.vk_public_url}")
     return "\n".join(lines)
 
 
-def send_caption_with_screen(caption: str, st: dict, kick: dict, vk: dict) -> None:
+def send_caption_with_screen(caption: str, st: dict, kick: dict, vk: dict, deadline: Deadline | None = None, ch=None, fan: FanOut | None = None) -> None:
     # Prefer platform thumbnails; fallback to text.
+    ch = ch or MAIN_CHANNEL
+    fan = fan or FanOut("caption")
+    fan.send([pubg_leg(caption, kick, ch)])
     try:
-        if kick.get("live") and kick.get("thumb"):
-            tg_send_photo_best_to(GROUP_ID, TOPIC_ID, kick.get("thumb"), caption, reply_to=None)
-            maybe_send_to_pubg_topic(caption, st, kick)
-            return
-        if vk.get("live") and vk.get("thumb"):
-            tg_send_photo_best_to(GROUP_ID, TOPIC_ID, vk.get("thumb"), caption, reply_to=None)
-            maybe_send_to_pubg_topic(caption, st, kick)
+        thumb = kick.get("thumb") if kick.get("live") else None
+        thumb = thumb or (vk.get("thumb") if vk.get("live") else None)
+        if thumb:
+            fan.send([FanLeg("main", ch.chat_id, lambda: tg_send_photo_best_to(ch.chat_id, ch.topic_id, thumb, caption, reply_to=None, deadline=deadline))])
             return
     except Exception:
         pass
 
-    tg_send_main_and_maybe_pubg(caption, st, kick)
+    tg_send_main_and_maybe_pubg(caption, st, kick, ch, fan)
 
-def send_status_with_screen_to_cmd(prefix: str, st: dict, kick: dict, vk: dict, chat_id: int, thread_id: int | None, reply_to: int | None) -> None:
-    caption = build_caption(prefix, st, kick, vk)
+def send_status_with_screen(prefix: str, st: dict, kick: dict, vk: dict, deadline: Deadline | None = None, ch=None, fan: FanOut | None = None) -> str:
+    ch = ch or MAIN_CHANNEL
+    return send_status_with_screen_to(prefix, st, kick, vk, ch.chat_id, ch.topic_id, reply_to=None, deadline=deadline, ch=ch, fan=fan)
 
-    shot = None
-    if kick.get("live"):
-        cached = _shot_cache_get()
-        if cached:
-            shot, _age = cached
-        else:
-            shot = screenshot_from_m3u8_fast(kick.get("playback_url"))
-            if shot:
-                _shot_cache_set(shot)
 
-    if shot:
-        tg_send_photo_upload_to_cmd(chat_id, thread_id, shot, caption, filename=f"kick_live_{ts()}.jpg", reply_to=reply_to)
-        maybe_send_to_pubg_topic(caption, st, kick)
-        return
+# ========== LIVE CARD ==========
+# With LIVE_CARD_ENABLED the START alert is the card: its message id goes into the channel's state
+# (live_card), it is pinned, and channel_tick() queues throttled edits instead of CHANGE posts.
+# Edits run on the outbound queue behind the START alert of the same chat, so they never overtake it.
+_LIVE_CARD_LOCK = threading.Lock()
+_LIVE_CARD_EDITS = {}  # channel id -> [last edit monotonic, last media monotonic, edit queued]
+_LIVE_CARD_LATEST = {}  # channel id -> (kick, vk) of the latest tick; a queued edit renders these
+
+
+def live_card_prefix(ch) -> str:
+    return f"🚨🚨 🧩 {ch.name} запустил паток! 🚨🚨"
 
-    if kick.get("live") and kick.get("thumb"):
-        try:
-            img = download_image(kick.get("thumb"))
-            tg_send_photo_upload_to_cmd(chat_id, thread_id, img, caption, filename=f"thumb_{ts()}.jpg", reply_to=reply_to)
-        except Exception:
-            tg_send_photo_url_to_cmd(chat_id, thread_id, kick.get("thumb"), caption, reply_to=reply_to)
-        maybe_send_to_pubg_topic(caption, st, kick)
-        return
 
-    if vk.get("live") and vk.get("thumb"):
+def live_card_of(st) -> dict | None:
+    """The card of the running stream, if there is one."""
+    card = st.get("live_card")
+    if LIVE_CARD_ENABLED and card and st.get("started_at"):
+        return card
+    return None
+
+
+def live_card_start(ch, fan: FanOut, kind: str) -> None:
+    """After the START alert went out: remember it as the card and pin it."""
+    message_id = fan.result("main")
+    if not isinstance(message_id, int):
+        return
+    card = {"chat_id": ch.chat_id, "message_id": message_id, "photo": kind == "photo"}
+    with STATE_LOCK:
+        st = channel_load(ch)
+        old = st.get("live_card")
+        st["live_card"] = card
+        channel_save(ch, st)
+    now = time.monotonic()
+    with _LIVE_CARD_LOCK:
+        _LIVE_CARD_EDITS[ch.id] = [now, now, False]
+    if old and old.get("message_id") != message_id:
         try:
-            img = download_image(vk.get("thumb"))
-            tg_send_photo_upload_to_cmd(chat_id, thread_id, img, caption, filename=f"thumb_{ts()}.jpg", reply_to=reply_to)
+            tg_unpin(old["chat_id"], old["message_id"])  # END of the previous stream was never seen
         except Exception:
-            tg_send_photo_url_to_cmd(chat_id, thread_id, vk.get("thumb"), caption, reply_to=reply_to)
-        maybe_send_to_pubg_topic(caption, st, kick)
+            pass
+    if LIVE_CARD_PIN:
+        try:
+            tg_pin(ch.chat_id, message_id)
+        except Exception as e:
+            log_line(f"[card] pin failed [{ch.id}]: {tg_error_text(e)}")
+
+
+def _live_card_forget(ch, card: dict) -> None:
+    with STATE_LOCK:
+        st = channel_load(ch)
+        if st.get("live_card") == card:
+            st["live_card"] = None
+            channel_save(ch, st)
+
+
+def _live_card_edit(ch, card: dict, media: bool) -> None:
+    """Render the card from the state and snapshots current when the job runs, not when it was queued.
+
+    The media refresh uses the refresher's cached frame of the channel only: no ffmpeg in the sender.
+    """
+    did_media = False
+    try:
+        st = channel_view(ch)
+        if live_card_of(st) != card or not st.get("any_live"):
+            return  # the stream ended or the card was replaced while the edit was queued
+        with _LIVE_CARD_LOCK:
+            kick, vk = _LIVE_CARD_LATEST[ch.id]
+        caption = build_caption(live_card_prefix(ch), st, kick, vk, ch)
+        if media:
+            cached = _shot_cache_get(ch)
+            shot = cached[0] if cached else None
+            if shot:
+                tg_edit_photo(card["chat_id"], card["message_id"], shot, caption)
+                did_media = True
+        if not did_media:
+            if card.get("photo"):
+                tg_edit_caption(card["chat_id"], card["message_id"], caption)
+            else:
+                tg_edit_text(card["chat_id"], card["message_id"], caption)
+    except Exception as e:
+        err = tg_error_text(e)
+        if _is_retryable(e):
+            raise
+        if "not modified" in err:
+            pass
+        else:
+            # Deleted or no longer editable: stop editing; CHANGE posts take over again.
+            log_line(f"[card] edit failed, card dropped [{ch.id}]: {err}")
+            _live_card_forget(ch, card)
+    finally:
+        now = time.monotonic()
+        with _LIVE_CARD_LOCK:
+            rec = _LIVE_CARD_EDITS.setdefault(ch.id, [0.0, now, False])
+            rec[0] = now
+            if did_media:
+                rec[1] = now
+            rec[2] = False
+
+
+def live_card_tick(ch, st, kick, vk, changed: bool) -> None:
+    """Queue an edit of the card if the throttle allows (sooner after a title/category change)."""
+    card = live_card_of(st)
+    if card is None or not st.get("any_live"):
         return
+    now = time.monotonic()
+    with _LIVE_CARD_LOCK:
+        _LIVE_CARD_LATEST[ch.id] = (kick, vk)
+        rec = _LIVE_CARD_EDITS.setdefault(ch.id, [0.0, now, False])
+        if rec[2] or now - rec[0] < (LIVE_CARD_CHANGE_SEC if changed else LIVE_CARD_EDIT_SEC):
+            return
+        media = bool(card.get("photo")) and now - rec[1] >= LIVE_CARD_MEDIA_SEC
+        rec[2] = True
+    outbox_send(
+        card["chat_id"],
+        f"live card [{ch.id}]",
+        PRIO_CHANGE,
+        lambda _dl: _live_card_edit(ch, card, media),
+    )
 
-    tg_send_to_cmd(chat_id, thread_id, caption, reply_to=reply_to)
-    maybe_send_to_pubg_topic(caption, st, kick)
 
-def send_status_with_screen(prefix: str, st: dict, kick: dict, vk: dict) -> None:
-    send_status_with_screen_to(prefix, st, kick, vk, GROUP_ID, TOPIC_ID, reply_to=None)
+def live_card_finish(ch, card: dict, end_text: str, st, kick, fan: FanOut) -> None:
+    """END: the card becomes the end report and is unpinned. If the report doesn't fit the card (photo
+    captions are limited to 1024 chars) or the card is gone, the report is posted as a message."""
+    fan.send([pubg_leg(end_text, kick, ch)])
+    limit = 1024 if card.get("photo") else 4000
+    summary = end_text if len(end_text) <= limit else f"⚫ <b>Паток {esc(ch.name)} завершён</b> — итоги ниже."
+    try:
+        if card.get("photo"):
+            tg_edit_caption(card["chat_id"], card["message_id"], summary)
+        else:
+            tg_edit_text(card["chat_id"], card["message_id"], summary)
+        edited = True
+    except Exception as e:
+        if _is_retryable(e):
+            raise
+        edited = "not modified" in tg_error_text(e)
+        if not edited:
+            log_line(f"[card] final edit failed [{ch.id}]: {tg_error_text(e)}")
+    if LIVE_CARD_PIN:
+        try:
+            tg_unpin(card["chat_id"], card["message_id"])
+        except Exception:
+            pass
+    with _LIVE_CARD_LOCK:
+        _LIVE_CARD_EDITS.pop(ch.id, None)
+        _LIVE_CARD_LATEST.pop(ch.id, None)
+    if not edited or summary is not end_text:
+        tg_send_main_and_maybe_pubg(end_text, st, kick, ch, fan)
 
 
 # ========== ADMIN DIAG ==========
@@ -1588,6 +4665,16 @@ def _yes_no(v: bool) -> str:
     return "ДА" if v else "НЕТ"
 
 
+def _sum_per_platform(stats: dict) -> dict:
+    """Add up per-channel counters ("kick", "kick@ch2", ...) into one row per platform name."""
+    out = {}
+    for name, row in stats.items():
+        acc = out.setdefault(name.split("@")[0], {})
+        for k, v in row.items():
+            acc[k] = acc.get(k, 0) + v
+    return out
+
+
 def build_admin_diag_text(st: dict, webhook_info: dict) -> str:
     now = ts()
 
@@ -1635,20 +4722,130 @@ def build_admin_diag_text(st: dict, webhook_info: dict) -> str:
     if last_rec:
         actions.append("ℹ️ Watchdog уже срабатывал — бот сам пытался починиться.")
 
+    breaker_names = {"closed": "✅ закрыт (норма)", "open": "⛔ ОТКРЫТ (запросы не идут)", "half-open": "⚠️ полуоткрыт (пробный запрос)"}
+    breaker_lines = []
+    for host, b in breaker_states().items():
+        line = f"- Предохранитель {esc(host)}: {breaker_names.get(b['state'], b['state'])}, ошибок за окно: {b['failures']}, срабатываний: {b['opens']}"
+        if b["state"] == "open":
+            line += f", повтор через {b['retry_in']} сек"
+        breaker_lines.append(line)
+    if not breaker_lines:
+        breaker_lines.append("- Предохранители площадок: запросов ещё не было")
+
+    fetch_lines = []
+    vk_names = (("vk_api", "VK (JSON)"), ("vk", "VK (страница)")) if VK_JSON_ENABLED else (("vk", "VK"),)
+    fetch_stats = _sum_per_platform(fetch_cache_stats())
+    for name, label in (("kick", "Kick"),) + vk_names:
+        c = fetch_stats.get(name)
+        if not c or not c["fetches"]:
+            fetch_lines.append(f"- {label}: ещё не опрашивали")
+            continue
+        skipped = c["not_modified"] + c["same_body"]
+        fetch_lines.append(
+            f"- {label}: разбор пропущен {skipped} из {c['fetches']} ({skipped * 100 // c['fetches']}%; "
+            f"304: {c['not_modified']}, тот же ответ: {c['same_body']})"
+        )
+    if VK_JSON_ENABLED:
+        vp = vk_path_stats()
+        fetch_lines.append(f"- VK: быстрый JSON {vp['json']} раз, запасной разбор страницы {vp['html']} раз")
+    fetch_lines.append(f"- VK: разметка страницы менялась {_VK_LAYOUT_RELEARNS} раз (путь к streamInfo переучен)")
+    large = kick_scan_stats()["large_members"]
+    if large:
+        fetch_lines.append(f"- Kick: крупных полей ответа (> {fmt_bytes(KICK_MEMBER_MAX_BYTES)}) разобрано {large}")
+    h = _sum_per_platform(hedge_stats()).get("kick")
+    if h:
+        fetch_lines.append(f"- Kick: дублирующих запросов {h['hedged']} из {h['requests']} (дубль ответил первым: {h['hedge_won']})")
+    if POLL_SCHED_ENABLED:
+        cad_sec = {
+            "live": POLL_LIVE_SEC,
+            "hot": POLL_HOT_SEC,
+            "idle": POLL_IDLE_SEC,
+            "steady": POLL_INTERVAL,
+            "push": KICK_PUSH_RECONCILE_SEC,
+        }
+        fetch_lines.append(
+            "- Частота опроса: "
+            + ", ".join(
+                f"{label} — {_POLL_CADENCE.get(n, 'steady')} ({cad_sec[_POLL_CADENCE.get(n, 'steady')]} сек)"
+                for n, label in (("kick", "Kick"), ("vk", "VK"))
+            )
+        )
+    rq = RETRY_SCHED.stats()
+    tr = tg_rate_stats()
+    ob = OUTBOX.stats()
+    mc = media_cache_stats()
+
+    conn_lines = []
+    for host, row in transport_stats().items():
+        parts = []
+        for kind, label in (("new", "новое соединение"), ("reused", "повторно"), ("h2", "HTTP/2")):
+            if kind in row:
+                n, avg = row[kind]
+                parts.append(f"{label} {n} раз, ответ за {avg:.2f} сек")
+        line = f"- {host}: " + "; ".join(parts)
+        if "new" in row and "reused" in row:
+            line += f" (экономия на рукопожатии ≈ {max(0.0, row['new'][1] - row['reused'][1]):.2f} сек)"
+        conn_lines.append(line)
+    if not conn_lines:
+        conn_lines.append("- запросов ещё не было")
+
+    channel_lines = []
+    for ch in CHANNELS[1:]:
+        cst = channel_view(ch)
+        channel_lines.append(
+            f"- {esc(ch.name)}: идёт {_yes_no(bool(cst.get('any_live')))} (Kick: {_yes_no(bool(cst.get('kick_live')))}, "
+            f"VK: {_yes_no(bool(cst.get('vk_live')))}), старт {esc(cst.get('started_at'))}, "
+            f"подтверждений конца {int(cst.get('end_streak') or 0)}"
+        )
+    channels_block = ("Другие каналы:\n" + "\n".join(channel_lines) + "\n\n") if channel_lines else ""
+
+    live_card_line = ""
+    if LIVE_CARD_ENABLED:
+        card = live_card_of(state_view())
+        live_card_line = (
+            f"- Живая карточка: сообщение {card['message_id']}, {'фото' if card.get('photo') else 'текст'}"
+            f"{', закреплена' if LIVE_CARD_PIN else ''}\n" if card else "- Живая карточка: нет (стрима нет)\n"
+        )
+
+    if KICK_PUSH_ENABLED:
+        p = kick_push_stats()
+        fetch_lines.append(
+            f"- Kick push (websocket): подключено {p['connected']} из {p['channels']}, "
+            f"событий: старт {p['start']}, стоп {p['stop']}, обновление {p['update']}"
+        )
+
     return (
         "Админ-проверка (простыми словами)\n\n"
         "Стрим сейчас:\n"
         f"- Идёт ли стрим: {_yes_no(any_live)} (Kick: {_yes_no(kick_live)}, VK: {_yes_no(vk_live)})\n"
         f"- Время старта: {started_at}\n"
         f"- Подтверждений конца: {end_streak} (нужно {END_CONFIRM_STREAK}) ✅\n\n"
-        "Команды в Телеграм:\n"
+        + channels_block
+        + "Команды в Телеграм:\n"
         f"- Бот “на связи”: {on_air_icon} {on_air_text} (последний опрос: {_age_str(poll_age)} назад)\n"
         f"- Последняя команда (/stream и т.п.): {_age_str(cmd_age)} назад\n"
-        f"- Самовосстановление (watchdog): {_age_str(rec_age)} назад\n\n"
+        f"- Самовосстановление (watchdog): {_age_str(rec_age)} назад\n"
+        + "\n".join(breaker_lines)
+        + "\n\n"
         "Очередь сообщений Telegram:\n"
         f"- Webhook: {webhook_state}\n"
         f"- В очереди Telegram: {esc(pend)} (сколько апдейтов ждут доставки)\n"
-        f"- Указатель очереди (offset): {offset} (с какого update_id продолжаем)\n\n"
+        f"- Указатель очереди (offset): {offset} (с какого update_id продолжаем)\n"
+        f"- Отложенные повторы отправки: {rq['pending']} в очереди; попыток {rq['attempts']}, "
+        f"повторов {rq['retries']} (ждали {rq['delay_sec']:.0f} сек), сдались {rq['gave_up']}\n"
+        f"- Ограничитель частоты: придержано {tr['waits']} сообщений (всего {tr['wait_sec']:.0f} сек), "
+        f"отложено в очередь {tr['deferred']}, отказов 429 от Telegram: {tr['rejected']}\n"
+        f"- Исходящая очередь: ждут {ob['pending']}; отправлено {ob['sent']}, повторов {ob['retries']}, "
+        f"сброшено {ob['dropped']}\n"
+        f"- Фото: загружено {mc['uploads']}, отправлено повторно по file_id {mc['reused']} (в кэше {mc['entries']})\n"
+        + live_card_line
+        + "\n"
+        "Опрос Kick/VK (без повторного разбора, если ничего не изменилось):\n"
+        + "\n".join(fetch_lines)
+        + "\n\n"
+        "Соединения (время до ответа сервера):\n"
+        + "\n".join(conn_lines)
+        + "\n\n"
         "Что делать:\n"
         + "\n".join(actions)
         + "\n"
@@ -1694,9 +4891,7 @@ def commands_loop_once():
         time.sleep(5)
         return
 
-    with STATE_LOCK:
-        st = load_state()
-    offset = int(st.get("updates_offset") or 0)
+    offset = int(state_view().get("updates_offset") or 0)
 
     try:
         updates = tg_get_updates(offset=offset, timeout=COMMAND_POLL_TIMEOUT)
@@ -1706,489 +4901,1289 @@ def commands_loop_once():
         time.sleep(1)
         return
 
-    now_ts = ts()
-    with STATE_LOCK:
-        st2 = load_state()
-        last_saved = int(st2.get("last_updates_poll_ts") or 0)
-        if now_ts - last_saved >= COMMAND_STATE_SAVE_SEC:
-            st2["last_updates_poll_ts"] = now_ts
-            save_state(st2)
+    mark_updates_polled()
+
+    max_update_id = None
+
+    for upd in updates:
+        uid = upd.get("update_id")
+        if isinstance(uid, int):
+            max_update_id = uid if (max_update_id is None or uid > max_update_id) else max_update_id
+        handle_update(upd)
+
+    # Always advance offset even if sending failed; otherwise bot will re-process old commands.
+    advance_updates_offset(max_update_id)
+
+
+def mark_updates_polled() -> None:
+    # Ephemeral field: RAM only, so it is cheap to bump on every poll.
+    with TG_STATE_LOCK:
+        st2 = load_state()
+        st2["last_updates_poll_ts"] = ts()
+        save_state(st2)
+
+
+def advance_updates_offset(max_update_id: int | None) -> None:
+    if max_update_id is None:
+        return
+    with TG_STATE_LOCK:
+        st3 = load_state()
+        st3["updates_offset"] = int(max_update_id) + 1
+        save_state(st3)
+
+
+def tg_reply(name: str, chat_id: int | None, fn, afn=None) -> None:
+    """Queue a command reply; fn(retries) sends it. The queue owns the retries and their backoff,
+    so each run is a single attempt and the commands loop never sleeps on a slow Telegram.
+    afn: the same reply as a coroutine function, used by the async runtime instead (handle_update_async)."""
+    retries = 1 if (OUTBOX_ENABLED or RETRY_SCHED_ENABLED) else None
+    send_later(name, lambda: fn(retries), chat_id=chat_id, prio=PRIO_CHANGE)
+
+
+def handle_update(upd: dict, reply=None) -> None:
+    """Process one Telegram update (commands). Never raises. reply(name, chat_id, fn, afn) sends the
+    replies, tg_reply by default."""
+    reply = reply or tg_reply
+    msg = upd.get("message") or {}
+    text = msg.get("text") or ""
+    if not text:
+        return
+
+    try:
+        # remember admin private chat id
+        if is_private_chat(msg) and is_admin_msg(msg):
+            with TG_STATE_LOCK:
+                stx = load_state()
+                stx["admin_private_chat_id"] = int((msg.get("chat") or {}).get("id") or 0)
+                save_state(stx)
+            reply("setMyCommands", None, setup_commands_visibility)
+
+        chat = msg.get("chat") or {}
+        chat_id = chat.get("id")
+        if not isinstance(chat_id, int):
+            return
+
+        thread_id = msg.get("message_thread_id")
+        thread_id = int(thread_id) if isinstance(thread_id, int) else None
+
+        reply_to = msg.get("message_id")
+        reply_to = int(reply_to) if isinstance(reply_to, int) else None
+
+        cmd = text.strip().split()[0].split("@")[0]
+
+        if cmd in ADMIN_COMMANDS:
+            if not (is_private_chat(msg) and is_admin_msg(msg)):
+                return
+            if cmd == "/admin_reset_offset":
+                with TG_STATE_LOCK:
+                    stx = load_state()
+                    stx["updates_offset"] = 0
+                    save_state(stx)
+                ok_text = "OK: updates_offset сброшен в 0."
+                reply(
+                    "admin_reset_offset reply",
+                    chat_id,
+                    lambda r: tg_send_to(chat_id, None, ok_text, reply_to=reply_to, retries=r),
+                    lambda: tg_send_to_async(chat_id, None, ok_text, reply_to=reply_to),
+                )
+                return
+
+            # /admin: getWebhookInfo is a Telegram call too, so it runs in the queued job
+            def send_admin(r):
+                try:
+                    wh = tg_get_webhook_info(r)
+                except Exception as e:
+                    wh = {"error": str(e)}
+                tg_send_to(chat_id, None, build_admin_diag_text(state_view(), wh), reply_to=reply_to, retries=r)
+
+            async def send_admin_async():
+                try:
+                    wh = await tg_call_async("getWebhookInfo", {}, timeout=(5, 15))
+                except Exception as e:
+                    wh = {"error": str(e)}
+                await tg_send_to_async(chat_id, None, build_admin_diag_text(state_view(), wh), reply_to=reply_to)
+
+            reply("/admin reply", chat_id, send_admin, send_admin_async)
+            return
+
+        if cmd in HISTORY_COMMANDS:
+            parts = text.strip().split(maxsplit=1)
+            try:
+                history = history_reply_text(parts[1] if len(parts) > 1 else "", chat_id)
+            except Exception as e:
+                log_line(f"history query failed: {e}")
+                history = "Не получилось прочитать историю патоков."
+            reply(
+                "/history reply",
+                chat_id,
+                lambda r: tg_send_to(chat_id, thread_id, history, reply_to=reply_to, retries=r),
+                lambda: tg_send_to_async(chat_id, thread_id, history, reply_to=reply_to),
+            )
+            return
+
+        if not is_status_command(text):
+            return
+
+        with TG_STATE_LOCK:
+            stx = load_state()
+            stx["last_command_seen_ts"] = ts()
+            save_state(stx)
+        # Fetch current status (cache-first; avoids long waits on Kick/VK)
+        snap = _cache_get_snapshot()
+        if snap is not None:
+            st_cur, kick, vk, _age = snap
+        else:
+            kick, vk = fetch_platforms("command")
+
+            with STATE_LOCK:
+                st_cur = load_state()
+                st_cur["any_live"] = bool(kick.get("live") or vk.get("live"))
+                st_cur["kick_live"] = bool(kick.get("live"))
+                st_cur["vk_live"] = bool(vk.get("live"))
+                if st_cur["any_live"]:
+                    set_started_at_from_kick(st_cur, kick)
+                    st_cur["end_streak"] = 0
+                st_cur["kick_title"] = kick.get("title")
+                st_cur["kick_cat"] = kick.get("category")
+                st_cur["vk_title"] = vk.get("title")
+                st_cur["vk_cat"] = vk.get("category")
+                st_cur["kick_viewers"] = kick.get("viewers")
+                st_cur["vk_viewers"] = vk.get("viewers")
+                save_state(st_cur)
+
+        if not (kick.get("live") or vk.get("live")):
+            no_stream = build_no_stream_text("Сейчас на канале Глад Валакас патока нет!")
+            reply(
+                "no-stream reply",
+                chat_id,
+                lambda r: tg_send_to(chat_id, thread_id, no_stream, reply_to=reply_to, retries=r),
+                lambda: tg_send_to_async(chat_id, thread_id, no_stream, reply_to=reply_to),
+            )
+        else:
+            prefix = "📌 Текущее состояние патока"
+            fan = FanOut("status reply")  # shared by a queued re-run: the PUBG copy is not sent twice
+            reply(
+                "status reply",
+                chat_id,
+                lambda r: send_status_with_screen_to(prefix, st_cur, kick, vk, chat_id, thread_id, reply_to, fan=fan, retries=r),
+                lambda: send_status_with_screen_to_async(prefix, st_cur, kick, vk, chat_id, thread_id, reply_to, fan=fan),
+            )
+
+    except Exception as e:
+        log_line(f"command processing error: {e}\n{traceback.format_exc()[:1200]}")
+
+
+def commands_watchdog_once() -> None:
+    now_ts = commands_watchdog_due()
+    if now_ts is None:
+        return
+    tg_drop_pending_updates_safe()
+    commands_watchdog_recovered(now_ts)
+
+
+def commands_watchdog_due() -> int | None:
+    """now_ts when getUpdates has been silent for too long and the recovery cool-down is over
+    (the admin is told the recovery starts)."""
+    if not (COMMANDS_ENABLED and COMMANDS_WATCHDOG_ENABLED):
+        return None
+
+    st = state_view()
+    last_poll = int(st.get("last_updates_poll_ts") or 0)
+    last_recover = int(st.get("last_commands_recover_ts") or 0)
+    now_ts = ts()
+
+    if last_poll == 0:
+        return None
+
+    silent = (now_ts - last_poll) >= COMMANDS_WATCHDOG_SILENCE_SEC
+    cooldown_ok = (now_ts - last_recover) >= COMMANDS_WATCHDOG_COOLDOWN_SEC
+    if not (silent and cooldown_ok):
+        return None
+    notify_admin_dedup("watchdog_triggered", "⚠️ Watchdog: getUpdates давно не отрабатывал, делаю восстановление...")
+    return now_ts
+
+
+def commands_watchdog_recovered(now_ts: int) -> None:
+    with TG_STATE_LOCK:
+        st2 = load_state()
+        st2["updates_offset"] = 0
+        st2["last_commands_recover_ts"] = now_ts
+        save_state(st2)
+
+    if COMMANDS_WATCHDOG_PING_ENABLED:
+        notify_admin_dedup("watchdog_recovered", "✅ Watchdog: восстановил polling команд.")
+
+
+def commands_watchdog_forever():
+    while True:
+        try:
+            commands_watchdog_once()
+        except Exception as e:
+            log_line(f"commands_watchdog error: {e}\n{traceback.format_exc()[:1200]}")
+
+        time.sleep(10)
+
+
+# ========== MAIN LOOP ==========
+
+def main_loop_forever():
+    while True:
+        try:
+            main_loop()
+        except Exception as e:
+            _flush_state_on_exit()
+            notify_admin_dedup("main_loop_crash", f"main_loop crashed: {e}\n{traceback.format_exc()[:1500]}")
+            time.sleep(LOOP_CRASH_SLEEP)
+
+
+CHANNEL_POOL = ThreadPoolExecutor(max_workers=max(1, CHANNEL_WORKERS), thread_name_prefix="channel")
+
+
+def _run_channels(fn, channels) -> list:
+    """Run fn(ch) for each channel (in parallel when there are several). Returns [(ch, error or None)]."""
+    if len(channels) == 1:
+        return [(channels[0], _timed_call(lambda: fn(channels[0]))[1])]
+    futs = [(ch, CHANNEL_POOL.submit(_timed_call, lambda c=ch: fn(c))) for ch in channels]
+    return [(ch, f.result()[1]) for ch, f in futs]
+
+
+def channel_init(ch) -> None:
+    # init fetch
+    deadline = Deadline(TICK_DEADLINE_SEC)
+    kick0, vk0 = fetch_platforms("init", deadline=deadline, ch=ch)
+
+    any_live0 = bool(kick0.get("live") or vk0.get("live"))
+
+    with STATE_LOCK:
+        st = channel_load(ch)
+        st["any_live"] = any_live0
+        st["kick_live"] = bool(kick0.get("live"))
+        st["vk_live"] = bool(vk0.get("live"))
+        if any_live0:
+            set_started_at_from_kick(st, kick0)
+            st["end_streak"] = 0
+        st["kick_title"] = kick0.get("title")
+        st["kick_cat"] = kick0.get("category")
+        st["vk_title"] = vk0.get("title")
+        st["vk_cat"] = vk0.get("category")
+        st["kick_viewers"] = kick0.get("viewers")
+        st["vk_viewers"] = vk0.get("viewers")
+        stats_tick(st, kick0, vk0, any_live0, now_ts=ts())
+        channel_save(ch, st)
+
+    if channel_view(ch).get("start_hist") is None:
+        st = channel_load(ch)
+        if start_hist_seed(st, ch):
+            with STATE_LOCK:
+                st2 = channel_load(ch)
+                st2["start_hist"] = st["start_hist"]
+                channel_save(ch, st2)
+    poll_schedule(("kick", "vk"), kick0, vk0, stream_on=any_live0 or bool(channel_view(ch).get("started_at")), ch=ch)
+
+    # no-stream on start
+    if NO_STREAM_ON_START_MESSAGE and (not any_live0):
+        last_ts = int(channel_view(ch).get("last_no_stream_start_ts") or 0)
+        if ts() - last_ts >= NO_STREAM_START_DEDUP_SEC:
+            try:
+                text = build_no_stream_text(f"Сейчас на канале {ch.name} патока нет!", ch)
+                outbox_send(ch.chat_id, f"no-stream notice [{ch.id}]", PRIO_CHANGE, lambda _dl: tg_send(text, ch))
+            except Exception as e:
+                log_line(f"No-stream-on-start send error: {e}")
+            with STATE_LOCK:
+                st = channel_load(ch)
+                st["last_no_stream_start_ts"] = ts()
+                channel_save(ch, st)
+
+    # boot status
+    if BOOT_STATUS_ENABLED and any_live0:
+        try:
+            can_send = ts() - int(channel_view(ch).get("last_boot_status_ts") or 0) >= BOOT_STATUS_DEDUP_SEC
+            if can_send:
+                st = channel_view(ch)
+                outbox_send(
+                    ch.chat_id,
+                    f"boot status [{ch.id}]",
+                    PRIO_CHANGE,
+                    lambda dl, st=st, fan=FanOut(f"boot status [{ch.id}]"): send_status_with_screen(
+                        "ℹ️ Паток уже идёт (после рестарта)", st, kick0, vk0, dl, ch, fan
+                    ),
+                    deadline,
+                )
+                with STATE_LOCK:
+                    st = channel_load(ch)
+                    st["last_boot_status_ts"] = ts()
+                    channel_save(ch, st)
+        except Exception as e:
+            log_line(f"Boot status send error: {e}")
+
+
+def _raise_channel_errors(what: str, results) -> None:
+    """With one channel its error stops the loop (as before channels existed); otherwise it is logged."""
+    for ch, err in results:
+        if err is not None:
+            if len(CHANNELS) == 1:
+                raise err
+            log_line(f"channel {what} failed [{ch.id}]: {err}\n{''.join(traceback.format_exception(err))[:1500]}")
+
+
+def main_loop_init() -> None:
+    _raise_channel_errors("init", _run_channels(channel_init, CHANNELS))
+    poll_stagger(CHANNELS)
+
+    # startup ping
+    ping_sent = bool(state_view().get("startup_ping_sent"))
+    if not ping_sent:
+        try:
+            st = state_view()
+            tg_send("✅ StreamAlertValakas запущен (ping).\n" + fmt_running_line(st))
+            with STATE_LOCK:
+                st = load_state()
+                st["startup_ping_sent"] = True
+                save_state(st)
+        except Exception as e:
+            log_line(f"Startup ping failed: {e}")
+
+
+_END_IN_FLIGHT = {}  # channel id -> started_at whose END report is queued (not re-queued meanwhile)
+
+
+def start_alert_job(ch, st, kick, vk, deadline, fan: FanOut) -> None:
+    """Outbox job: the START alert. last_start_sent_ts (START_DEDUP_SEC) is recorded once it is out."""
+    kind = send_status_with_screen(live_card_prefix(ch), st, kick, vk, deadline, ch, fan)
+    with STATE_LOCK:
+        st2 = channel_load(ch)
+        st2["last_start_sent_ts"] = ts()
+        channel_save(ch, st2)
+    live_card_start(ch, fan, kind)
+
+
+def end_report_job(ch, st_end, end_text: str, kick, fan: FanOut) -> None:
+    """Outbox job: the END report. Only after it is out the session is closed (started_at cleared)."""
+    card = live_card_of(st_end)
+    if card:
+        live_card_finish(ch, card, end_text, st_end, kick, fan)
+    else:
+        tg_send_main_and_maybe_pubg(end_text, st_end, kick, ch, fan)
+    started_at = st_end.get("started_at")
+    with STATE_LOCK:
+        st = channel_load(ch)
+        if st.get("started_at") == started_at:  # not a new stream that began meanwhile
+            st["started_at"] = None
+            st["live_card"] = None
+            st["end_sent_for_started_at"] = started_at
+            st["end_sent_ts"] = st_end.get("end_sent_ts") or ts()
+            channel_save(ch, st)
+    if _END_IN_FLIGHT.get(ch.id) == started_at:
+        _END_IN_FLIGHT.pop(ch.id, None)
+
+
+def channel_tick(ch) -> None:
+    """One poll of one channel: fetch the due platforms, START/CHANGE/END, save state."""
+    deadline = Deadline(TICK_DEADLINE_SEC)
+    tick_t0 = time.monotonic()
+    polled = poll_due_platforms(ch)
+    kick, vk = fetch_platforms("tick", polled, deadline, ch)
+    channel_apply(ch, polled, kick, vk, deadline, tick_t0)
+
+
+def channel_apply(ch, polled, kick, vk, deadline: Deadline, tick_t0: float) -> None:
+    """The rest of a tick once the platforms are fetched: START/CHANGE/END, save state, reschedule."""
+    st = channel_view(ch)
+    prev_any = bool(st.get("any_live"))
+    prev_end_streak = int(st.get("end_streak") or 0)
+
+    any_live = bool(kick.get("live") or vk.get("live"))
+    end_streak = end_streak_step(ch, polled, any_live, prev_end_streak)
+
+    # START
+    if (not prev_any) and any_live:
+        last = int(channel_view(ch).get("last_start_sent_ts") or 0)
+        if ts() - last >= START_DEDUP_SEC:
+            with STATE_LOCK:
+                st_start = channel_load(ch)
+                # New stream session: force sync from Kick so start time/duration won't stick.
+                reset_stream_session(st_start)
+                set_started_at_from_kick(st_start, kick, force=True)
+                started_dt = dt_from_iso(st_start.get("started_at"))
+                start_hist_add(st_start, int(started_dt.timestamp()) if started_dt else ts())
+                channel_save(ch, st_start)
+            try:
+                st = channel_view(ch)
+                outbox_send(
+                    ch.chat_id,
+                    f"start alert [{ch.id}]",
+                    PRIO_ALERT,
+                    lambda dl, st=st, fan=FanOut(f"start alert [{ch.id}]"): start_alert_job(ch, st, kick, vk, dl, fan),
+                    deadline,
+                )
+            except Exception as e:
+                log_line(f"Start send error: {e}")
+
+    # CHANGE
+
+    kick_title_changed = False
+
+    kick_cat_changed = False
+
+    vk_title_changed = False
+
+    vk_cat_changed = False
+
+
+    st = channel_view(ch)
+
+    if kick.get("live"):
+
+        kick_title_changed = (kick.get("title") != st.get("kick_title"))
+
+        kick_cat_changed = (kick.get("category") != st.get("kick_cat"))
+
+    if vk.get("live"):
+
+        vk_title_changed = (vk.get("title") != st.get("vk_title"))
+
+        vk_cat_changed = (vk.get("category") != st.get("vk_cat"))
+
+
+    changed = (kick_title_changed or kick_cat_changed or vk_title_changed or vk_cat_changed)
+
+
+    if any_live and prev_any and changed and live_card_of(channel_view(ch)) is None:
+        last = int(channel_view(ch).get("last_change_sent_ts") or 0)
+        if ts() - last >= CHANGE_DEDUP_SEC:
+            try:
+                st = channel_view(ch)
+                caption = build_change_caption(st, kick, vk, kick_title_changed, kick_cat_changed, vk_title_changed, vk_cat_changed, ch)
+                outbox_send(
+                    ch.chat_id,
+                    f"change alert [{ch.id}]",
+                    PRIO_CHANGE,
+                    lambda dl, st=st, fan=FanOut(f"change alert [{ch.id}]"): send_caption_with_screen(caption, st, kick, vk, dl, ch, fan),
+                    deadline,
+                )
+                with STATE_LOCK:
+                    st = channel_load(ch)
+                    st["last_change_sent_ts"] = ts()
+                    channel_save(ch, st)
+            except Exception as e:
+                log_line(f"Change send error: {e}")
+
+    # END (once per started_at)
+    should_send_end = False
+    st_chk = channel_view(ch)
+    cur_started = st_chk.get("started_at")
+    already_for = st_chk.get("end_sent_for_started_at")
+    confirmed_off = end_confirmed(ch, any_live, end_streak)
+    if confirmed_off and cur_started and (already_for != cur_started) and _END_IN_FLIGHT.get(ch.id) != cur_started:
+        should_send_end = True
+
+    if should_send_end:
+        try:
+            # Private copy for the report only; it is not committed.
+            st_end = channel_load(ch)
+            # Finalize stats up to now (counts the last interval)
+            stats_tick(st_end, kick, vk, any_live=False, now_ts=ts())
+            stats_finalize_end(st_end, now_ts=ts())
+            st_end["kick_viewers"] = st_end.get("kick_viewers") or kick.get("viewers")
+            st_end["vk_viewers"] = st_end.get("vk_viewers") or vk.get("viewers")
+            st_end["end_sent_for_started_at"] = st_end.get("started_at")
+            st_end["end_sent_ts"] = ts()
+            end_text = build_end_text(st_end, ch)
+            history_archive_session(st_end, ch)
+            # started_at is cleared by the job once the report is out. Until then a restart (or a
+            # dropped job, see on_drop) leaves it set and the END is reported again.
+            _END_IN_FLIGHT[ch.id] = cur_started
+            outbox_send(
+                ch.chat_id,
+                f"end report [{ch.id}]",
+                PRIO_ALERT,
+                lambda _dl, fan=FanOut(f"end report [{ch.id}]"): end_report_job(ch, st_end, end_text, kick, fan),
+                deadline,
+                on_drop=lambda: _END_IN_FLIGHT.pop(ch.id, None),
+            )
+        except Exception as e:
+            log_line(f"End send error: {e}")
+
+    # SAVE NEW STATE
+    with STATE_LOCK:
+        st = channel_load(ch)
+        st["any_live"] = any_live
+        st["kick_live"] = bool(kick.get("live"))
+        st["vk_live"] = bool(vk.get("live"))
+        if any_live:
+            set_started_at_from_kick(st, kick)
+            st["end_streak"] = 0
+        else:
+            # Do not clear started_at yet — it is required for sending the final end report.
+            # started_at will be reset when a new stream session starts (Kick created_at sync) or after end-report is sent.
+            st["end_streak"] = end_streak
+        st["kick_title"] = kick.get("title")
+        st["kick_cat"] = kick.get("category")
+        st["vk_title"] = vk.get("title")
+        st["vk_cat"] = vk.get("category")
+        st["kick_viewers"] = kick.get("viewers")
+        st["vk_viewers"] = vk.get("viewers")
+        stats_tick(st, kick, vk, any_live, now_ts=ts())
+        channel_save(ch, st)
+    # started_at stays set until the end report is out, so END confirmation keeps the live cadence.
+    poll_schedule(polled, kick, vk, stream_on=any_live or bool(st.get("started_at")), ch=ch)
+    end_pending = bool(st.get("started_at")) and st.get("end_sent_for_started_at") != st.get("started_at")
+    poll_transition(ch, polled, prev_any, any_live, kick, vk, end_pending=not any_live and end_pending)
+    if any_live:
+        history_record_samples(st.get("started_at"), kick, vk, ts(), ch)
+        live_card_tick(ch, st, kick, vk, changed)
+    if ch.is_main:
+        # Commands (/stream) answer for the main channel.
+        try:
+            _cache_set_snapshot(st, kick, vk)
+        except Exception:
+            pass
+
+    if deadline.expired():
+        label = "" if ch.is_main else f" [{ch.id}]"
+        log_line(f"[tick]{label} over budget: {time.monotonic() - tick_t0:.1f}s (TICK_DEADLINE_SEC={TICK_DEADLINE_SEC:g})")
+
+
+def main_loop_tick(cleanup_counter: int) -> int:
+    """One main loop iteration: tick every channel that is due, then housekeeping. Returns the cleanup counter."""
+    due = [ch for ch in CHANNELS if poll_due_platforms(ch)]
+    _raise_channel_errors("tick", _run_channels(channel_tick, due))
+    return main_loop_housekeeping(cleanup_counter)
+
+
+def main_loop_housekeeping(cleanup_counter: int) -> int:
+    """Periodic cleanup + quota monitor, every DISK_CHECK_INTERVAL ticks. Returns the cleanup counter."""
+    cleanup_counter += 1
+    if cleanup_counter >= DISK_CHECK_INTERVAL:
+        cleanup_temp_files()
+        cleanup_old_state_backups()
+
+        q_percent, q_used, q_total = quota_usage_for_bot()
+        last_nt = int(state_view().get("last_quota_notify_ts") or 0)
+        cooldown_ok = (ts() - last_nt) >= BOT_NOTIFY_COOLDOWN_SEC
+
+        if q_percent >= BOT_WARN_PERCENT and cooldown_ok:
+            top = list_largest_files(os.getcwd(), BOT_TOP_FILES)
+            top_text = ""
+            if top:
+                top_lines = "\n".join([f"- {fmt_bytes(sz)} — {path}" for sz, path in top])
+                top_text = "\n\nТоп файлов по размеру:\n" + top_lines
+
+            notify_admin_dedup(
+                "quota_high",
+                "⚠️ Квота диска почти заполнена (по размеру папки бота).\n"
+                f"Занято ботом: {fmt_bytes(q_used)} из {fmt_bytes(q_total)} ({q_percent:.1f}%)."
+                + top_text
+                + "\n\nОчищаю temp/__pycache__…",
+            )
+            cleanup_pycache()
+            cleanup_temp_files()
+            cleanup_old_state_backups()
+
+            with NOTIFY_STATE_LOCK:
+                stq = load_state()
+                stq["last_quota_notify_ts"] = ts()
+                save_state(stq)
+
+        cleanup_counter = 0
+
+    return cleanup_counter
+
+
+def main_loop():
+    main_loop_init()
+
+    cleanup_counter = 0
+
+    while True:
+        POLL_WAKE.clear()
+        cleanup_counter = main_loop_tick(cleanup_counter)
+        POLL_WAKE.wait(poll_sleep_sec())
+
+
+def shot_refresh_due() -> float:
+    """Refresher cadence: never longer than a cached frame stays usable."""
+    return max(2, min(int(SHOT_REFRESH_SEC), int(SHOT_CACHE_MAX_AGE_SEC)))
+
+
+def _shot_refresh_url(ch) -> str | None:
+    """The channel's playback URL if it is live on Kick and its cached frame is due for a refresh."""
+    kick = _LAST_FETCHED.get(fetch_key(ch, "kick"))
+    if kick is None or not kick.get("live") or not kick.get("playback_url"):
+        return None
+    cached = _shot_cache_get(ch)
+    if cached is not None and cached[1] < shot_refresh_due():
+        return None
+    return kick.get("playback_url")
+
+
+def shot_refresh_once(ch) -> bool:
+    """Take a new frame of the channel if it is live on Kick and its cached frame is due. True if taken."""
+    url = _shot_refresh_url(ch)
+    if url is None:
+        return False
+    img = screenshot_from_m3u8_fast(url)
+    if not img:
+        return False
+    _shot_cache_set(img, ch)
+    return True
+
+
+def screenshot_refresher_forever() -> None:
+    # Keep a fresh real screenshot in RAM for every channel live on Kick.
+    while True:
+        for ch in CHANNELS:
+            try:
+                shot_refresh_once(ch)
+            except Exception as e:
+                log_line(f"[shot] refresh failed [{ch.id}]: {e}")
+        time.sleep(shot_refresh_due())
+
+# ========== ASYNC RUNTIME (ASYNC_RUNTIME=1) ==========
+# The steps of the threads above as tasks on one event loop. HTTP goes through one aiohttp session;
+# answers become requests.Response objects and aiohttp errors the matching requests exceptions, so
+# retries, breakers, rate limits and error texts work as in the threaded runtime. channel_apply()
+# (state, SQLite, queuing alerts) and handle_update() run in the loop's executor; their replies are
+# awaited on the loop. Commands from different chats are handled concurrently, in order within one chat.
+_AIO_SESSION = None
+_ASYNC_CHAT_LOCKS = {}  # chat_id -> [asyncio.Lock, users]
+_ASYNC_TASKS = set()  # running command handlers (the loop keeps only weak references)
+
+
+def _aio_timeout(timeout, deadline: Deadline | None = None):
+    """aiohttp timeouts from a requests-style one (seconds or (connect, read)), clamped to the deadline."""
+    if deadline is not None:
+        timeout = deadline.clamp(timeout)
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return aiohttp.ClientTimeout(sock_connect=float(connect), sock_read=float(read))
+
+
+@contextmanager
+def _aio_errors(what: str):
+    """aiohttp errors as the requests exceptions the retry and breaker code expects."""
+    try:
+        yield
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError as e:
+        raise requests.exceptions.Timeout(f"{what}: timed out") from e
+    except aiohttp.ClientPayloadError as e:
+        raise requests.exceptions.ChunkedEncodingError(f"{what}: {e}") from e
+    except aiohttp.ClientConnectionError as e:
+        raise requests.exceptions.ConnectionError(f"{what}: {e}") from e
+
+
+async def _aio_read_response(resp) -> requests.Response:
+    """Read the whole body of an aiohttp response and release it."""
+    try:
+        with _aio_errors(f"{resp.method} {resp.url}"):
+            body = await resp.read()
+    finally:
+        resp.release()
+    r = requests.Response()
+    r.status_code = resp.status
+    r.reason = resp.reason
+    r.url = str(resp.url)
+    r.headers = CaseInsensitiveDict(resp.headers)
+    r.encoding = resp.get_encoding() if body else None
+    r._content = body
+    r._content_consumed = True
+    return r
+
+
+async def aio_transport_request(method: str, url: str, *, headers=None, json=None, data=None, files=None, timeout=None, allow_redirects=True, stream=False):
+    """One request on the shared session. Returns a requests.Response, or with stream=True the open
+    aiohttp response (release() it when done)."""
+    body = data
+    if files:
+        body = aiohttp.FormData()
+        for k, v in (data or {}).items():
+            body.add_field(k, str(v))
+        for k, (filename, content) in files.items():
+            body.add_field(k, content, filename=filename)
+    with _aio_errors(f"{method} {url}"):
+        resp = await _AIO_SESSION.request(method, url, headers=headers, json=json, data=body, timeout=timeout, allow_redirects=allow_redirects)
+    return resp if stream else await _aio_read_response(resp)
+
+
+async def aio_request_ext(method: str, url: str, *, headers=None, json_body=None, data=None, timeout=25, allow_redirects=True, stream=False, deadline: Deadline | None = None, retries: int | None = None):
+    """http_request_ext() on the event loop: same retries, breaker and exceptions; the backoff is awaited."""
+    breaker = breaker_for(url) if BREAKER_ENABLED else None
+    last_exc = None
+    retries = HTTP_RETRIES if retries is None else max(1, int(retries))
+    for attempt in range(1, retries + 1):
+        if deadline is not None and deadline.expired():
+            raise last_exc or DeadlineExceeded(f"{method} {url}: tick deadline exceeded")
+        if breaker is not None:
+            breaker.allow()
+        try:
+            r = await aio_transport_request(
+                method,
+                url,
+                headers=headers,
+                json=json_body,
+                data=data,
+                timeout=_aio_timeout(timeout, deadline),
+                allow_redirects=allow_redirects,
+                stream=stream,
+            )
+            status = r.status if stream else r.status_code
+            if breaker is not None:
+                breaker.record(status not in (429, 500, 502, 503, 504))
+            if status < 400:
+                return r
+            if stream:
+                r = await _aio_read_response(r)
+            if status in (429, 500, 502, 503, 504) and attempt < retries:
+                await asyncio.sleep(_backoff_wait(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_JITTER, deadline))
+                continue
+            r.raise_for_status()
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            last_exc = e
+            if breaker is not None:
+                breaker.record(False)
+            if attempt == retries:
+                raise
+            await asyncio.sleep(_backoff_wait(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_JITTER, deadline))
+        except requests.exceptions.HTTPError:
+            raise
+        except Exception:
+            if breaker is not None:
+                breaker.record(False)
+            raise
+    raise last_exc
+
+
+async def aio_request_tg(method: str, url: str, *, json_body=None, data=None, files=None, timeout=(5, 15), retries: int | None = None) -> requests.Response:
+    """http_request_tg() on the event loop. A rate-limit wait or a 429's retry_after is awaited by this
+    task instead of being handed back to a queue: nothing else waits for it."""
+    last_exc = None
+    retries = TG_RETRIES if retries is None else max(1, int(retries))
+    for attempt in range(1, retries + 1):
+        wait = _tg_rate_take(url, json_body, data, defer=False)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            r = await aio_transport_request(method, url, json=json_body, data=data, files=files, timeout=_aio_timeout(timeout))
+            if r.status_code in (429, 500, 502, 503, 504):
+                retry_after = tg_response_retry_after(r)
+                if retry_after is not None:
+                    tg_rate_penalize(url, json_body, data, retry_after)  # the next attempt waits it out
+                if attempt == retries:
+                    r.raise_for_status()
+                if retry_after is None:
+                    await asyncio.sleep(_backoff_wait(attempt, TG_BACKOFF_BASE, TG_BACKOFF_MAX, True))
+                continue
+            r.raise_for_status()
+            return r
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.HTTPError) as e:
+            last_exc = e
+            if attempt == retries:
+                raise
+            await asyncio.sleep(_backoff_wait(attempt, TG_BACKOFF_BASE, TG_BACKOFF_MAX, True))
+    raise last_exc
+
+
+async def _aio_timed(make):
+    t0 = time.monotonic()
+    try:
+        return await make(), None, time.monotonic() - t0
+    except Exception as e:
+        return None, e, time.monotonic() - t0
+
+
+async def _aio_nothing():
+    return None
 
-    max_update_id = None
 
-    for upd in updates:
-        uid = upd.get("update_id")
-        if isinstance(uid, int):
-            max_update_id = uid if (max_update_id is None or uid > max_update_id) else max_update_id
+async def aio_hedged_call(name: str, make):
+    """hedged_call() on the event loop. The loser is not cancelled (a half-open breaker waits for its
+    probe); its response is closed when it arrives."""
+    threshold = _hedge_threshold(name)
+    if threshold is None:
+        res, err, sec = await _aio_timed(make)
+        _hedge_record(name, sec if err is None else None)
+        if err is not None:
+            raise err
+        return res
+
+    first = asyncio.ensure_future(_aio_timed(make))
+    done, _ = await asyncio.wait({first}, timeout=threshold)
+    if done:
+        res, err, sec = first.result()
+        _hedge_record(name, sec if err is None else None)
+        if err is not None:
+            raise err
+        return res
+
+    second = asyncio.ensure_future(_aio_timed(make))
+    pending = {first, second}
+    last_err = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        won = [fut for fut in (first, second) if fut in done and fut.result()[1] is None]
+        if won:
+            fut = won[0]
+            res, _err, sec = fut.result()
+            _hedge_record(name, sec, hedged=True, won=fut is second)
+            for other in {first, second} - {fut}:
+                other.add_done_callback(_close_hedge_loser)
+            return res
+        last_err = next(iter(done)).result()[1]
+    _hedge_record(name, None, hedged=True)
+    raise last_err
+
+
+async def aio_read_streamed(resp, scan, max_bytes: int, name: str, deadline: Deadline | None = None) -> bytearray:
+    """read_streamed() for an open aiohttp response."""
+    buf = bytearray()
+    with _aio_errors(f"{name} body"):
+        async for chunk in resp.content.iter_chunked(max(1024, int(FETCH_CHUNK_BYTES))):
+            if deadline is not None:
+                deadline.check(f"{name} body")
+            if chunk and _feed_chunk(buf, chunk, scan, max_bytes, name):
+                break
+    return buf
+
+
+async def fetch_conditional_async(name: str, url: str, headers: dict, scan, max_bytes: int, deadline: Deadline | None = None, hedge: bool = False, **kwargs) -> PlatformSnapshot:
+    """fetch_conditional() on the event loop."""
+    cached, req_headers = _conditional_headers(name, headers)
+
+    def request():
+        return aio_request_ext("GET", url, headers=req_headers, stream=True, deadline=deadline, **kwargs)
+
+    resp = await (aio_hedged_call(name, request) if hedge else request())
+    try:
+        if resp.status == 304 and cached is not None:
+            _fetch_count(name, "not_modified")
+            return cached[3]
+        buf = await aio_read_streamed(resp, scan, max_bytes, name, deadline)
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+    finally:
+        resp.release()
+    return _conditional_settle(name, cached, buf, etag, last_modified, scan)
 
-        msg = upd.get("message") or {}
-        text = msg.get("text") or ""
-        if not text:
-            continue
 
-        try:
-            # remember admin private chat id
-            if is_private_chat(msg) and is_admin_msg(msg):
-                with STATE_LOCK:
-                    stx = load_state()
-                    stx["admin_private_chat_id"] = int((msg.get("chat") or {}).get("id") or 0)
-                    save_state(stx)
-                try:
-                    setup_commands_visibility()
-                except Exception:
-                    pass
+async def kick_fetch_async(deadline: Deadline | None = None, ch=None) -> PlatformSnapshot:
+    return await fetch_conditional_async(**_kick_request(ch or MAIN_CHANNEL), deadline=deadline)
 
-            chat = msg.get("chat") or {}
-            chat_id = chat.get("id")
-            if not isinstance(chat_id, int):
-                continue
 
-            thread_id = msg.get("message_thread_id")
-            thread_id = int(thread_id) if isinstance(thread_id, int) else None
+async def vk_fetch_best_effort_async(deadline: Deadline | None = None, ch=None) -> PlatformSnapshot:
+    ch = ch or MAIN_CHANNEL
+    if _vk_json_due(ch):
+        try:
+            snap = await fetch_conditional_async(**_vk_api_request(ch), deadline=deadline)
+            _vk_json_result(ch, None)
+            return snap
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            _vk_json_result(ch, e)
+    return await fetch_conditional_async(**_vk_html_request(ch), deadline=deadline)
+
+
+async def fetch_platforms_async(where: str = "tick", platforms=("kick", "vk"), deadline: Deadline | None = None, ch=None) -> tuple[PlatformSnapshot, PlatformSnapshot]:
+    """fetch_platforms() on the event loop: the two requests run concurrently without fetch threads."""
+    ch = ch or MAIN_CHANNEL
+    t0 = time.monotonic()
+    fd = deadline.child(FETCH_DEADLINE_SEC) if deadline is not None else Deadline(FETCH_DEADLINE_SEC)
+    kick_res, vk_res = await asyncio.gather(
+        _aio_timed(lambda: kick_fetch_async(fd, ch)) if "kick" in platforms else _aio_nothing(),
+        _aio_timed(lambda: vk_fetch_best_effort_async(fd, ch)) if "vk" in platforms else _aio_nothing(),
+    )
+    return _fetch_settle(where, ch, t0, kick_res, vk_res)
 
-            reply_to = msg.get("message_id")
-            reply_to = int(reply_to) if isinstance(reply_to, int) else None
 
-            cmd = text.strip().split()[0].split("@")[0]
+async def tg_call_async(method: str, payload: dict, *, timeout=(5, 15), retries: int | None = None):
+    r = await aio_request_tg("POST", tg_api_url(method), json_body=payload, timeout=timeout, retries=retries)
+    return _tg_result(r)
 
-            if cmd in ADMIN_COMMANDS:
-                if not (is_private_chat(msg) and is_admin_msg(msg)):
-                    continue
-                if cmd == "/admin_reset_offset":
-                    with STATE_LOCK:
-                        stx = load_state()
-                        stx["updates_offset"] = 0
-                        save_state(stx)
-                    try:
-                        tg_send_to(chat_id, None, "OK: updates_offset сброшен в 0.", reply_to=reply_to)
-                    except Exception as e:
-                        log_line(f"send admin_reset_offset reply failed: {e}")
-                    continue
 
-                # /admin
-                with STATE_LOCK:
-                    stx = load_state()
-                try:
-                    wh = tg_get_webhook_info()
-                except Exception as e:
-                    wh = {"error": str(e)}
-                try:
-                    tg_send_to(chat_id, None, build_admin_diag_text(stx, wh), reply_to=reply_to)
-                except Exception as e:
-                    log_line(f"send /admin reply failed: {e}")
-                continue
+async def tg_get_updates_async(offset: int, timeout: int) -> list:
+    payload, http_timeout = _get_updates_request(offset, timeout)
+    return _get_updates_result(await aio_request_tg("POST", tg_api_url("getUpdates"), json_body=payload, timeout=http_timeout))
 
-            if not is_status_command(text):
-                continue
 
-            with STATE_LOCK:
-                stx = load_state()
-                stx["last_command_seen_ts"] = ts()
-                save_state(stx)
-            # Fetch current status (cache-first; avoids long waits on Kick/VK)
-            snap = _cache_get_snapshot()
-            if snap is not None:
-                st_cur, kick, vk, _age = snap
-            else:
-                try:
-                    kick = kick_fetch()
-                except Exception as e:
-                    kick = {"live": False, "title": None, "category": None, "viewers": None, "thumb": None, "created_at": None, "playback_url": None}
-                    log_line(f"Kick fetch (command) error: {e}")
+async def tg_drop_pending_updates_async() -> None:
+    try:
+        await tg_call_async("deleteWebhook", {"drop_pending_updates": True}, timeout=(5, 15))
+    except Exception as e:
+        log_line(f"tg_drop_pending_updates_safe failed: {e}")
 
-                try:
-                    vk = vk_fetch_best_effort()
-                except Exception as e:
-                    vk = {"live": False, "title": None, "category": None, "viewers": None, "thumb": None}
-                    log_line(f"VK fetch (command) error: {e}")
 
-                with STATE_LOCK:
-                    st_cur = load_state()
-                st_cur["any_live"] = bool(kick.get("live") or vk.get("live"))
-                st_cur["kick_live"] = bool(kick.get("live"))
-                st_cur["vk_live"] = bool(vk.get("live"))
-                if st_cur["any_live"]:
-                    set_started_at_from_kick(st_cur, kick)
-                    st_cur["end_streak"] = 0
-                st_cur["kick_title"] = kick.get("title")
-                st_cur["kick_cat"] = kick.get("category")
-                st_cur["vk_title"] = vk.get("title")
-                st_cur["vk_cat"] = vk.get("category")
-                st_cur["kick_viewers"] = kick.get("viewers")
-                st_cur["vk_viewers"] = vk.get("viewers")
-                save_state(st_cur)
+async def tg_send_chat_action_async(chat_id: int, thread_id: int | None, action: str) -> None:
+    try:
+        await tg_call_async("sendChatAction", _tg_payload(int(chat_id), thread_id, None, action=action), timeout=(5, 10), retries=1)
+    except Exception:
+        pass
 
-            if not (kick.get("live") or vk.get("live")):
-                try:
-                    tg_send_to(chat_id, thread_id, build_no_stream_text("Сейчас на канале Глад Валакас патока нет!"), reply_to=reply_to)
-                except Exception as e:
-                    log_line(f"send no-stream reply failed: {e}")
-            else:
-                try:
-                    send_status_with_screen_to("📌 Текущее состояние патока", st_cur, kick, vk, chat_id, thread_id, reply_to)
-                except Exception as e:
-                    # Do not kill polling loop on timeouts; log and continue.
-                    log_line(f"send_status_with_screen_to failed: {e}")
 
-        except Exception as e:
-            log_line(f"command processing error: {e}\n{traceback.format_exc()[:1200]}")
+async def tg_send_to_async(chat_id: int, thread_id: int | None, text: str, reply_to: int | None = None) -> int:
+    res = await tg_call_async("sendMessage", _tg_text_payload(chat_id, thread_id, text, reply_to), timeout=(5, 15))
+    return int(res["message_id"])
 
-    # Always advance offset even if sending failed; otherwise bot will re-process old commands.
-    if max_update_id is not None:
-        with STATE_LOCK:
-            st3 = load_state()
-            st3["updates_offset"] = int(max_update_id) + 1
-            save_state(st3)
+
+async def tg_send_photo_url_to_async(chat_id: int, thread_id: int | None, photo_url: str, caption: str, reply_to: int | None = None) -> int:
+    res = await tg_call_async("sendPhoto", _tg_photo_payload(chat_id, thread_id, bust(photo_url), caption, reply_to), timeout=(5, 25))
+    return int(res["message_id"])
 
 
-def commands_watchdog_forever():
-    while True:
+async def tg_send_photo_upload_to_async(chat_id: int, thread_id: int | None, image_bytes: bytes, caption: str, filename: str, reply_to: int | None = None) -> int:
+    """_tg_send_photo_bytes() on the event loop: by cached file_id if possible, upload otherwise."""
+    file_id = media_cache_get(image_bytes)
+    if file_id:
         try:
-            if not (COMMANDS_ENABLED and COMMANDS_WATCHDOG_ENABLED):
-                time.sleep(10)
-                continue
+            res = await tg_call_async("sendPhoto", _tg_photo_payload(chat_id, thread_id, file_id, caption, reply_to), timeout=(5, 25))
+            _media_count("reused")
+            return int(res["message_id"])
+        except Exception as e:
+            if _is_retryable(e):
+                raise
+            log_line(f"Cached file_id rejected, uploading again: {e}")
+            media_cache_drop(image_bytes)
 
-            with STATE_LOCK:
-                st = load_state()
-            last_poll = int(st.get("last_updates_poll_ts") or 0)
-            last_recover = int(st.get("last_commands_recover_ts") or 0)
-            now_ts = ts()
+    data = _tg_photo_payload(chat_id, thread_id, None, caption, reply_to)
+    r = await aio_request_tg("POST", tg_api_url("sendPhoto"), data=data, files={"photo": (filename, image_bytes)}, timeout=(10, 45))
+    return _tg_photo_uploaded(image_bytes, r.json())
 
-            if last_poll == 0:
-                time.sleep(10)
-                continue
 
-            silent = (now_ts - last_poll) >= COMMANDS_WATCHDOG_SILENCE_SEC
-            cooldown_ok = (now_ts - last_recover) >= COMMANDS_WATCHDOG_COOLDOWN_SEC
+async def tg_send_photo_best_to_async(chat_id: int, thread_id: int | None, photo_url: str, caption: str, reply_to: int | None = None) -> int:
+    try:
+        r = await aio_request_ext("GET", bust(photo_url) or photo_url, headers=HEADERS_IMAGE, timeout=25)
+        return await tg_send_photo_upload_to_async(chat_id, thread_id, r.content, caption, f"thumb_{ts()}.jpg", reply_to)
+    except Exception as e:
+        log_line(f"Photo upload fallback to URL. Reason: {e}")
+        return await tg_send_photo_url_to_async(chat_id, thread_id, photo_url, caption, reply_to)
 
-            if silent and cooldown_ok:
-                notify_admin_dedup("watchdog_triggered", "⚠️ Watchdog: getUpdates давно не отрабатывал, делаю восстановление...")
-                tg_drop_pending_updates_safe()
 
-                with STATE_LOCK:
-                    st2 = load_state()
-                    st2["updates_offset"] = 0
-                    st2["last_commands_recover_ts"] = now_ts
-                    save_state(st2)
+async def _aio_run(cmd: list, timeout: float) -> tuple[int, bytes]:
+    p = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        out, _err = await asyncio.wait_for(p.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        try:
+            p.kill()
+        except ProcessLookupError:
+            pass
+        await p.wait()
+        raise
+    return p.returncode, out
 
-                if COMMANDS_WATCHDOG_PING_ENABLED:
-                    notify_admin_dedup("watchdog_recovered", "✅ Watchdog: восстановил polling команд.")
 
-        except Exception as e:
-            log_line(f"commands_watchdog error: {e}\n{traceback.format_exc()[:1200]}")
+async def ffmpeg_available_async() -> bool:
+    try:
+        code, _out = await _aio_run([FFMPEG_BIN, "-version"], 5)
+        return code == 0
+    except Exception:
+        return False
 
-        time.sleep(10)
 
+async def screenshot_from_m3u8_async(playback_url: str, timeout: float) -> bytes | None:
+    """screenshot_from_m3u8() as a subprocess of the event loop: no thread waits for ffmpeg."""
+    if not FFMPEG_ENABLED or not playback_url or not await ffmpeg_available_async():
+        return None
+    try:
+        code, out = await _aio_run(ffmpeg_screenshot_cmd(playback_url), timeout)
+    except Exception:
+        return None
+    return out if code == 0 and out else None
 
-# ========== MAIN LOOP ==========
 
-def main_loop_forever():
-    while True:
+async def send_status_with_screen_to_async(prefix: str, st: dict, kick: dict, vk: dict, chat_id: int, thread_id: int | None, reply_to: int | None, ch=None, fan: FanOut | None = None) -> str:
+    """send_status_with_screen_to() on the event loop (the PUBG duplicate still goes on FANOUT_POOL)."""
+    caption = build_caption(prefix, st, kick, vk, ch)
+    fan = fan or FanOut("status")
+    fan.send([pubg_leg(caption, kick, ch)])
+
+    await tg_send_chat_action_async(chat_id, thread_id, "upload_photo")
+
+    shot = None
+    if kick.get("live"):
+        cached = _shot_cache_get(ch)
+        if cached:
+            shot = cached[0]
+        else:
+            shot = await screenshot_from_m3u8_async(kick.get("playback_url"), FFMPEG_TIMEOUT_SEC)
+            if shot:
+                _shot_cache_set(shot, ch)
+    if shot:
+        await tg_send_photo_upload_to_async(chat_id, thread_id, shot, caption, f"kick_live_{ts()}.jpg", reply_to)
+        return "photo"
+    for snap in (kick, vk):
+        if snap.get("live") and snap.get("thumb"):
+            await tg_send_photo_best_to_async(chat_id, thread_id, snap["thumb"], caption, reply_to)
+            return "photo"
+    await tg_send_to_async(chat_id, thread_id, caption, reply_to=reply_to)
+    return "text"
+
+
+async def handle_update_async(upd: dict) -> None:
+    """handle_update() with the replies awaited on the loop; the state/SQLite part runs in the executor.
+    A reply without a coroutine (setMyCommands) goes to the outbound queue. Never raises."""
+    replies = []
+
+    def reply(name, chat_id, fn, afn=None):
+        replies.append((name, chat_id, fn, afn))
+
+    await asyncio.get_running_loop().run_in_executor(None, handle_update, upd, reply)
+    for name, chat_id, fn, afn in replies:
+        if afn is None:
+            tg_reply(name, chat_id, fn)
+            continue
         try:
-            main_loop()
+            await afn()
         except Exception as e:
-            notify_admin_dedup("main_loop_crash", f"main_loop crashed: {e}\n{traceback.format_exc()[:1500]}")
-            time.sleep(LOOP_CRASH_SLEEP)
+            log_line(f"{name} failed: {e}")
 
 
-def main_loop():
-    # init fetch
+async def _handle_update_in_chat(upd: dict, sem: asyncio.Semaphore) -> None:
+    chat_id = ((upd.get("message") or {}).get("chat") or {}).get("id")
+    entry = _ASYNC_CHAT_LOCKS.get(chat_id)
+    if entry is None:
+        entry = _ASYNC_CHAT_LOCKS[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
     try:
-        kick0 = kick_fetch()
-    except Exception as e:
-        kick0 = {"live": False, "title": None, "category": None, "viewers": None, "thumb": None, "created_at": None, "playback_url": None}
-        log_line(f"Kick init fetch error: {e}")
+        async with entry[0], sem:
+            await handle_update_async(upd)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _ASYNC_CHAT_LOCKS.pop(chat_id, None)
+
+
+def dispatch_update_async(upd: dict, sem: asyncio.Semaphore) -> asyncio.Task:
+    """Handle upd as a task of its own: other chats don't wait for it, later commands of its chat do."""
+    task = asyncio.create_task(_handle_update_in_chat(upd, sem))
+    _ASYNC_TASKS.add(task)
+    task.add_done_callback(_ASYNC_TASKS.discard)
+    return task
+
+
+async def commands_poll_async(sem: asyncio.Semaphore) -> None:
+    """commands_loop_once() on the loop: the next long-poll starts while the handlers still run."""
+    offset = int(state_view().get("updates_offset") or 0)
 
     try:
-        vk0 = vk_fetch_best_effort()
+        updates = await tg_get_updates_async(offset=offset, timeout=COMMAND_POLL_TIMEOUT)
     except Exception as e:
-        vk0 = {"live": False, "title": None, "category": None, "viewers": None, "thumb": None}
-        log_line(f"VK init fetch error: {e}")
-
-    any_live0 = bool(kick0.get("live") or vk0.get("live"))
+        log_line(f"getUpdates failed: {e}")
+        await asyncio.sleep(1)
+        return
 
-    with STATE_LOCK:
-        st = load_state()
-        st["any_live"] = any_live0
-        st["kick_live"] = bool(kick0.get("live"))
-        st["vk_live"] = bool(vk0.get("live"))
-        if any_live0:
-            set_started_at_from_kick(st, kick0)
-            st["end_streak"] = 0
-        st["kick_title"] = kick0.get("title")
-        st["kick_cat"] = kick0.get("category")
-        st["vk_title"] = vk0.get("title")
-        st["vk_cat"] = vk0.get("category")
-        st["kick_viewers"] = kick0.get("viewers")
-        st["vk_viewers"] = vk0.get("viewers")
-        stats_tick(st, kick0, vk0, any_live0, now_ts=ts())
-        save_state(st)
+    mark_updates_polled()
 
-    # startup ping
-    with STATE_LOCK:
-        st = load_state()
-        ping_sent = bool(st.get("startup_ping_sent"))
-    if not ping_sent:
-        try:
-            with STATE_LOCK:
-                st = load_state()
-            tg_send("✅ StreamAlertValakas запущен (ping).\n" + fmt_running_line(st))
-            with STATE_LOCK:
-                st = load_state()
-                st["startup_ping_sent"] = True
-                save_state(st)
-        except Exception as e:
-            log_line(f"Startup ping failed: {e}")
+    max_update_id = None
 
-    # no-stream on start
-    if NO_STREAM_ON_START_MESSAGE and (not any_live0):
-        with STATE_LOCK:
-            st = load_state()
-            last_ts = int(st.get("last_no_stream_start_ts") or 0)
-        if ts() - last_ts >= NO_STREAM_START_DEDUP_SEC:
-            try:
-                tg_send(build_no_stream_text("Сейчас на канале Глад Валакас патока нет!"))
-            except Exception as e:
-                log_line(f"No-stream-on-start send error: {e}")
-            with STATE_LOCK:
-                st = load_state()
-                st["last_no_stream_start_ts"] = ts()
-                save_state(st)
+    for upd in updates:
+        uid = upd.get("update_id")
+        if isinstance(uid, int):
+            max_update_id = uid if (max_update_id is None or uid > max_update_id) else max_update_id
+        dispatch_update_async(upd, sem)
 
-    # boot status
-    if BOOT_STATUS_ENABLED and any_live0:
-        try:
-            with STATE_LOCK:
-                st = load_state()
-                can_send = ts() - int(st.get("last_boot_status_ts") or 0) >= BOOT_STATUS_DEDUP_SEC
-            if can_send:
-                with STATE_LOCK:
-                    st = load_state()
-                send_status_with_screen("ℹ️ Паток уже идёт (после рестарта)", st, kick0, vk0)
-                with STATE_LOCK:
-                    st = load_state()
-                    st["last_boot_status_ts"] = ts()
-                    save_state(st)
-        except Exception as e:
-            log_line(f"Boot status send error: {e}")
+    advance_updates_offset(max_update_id)
 
-    cleanup_counter = 0
 
+async def commands_loop_async() -> None:
+    sem = asyncio.Semaphore(max(1, ASYNC_MAX_INFLIGHT))
     while True:
         try:
-            kick = kick_fetch()
+            await commands_poll_async(sem)
         except Exception as e:
-            kick = {"live": False, "title": None, "category": None, "viewers": None, "thumb": None, "created_at": None, "playback_url": None}
-            log_line(f"Kick fetch error: {e}")
+            if is_telegram_conflict_409(e):
+                notify_409_dedup("⚠️ Telegram 409 Conflict (getUpdates): есть другой polling на этом токене. Проверь, не запущено ли где-то ещё.")
+                await asyncio.sleep(10)
+                continue
+            log_line(f"commands_loop_async error: {e}\n{traceback.format_exc()[:1500]}")
+            await asyncio.sleep(LOOP_CRASH_SLEEP)
+
 
+async def commands_watchdog_async() -> None:
+    while True:
         try:
-            vk = vk_fetch_best_effort()
+            now_ts = commands_watchdog_due()
+            if now_ts is not None:
+                await tg_drop_pending_updates_async()
+                commands_watchdog_recovered(now_ts)
         except Exception as e:
-            vk = {"live": False, "title": None, "category": None, "viewers": None, "thumb": None}
-            log_line(f"VK fetch error: {e}")
-
-        with STATE_LOCK:
-            st = load_state()
-            prev_any = bool(st.get("any_live"))
-            prev_end_streak = int(st.get("end_streak") or 0)
-
-        any_live = bool(kick.get("live") or vk.get("live"))
-
-        # START
-        if (not prev_any) and any_live:
-            with STATE_LOCK:
-                st = load_state()
-                last = int(st.get("last_start_sent_ts") or 0)
-            if ts() - last >= START_DEDUP_SEC:
-                with STATE_LOCK:
-                    st_start = load_state()
-                    # New stream session: force sync from Kick so start time/duration won't stick.
-                    reset_stream_session(st_start)
-                    set_started_at_from_kick(st_start, kick, force=True)
-                    save_state(st_start)
-                try:
-                    with STATE_LOCK:
-                        st = load_state()
-                    send_status_with_screen("🚨🚨 🧩 Глад Валакас запустил паток! 🚨🚨", st, kick, vk)
-                    with STATE_LOCK:
-                        st = load_state()
-                        st["last_start_sent_ts"] = ts()
-                        save_state(st)
-                except Exception as e:
-                    log_line(f"Start send error: {e}")
-
-        # CHANGE
+            log_line(f"commands_watchdog error: {e}\n{traceback.format_exc()[:1200]}")
 
-        kick_title_changed = False
+        await asyncio.sleep(10)
 
-        kick_cat_changed = False
 
-        vk_title_changed = False
+async def channel_tick_async(ch) -> None:
+    """channel_tick() with the fetch on the loop; the rest of the tick runs in the executor."""
+    deadline = Deadline(TICK_DEADLINE_SEC)
+    tick_t0 = time.monotonic()
+    polled = poll_due_platforms(ch)
+    kick, vk = await fetch_platforms_async("tick", polled, deadline, ch)
+    await asyncio.get_running_loop().run_in_executor(None, channel_apply, ch, polled, kick, vk, deadline, tick_t0)
 
-        vk_cat_changed = False
 
+async def poll_wake_async(timeout: float) -> None:
+    """POLL_WAKE.wait(timeout) without holding a thread (the Kick push threads set the event)."""
+    end = time.monotonic() + timeout
+    while not POLL_WAKE.is_set():
+        left = end - time.monotonic()
+        if left <= 0:
+            return
+        await asyncio.sleep(min(left, 0.25))
 
-        with STATE_LOCK:
 
-            st = load_state()
+async def main_loop_async() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, main_loop_init)
 
-            if kick.get("live"):
+            cleanup_counter = 0
 
-                kick_title_changed = (kick.get("title") != st.get("kick_title"))
+            while True:
+                POLL_WAKE.clear()
+                due = [ch for ch in CHANNELS if poll_due_platforms(ch)]
+                errors = await asyncio.gather(*(channel_tick_async(ch) for ch in due), return_exceptions=True)
+                _raise_channel_errors("tick", zip(due, errors))
+                cleanup_counter = await loop.run_in_executor(None, main_loop_housekeeping, cleanup_counter)
+                await poll_wake_async(poll_sleep_sec())
+        except Exception as e:
+            _flush_state_on_exit()
+            notify_admin_dedup("main_loop_crash", f"main_loop crashed: {e}\n{traceback.format_exc()[:1500]}")
+            await asyncio.sleep(LOOP_CRASH_SLEEP)
 
-                kick_cat_changed = (kick.get("category") != st.get("kick_cat"))
 
-            if vk.get("live"):
+async def screenshot_refresher_async() -> None:
+    while True:
+        for ch in CHANNELS:
+            try:
+                url = _shot_refresh_url(ch)
+                if url is not None:
+                    img = await screenshot_from_m3u8_async(url, min(int(FFMPEG_TIMEOUT_SEC), int(FFMPEG_CMD_TIMEOUT_SEC)))
+                    if img:
+                        _shot_cache_set(img, ch)
+            except Exception as e:
+                log_line(f"[shot] refresh failed [{ch.id}]: {e}")
+        await asyncio.sleep(shot_refresh_due())
 
-                vk_title_changed = (vk.get("title") != st.get("vk_title"))
 
-                vk_cat_changed = (vk.get("category") != st.get("vk_cat"))
+async def async_runtime_main() -> None:
+    global _AIO_SESSION
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max(2, ASYNC_EXECUTOR_WORKERS), thread_name_prefix="async"))
+    _AIO_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max(1, ASYNC_MAX_INFLIGHT)))
+    log_line(f"[cfg] ASYNC_RUNTIME=1 inflight={ASYNC_MAX_INFLIGHT} executor={ASYNC_EXECUTOR_WORKERS}")
 
+    tasks = [main_loop_async()]
+    if COMMANDS_ENABLED:
+        tasks += [commands_loop_async(), commands_watchdog_async()]
+    if SHOT_REFRESH_ENABLED:
+        tasks.append(screenshot_refresher_async())
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await _AIO_SESSION.close()
+        _AIO_SESSION = None
+
+# ========== STATE MICRO-BENCHMARK ==========
+# python bot.py --bench-state [iterations]
+
+def _bench_sample_state() -> BotState:
+    st = default_state()
+    st.started_at = now_utc().isoformat()
+    t0 = ts()
+    for i in range(240):
+        kick = PlatformSnapshot(live=True, title=f"title {i // 20}", category=f"cat {i // 40}", viewers=1000 + i)
+        vk = PlatformSnapshot(live=i % 3 != 0, title=f"vk title {i // 30}", category="cat", viewers=200 + i)
+        stats_tick(st, kick, vk, True, now_ts=t0 + i * POLL_INTERVAL)
+    return st
+
+
+def _bench(fn, iterations: int) -> tuple[float, int]:
+    """Mean microseconds per call and peak bytes allocated by one call."""
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    per_call_us = (time.perf_counter() - t0) * 1e6 / iterations
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return per_call_us, peak
 
-        changed = (kick_title_changed or kick_cat_changed or vk_title_changed or vk_cat_changed)
 
+def bench_state(iterations: int = 2000) -> None:
+    st = _bench_sample_state()
+    d = st.to_dict()
+    raw_json = json.dumps(d, ensure_ascii=False, separators=(",", ":"))
 
-        if any_live and prev_any and changed:
-            with STATE_LOCK:
-                st = load_state()
-                last = int(st.get("last_change_sent_ts") or 0)
-            if ts() - last >= CHANGE_DEDUP_SEC:
-                try:
-                    with STATE_LOCK:
-                        st = load_state()
-                    caption = build_change_caption(st, kick, vk, kick_title_changed, kick_cat_changed, vk_title_changed, vk_cat_changed)
-                    send_caption_with_screen(caption, st, kick, vk)
-                    with STATE_LOCK:
-                        st = load_state()
-                        st["last_change_sent_ts"] = ts()
-                        save_state(st)
-                except Exception as e:
-                    log_line(f"Change send error: {e}")
-
-        # END (once per started_at)
-        should_send_end = False
-        with STATE_LOCK:
-            st_chk = load_state()
-            cur_started = st_chk.get("started_at")
-            already_for = st_chk.get("end_sent_for_started_at")
-            confirmed_off = (not any_live) and ((prev_end_streak + 1) >= END_CONFIRM_STREAK)
-            if confirmed_off and cur_started and (already_for != cur_started):
-                should_send_end = True
-
-        if should_send_end:
-            try:
-                with STATE_LOCK:
-                    st_end = load_state()
-                    # Finalize stats up to now (counts the last interval)
-                    stats_tick(st_end, kick, vk, any_live=False, now_ts=ts())
-                    stats_finalize_end(st_end, now_ts=ts())
-                    st_end["kick_viewers"] = st_end.get("kick_viewers") or kick.get("viewers")
-                    st_end["vk_viewers"] = st_end.get("vk_viewers") or vk.get("viewers")
-                    st_end["end_sent_for_started_at"] = st_end.get("started_at")
-                    st_end["end_sent_ts"] = ts()
-                end_text = build_end_text(st_end)
-                tg_send_main_and_maybe_pubg(end_text, st_end, kick)
-                # Now it is safe to clear started_at to avoid stale session id staying forever.
-                with STATE_LOCK:
-                    st_end2 = load_state()
-                    st_end2["started_at"] = None
-                    save_state(st_end2)
-            except Exception as e:
-                log_line(f"End send error: {e}")
-
-        # SAVE NEW STATE
-        with STATE_LOCK:
-            st = load_state()
-            st["any_live"] = any_live
-            st["kick_live"] = bool(kick.get("live"))
-            st["vk_live"] = bool(vk.get("live"))
-            if any_live:
-                set_started_at_from_kick(st, kick)
-                st["end_streak"] = 0
-            else:
-                # Do not clear started_at yet — it is required for sending the final end report.
-                # started_at will be reset when a new stream session starts (Kick created_at sync) or after end-report is sent.
-                st["end_streak"] = prev_end_streak + 1
-            st["kick_title"] = kick.get("title")
-            st["kick_cat"] = kick.get("category")
-            st["vk_title"] = vk.get("title")
-            st["vk_cat"] = vk.get("category")
-            st["kick_viewers"] = kick.get("viewers")
-            st["vk_viewers"] = vk.get("viewers")
-            stats_tick(st, kick, vk, any_live, now_ts=ts())
-            save_state(st)
-        try:
-            _cache_set_snapshot(st, kick, vk)
-        except Exception:
-            pass
+    rows = []
 
-        # Periodic cleanup + quota monitor
-        cleanup_counter += 1
-        if cleanup_counter >= DISK_CHECK_INTERVAL:
-            cleanup_temp_files()
-            cleanup_old_state_backups()
+    # Old dict-based tick: ~12 load_state() parses, ~4 save_state() encodes, dict() copies for the cache.
+    def legacy_tick():
+        for _ in range(12):
+            cur = default_state().to_dict()
+            cur.update(json.loads(raw_json))
+        for _ in range(4):
+            json.dumps(cur, ensure_ascii=False, separators=(",", ":"))
+        dict(cur)
 
-            q_percent, q_used, q_total = quota_usage_for_bot()
-            with STATE_LOCK:
-                stq = load_state()
-                last_nt = int(stq.get("last_quota_notify_ts") or 0)
-            cooldown_ok = (ts() - last_nt) >= BOT_NOTIFY_COOLDOWN_SEC
-
-            if q_percent >= BOT_WARN_PERCENT and cooldown_ok:
-                top = list_largest_files(os.getcwd(), BOT_TOP_FILES)
-                top_text = ""
-                if top:
-                    top_lines = "\n".join([f"- {fmt_bytes(sz)} — {path}" for sz, path in top])
-                    top_text = "\n\nТоп файлов по размеру:\n" + top_lines
-
-                notify_admin_dedup(
-                    "quota_high",
-                    "⚠️ Квота диска почти заполнена (по размеру папки бота).\n"
-                    f"Занято ботом: {fmt_bytes(q_used)} из {fmt_bytes(q_total)} ({q_percent:.1f}%)."
-                    + top_text
-                    + "\n\nОчищаю temp/__pycache__…",
-                )
-                cleanup_pycache()
-                cleanup_temp_files()
-                cleanup_old_state_backups()
+    rows.append(("dict: encode (json)", *_bench(lambda: json.dumps(d, ensure_ascii=False, separators=(",", ":")), iterations)))
+    rows.append(("dict: decode (json)", *_bench(lambda: json.loads(raw_json), iterations)))
+    rows.append(("dict: tick (12 loads, 4 saves)", *_bench(legacy_tick, iterations)))
 
-                with STATE_LOCK:
-                    stq = load_state()
-                    stq["last_quota_notify_ts"] = ts()
-                    save_state(stq)
+    for kind in ("json", "orjson", "msgpack"):
+        if kind == "orjson" and orjson is None:
+            continue
+        if kind == "msgpack" and msgpack is None:
+            continue
+        raw = state_dumps(st.to_dict(), kind)
+        rows.append((f"typed: encode ({kind})", *_bench(lambda k=kind: state_dumps(st.to_dict(), k), iterations)))
+        rows.append((f"typed: decode ({kind})", *_bench(lambda r=raw: BotState.from_dict(state_loads(r)), iterations)))
 
-            cleanup_counter = 0
+    # Same tick on the typed in-memory state: loads are shallow copies (plus one copy-on-write of
+    # stream_stats), and each of the 4 saves still encodes the whole state like the dict flow did.
+    def typed_tick(kind):
+        for _ in range(12):
+            cur = st.copy()
+        cur.stream_stats = _copy_tree(cur.stream_stats)
+        for _ in range(4):
+            state_dumps(cur.to_dict(), kind)
+        cur.copy()
 
-        time.sleep(POLL_INTERVAL)
+    rows.append(("typed: tick (12 loads, 4 saves, json)", *_bench(lambda: typed_tick("json"), iterations)))
+    if _state_serializer() != "json":
+        kind = _state_serializer()
+        rows.append((f"typed: tick (12 loads, 4 saves, {kind})", *_bench(lambda: typed_tick(kind), iterations)))
 
+    print(f"state size: {len(raw_json)} bytes json, serializer={_state_serializer()}, iterations={iterations}")
+    print(f"{'case':<40} {'us/call':>10} {'peak alloc':>12}")
+    for name, us, peak in rows:
+        print(f"{name:<40} {us:>10.1f} {fmt_bytes(peak):>12}")
 
 
+def _handle_sigterm(signum, frame) -> None:
+    # Turn SIGTERM into a normal exit so the final state flush runs.
+    raise SystemExit(0)
 
-def screenshot_refresher_forever() -> None:
-    # Refresh a real screenshot in RAM while Kick is live.
-    while True:
-        try:
-            snap = _cache_get_snapshot()
-            if snap is None:
-                time.sleep(2)
-                continue
-            _st, kick, _vk, _age = snap
-            if not kick.get("live"):
-                time.sleep(max(2, int(SHOT_REFRESH_SEC)))
-                continue
-            if _shot_cache_get() is not None:
-                time.sleep(max(2, int(SHOT_REFRESH_SEC)))
-                continue
-            img = screenshot_from_m3u8_fast(kick.get("playback_url"))
-            if img:
-                _shot_cache_set(img)
-            time.sleep(max(2, int(SHOT_REFRESH_SEC)))
-        except Exception:
-            time.sleep(3)
 
 def main():
     log_line(f"[cfg] COMMAND_POLL_TIMEOUT={COMMAND_POLL_TIMEOUT} COMMAND_HTTP_TIMEOUT={COMMAND_HTTP_TIMEOUT}")
 
+    atexit.register(_flush_state_on_exit)
+    atexit.register(outbox_drain_on_exit)  # runs first (LIFO): alerts still queued go out before exit
+    try:
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+    except Exception:
+        pass
+    threading.Thread(target=state_flusher_forever, daemon=True).start()
+
     cleanup_temp_files()
     cleanup_old_state_backups()
 
@@ -2200,6 +6195,21 @@ def main():
     except Exception as e:
         log_line(f"Setup commands visibility failed: {e}")
 
+    start_kick_push()
+    if HTTP_KEEPALIVE_SEC > 0:
+        threading.Thread(target=http_keepalive_forever, daemon=True).start()
+    if HTTP2_ENABLED and httpx is None:
+        log_line("HTTP2_ENABLED=1 but httpx is not installed; using HTTP/1.1")
+
+    if ASYNC_RUNTIME and aiohttp is None:
+        log_line("ASYNC_RUNTIME=1 but aiohttp is not installed; using the threaded runtime")
+    elif ASYNC_RUNTIME:
+        asyncio.run(async_runtime_main())
+        return
+
+    if SHOT_REFRESH_ENABLED:
+        threading.Thread(target=screenshot_refresher_forever, daemon=True, name="shot-refresh").start()
+
     if COMMANDS_ENABLED:
         threading.Thread(target=commands_loop_forever, daemon=True).start()
         threading.Thread(target=commands_watchdog_forever, daemon=True).start()
@@ -2208,4 +6218,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "--bench-state":
+        bench_state(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    else:
+        main()
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# bot.py reads its configuration at import time: point every file it writes at a scratch directory.
+_TMP = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.update(
+    BOT_TOKEN="123:test",
+    GROUP_ID="-1001",
+    LOG_FILE=os.path.join(_TMP, "bot.log"),
+    STATE_FILE=os.path.join(_TMP, "state.json"),
+    HISTORY_DB_FILE=os.path.join(_TMP, "history.db"),
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,86 @@
+import json
+import threading
+
+import pytest
+import requests
+
+import bot
+
+STARTED = "2026-10-17T10:00:00+00:00"
+
+
+class FakeTelegram:
+    """transport_request stand-in: records sent texts; can fail with 400 or hold sends until released."""
+
+    def __init__(self):
+        self.texts = []
+        self.fail = 0  # next N sends answer 400 (not retryable)
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, session, method, url, **kw):
+        self.gate.wait(5)
+        body = kw.get("json") or {}
+        r = requests.Response()
+        r.url = url
+        if self.fail > 0:
+            self.fail -= 1
+            r.status_code = 400
+            r._content = json.dumps({"ok": False, "description": "Bad Request: chat not found"}).encode()
+            return r
+        self.texts.append(body.get("text") or body.get("caption") or "")
+        r.status_code = 200
+        r._content = json.dumps({"ok": True, "result": {"message_id": len(self.texts)}}).encode()
+        return r
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(bot, "transport_request", fake)
+    monkeypatch.setattr(bot, "kick_fetch", lambda deadline=None, ch=None: bot.PlatformSnapshot(live=False))
+    monkeypatch.setattr(bot, "vk_fetch_best_effort", lambda deadline=None, ch=None: bot.PlatformSnapshot(live=False))
+    monkeypatch.setattr(bot, "END_CONFIRM_MIN_SEC", 0)
+    monkeypatch.setattr(bot, "HISTORY_ENABLED", False)
+    monkeypatch.setattr(bot, "OUTBOX_ENABLED", True)
+    monkeypatch.setattr(bot, "OUTBOX", bot.Outbox(1))
+    bot._POLL_NEXT_DUE.clear()
+    bot._END_IN_FLIGHT.clear()
+    with bot.STATE_LOCK:
+        st = bot.load_state()
+        for k, v in dict(any_live=False, kick_live=False, vk_live=False, started_at=STARTED, end_streak=5, end_sent_for_started_at=None).items():
+            st[k] = v
+        bot.save_state(st)
+    return fake
+
+
+def tick():
+    bot._POLL_NEXT_DUE.clear()  # both platforms due
+    bot.channel_tick(bot.MAIN_CHANNEL)
+
+
+def test_started_at_stays_until_the_end_report_is_out(offline):
+    offline.gate.clear()  # Telegram is slow: the report sits in the outbox
+    tick()
+    tick()  # a second tick must not queue the report again
+    assert bot.state_view().get("started_at") == STARTED
+    assert bot.OUTBOX.stats()["pending"] == 1
+    offline.gate.set()
+    assert bot.OUTBOX.drain(5)
+    assert len(offline.texts) == 1
+    st = bot.state_view()
+    assert st.get("started_at") is None and st.get("end_sent_for_started_at") == STARTED
+
+
+def test_dropped_end_report_is_queued_again_next_tick(offline):
+    offline.fail = 100
+    tick()
+    assert bot.OUTBOX.drain(5)
+    assert bot.OUTBOX.stats()["dropped"] == 1 and offline.texts == []
+    offline.fail = 0
+    assert bot.state_view().get("started_at") == STARTED  # the session is still open: END is owed
+
+    tick()
+    assert bot.OUTBOX.drain(5)
+    assert len(offline.texts) == 1
+    assert bot.state_view().get("started_at") is None
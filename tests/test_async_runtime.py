@@ -0,0 +1,115 @@
+import asyncio
+import json
+import re
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bot
+
+aiohttp = pytest.importorskip("aiohttp")
+
+KICK_BODY = json.dumps(
+    {"livestream": {"is_live": True, "session_title": "t", "viewer_count": 10, "categories": [{"name": "IRL"}]}, "playback_url": "https://x/m3u8"}
+).encode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Kick: the JSON above with an ETag. Telegram: ok for every method, sendPhoto to -1001 is slow."""
+
+    photos = []  # (chat_id, monotonic time the answer went out)
+
+    def log_message(self, *a):
+        pass
+
+    def _send(self, code: int, body: bytes = b"", headers=()):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"v1"':
+            return self._send(304)
+        self._send(200, KICK_BODY, [("ETag", '"v1"'), ("Content-Type", "application/json")])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        api = self.path.rsplit("/", 1)[-1]
+        result = True
+        if api == "sendPhoto":
+            m = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body) or re.search(rb'"chat_id": ?(-?\d+)', body)
+            chat_id = int(m.group(1))
+            if chat_id == -1001:
+                time.sleep(1)  # a slow upload
+            result = {"message_id": 1, "photo": [{"file_id": f"id{chat_id}", "width": 1280}]}
+            type(self).photos.append((chat_id, time.monotonic()))
+        self._send(200, json.dumps({"ok": True, "result": result}).encode(), [("Content-Type", "application/json")])
+
+
+@pytest.fixture
+def server():
+    Handler.photos = []
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}"
+    srv.shutdown()
+
+
+def run(coro):
+    async def with_session():
+        bot._AIO_SESSION = aiohttp.ClientSession()
+        try:
+            return await coro
+        finally:
+            await bot._AIO_SESSION.close()
+            bot._AIO_SESSION = None
+
+    return asyncio.run(with_session())
+
+
+def test_async_fetch_matches_the_threaded_one(server):
+    url = f"{server}/api/v1/channels/x"
+    sync = bot.fetch_conditional("async-test-sync", url, bot.HEADERS_JSON, bot._KickScan(), bot.KICK_MAX_BYTES)
+
+    async def twice():
+        first = await bot.fetch_conditional_async("async-test", url, bot.HEADERS_JSON, bot._KickScan(), bot.KICK_MAX_BYTES)
+        return first, await bot.fetch_conditional_async("async-test", url, bot.HEADERS_JSON, bot._KickScan(), bot.KICK_MAX_BYTES)
+
+    first, second = run(twice())
+    assert first == sync and first.live and first.title == "t"
+    assert second is first  # 304: the cached snapshot
+    assert bot.fetch_cache_stats()["async-test"]["not_modified"] == 1
+
+
+def test_slow_upload_in_one_chat_does_not_hold_up_another(server, monkeypatch, tmp_path):
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text("#!/bin/sh\nprintf 'JPEG'\n")
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(bot, "FFMPEG_BIN", str(ffmpeg))
+    monkeypatch.setattr(bot, "tg_api_url", lambda method: f"{server}/bot/{method}")
+    monkeypatch.setattr(bot, "TG_RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(bot, "_SHOT_CACHE", {})
+    monkeypatch.setattr(bot, "_MEDIA_CACHE", {})
+    kick = bot.PlatformSnapshot(live=True, title="t", category="IRL", viewers=10, playback_url="https://x/m3u8")
+    bot._cache_set_snapshot(bot.state_view(), kick, bot.PlatformSnapshot(live=False))
+
+    def stream(n: int, chat_id: int) -> dict:
+        return {"update_id": n, "message": {"message_id": n, "chat": {"id": chat_id, "type": "supergroup"}, "text": "/stream"}}
+
+    async def both():
+        sem = asyncio.Semaphore(8)
+        slow = bot.dispatch_update_async(stream(1, -1001), sem)
+        await asyncio.sleep(0.2)  # -1001's upload is in flight
+        fast = bot.dispatch_update_async(stream(2, -1002), sem)
+        await asyncio.gather(slow, fast)
+
+    run(both())
+    chats = [chat_id for chat_id, _t in Handler.photos if chat_id in (-1001, -1002)]
+    assert chats == [-1002, -1001]
+    assert not bot._ASYNC_CHAT_LOCKS
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import bot
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    monkeypatch.setattr(bot, "OUTBOX_ENABLED", True)
+    monkeypatch.setattr(bot, "OUTBOX", bot.Outbox(1))
+    return bot.OUTBOX
+
+
+def test_duplicate_is_not_held_up_by_a_slow_main_leg(outbox):
+    # Same chat for both legs (PUBG_DUPLICATE_CHAT_ID defaults to GROUP_ID), main is a slow upload.
+    pubg_sent = threading.Event()
+    order = []
+
+    def main():
+        assert pubg_sent.wait(2), "the duplicate waited for the main leg"
+        order.append("main")
+        return 1
+
+    def pubg():
+        order.append("pubg")
+        pubg_sent.set()
+        return 2
+
+    fan = bot.FanOut("start")
+    t0 = time.monotonic()
+    res = fan.send([bot.FanLeg("pubg", -1001, pubg, primary=False), bot.FanLeg("main", -1001, main)])
+    assert time.monotonic() - t0 < 1
+    assert order == ["pubg", "main"] and res["main"] == 1
+    assert fan.results["pubg"] == 2 and outbox.stats()["queued"] == 0
+
+
+def test_failing_main_leg_does_not_delay_the_duplicate(outbox):
+    pubg_sent = threading.Event()
+
+    def main():
+        raise ConnectionError("upload failed")
+
+    fan = bot.FanOut("start")
+    with pytest.raises(ConnectionError):
+        fan.send([bot.FanLeg("pubg", -1001, lambda: pubg_sent.set() or 2, primary=False), bot.FanLeg("main", -1001, main)])
+    assert pubg_sent.wait(1)
+    # A retry of the whole alert resends only the main leg.
+    calls = []
+    fan.send([bot.FanLeg("pubg", -1001, lambda: calls.append("pubg"), primary=False), bot.FanLeg("main", -1001, lambda: calls.append("main"))])
+    assert calls == ["main"]
+
+
+def test_failed_duplicate_is_retried_through_the_outbox(outbox, monkeypatch):
+    monkeypatch.setattr(bot, "_backoff_delay", lambda *a, **k: 0.0)
+    attempts = []
+
+    def pubg():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise requests.exceptions.ConnectionError("reset by peer")
+        return 2
+
+    bot.FanOut("start").send([bot.FanLeg("pubg", -1001, pubg, primary=False)])
+    deadline = time.monotonic() + 2
+    while outbox.stats()["sent"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(attempts) == 2 and outbox.stats()["sent"] == 1
+
+
+
+
+def test_duplicate_result_is_written_under_the_lock(outbox):
+    gate, sent = threading.Event(), threading.Event()
+
+    def pubg():
+        gate.wait(1)
+        sent.set()
+        return 2
+
+    fan = bot.FanOut("start")
+    fan.send([bot.FanLeg("pubg", -1001, pubg, primary=False)])
+    with fan.lock:  # as send() holds it while it copies results
+        gate.set()
+        assert sent.wait(1)
+        time.sleep(0.05)
+        assert fan.results["pubg"] == "queued"  # the pool thread's write waits for the lock
+    deadline = time.monotonic() + 1
+    while fan.result("pubg") != 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fan.result("pubg") == 2
@@ -0,0 +1,38 @@
+import pytest
+import requests
+
+import bot
+
+
+@pytest.fixture
+def kick(monkeypatch):
+    script = []
+
+    def kick_fetch(deadline=None, ch=None):
+        step = script.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        return step
+
+    monkeypatch.setattr(bot, "kick_fetch", kick_fetch)
+    monkeypatch.setattr(bot, "vk_fetch_best_effort", lambda deadline=None, ch=None: bot.PlatformSnapshot(live=False))
+    monkeypatch.setattr(bot, "KICK_PUSH_ENABLED", False)
+    bot._LAST_FETCHED.clear()
+    return script
+
+
+def test_failed_fetch_is_what_the_next_skipped_tick_reuses(kick):
+    kick += [bot.PlatformSnapshot(live=True, title="on"), requests.exceptions.ConnectionError("reset")]
+    k, _vk = bot.fetch_platforms("tick", ("kick", "vk"))
+    assert k.live
+    k, _vk = bot.fetch_platforms("tick", ("kick", "vk"))  # the fetch fails: this tick reads offline
+    assert not k.live
+    k, _vk = bot.fetch_platforms("tick", ("vk",))  # Kick not due: must not go back to the old live snapshot
+    assert not k.live
+
+
+def test_skipped_platform_reuses_the_last_success(kick):
+    kick.append(bot.PlatformSnapshot(live=True, title="on"))
+    bot.fetch_platforms("tick", ("kick", "vk"))
+    k, _vk = bot.fetch_platforms("tick", ("vk",))
+    assert k.live and k.title == "on"
@@ -0,0 +1,38 @@
+import pytest
+import requests
+
+import bot
+
+
+class Body:
+    """Stands in for a stream=True response body: remembers whether the connection was released."""
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def release_conn(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize("status", [403, 404, 503])
+def test_failed_response_is_released_before_raising(monkeypatch, status):
+    bodies = []
+
+    def transport(session, method, url, **kw):
+        r = requests.Response()
+        r.url = url
+        r.status_code = status
+        r.raw = Body()
+        bodies.append(r.raw)
+        return r
+
+    monkeypatch.setattr(bot, "transport_request", transport)
+    monkeypatch.setattr(bot, "BREAKER_ENABLED", False)
+    monkeypatch.setattr(bot, "_sleep_backoff", lambda *a, **k: None)
+    with pytest.raises(requests.exceptions.HTTPError):
+        bot.http_request_ext("GET", "https://kick.example/api", stream=True, retries=2)
+    assert len(bodies) == (1 if status < 500 else 2)  # 4xx is final, 5xx is retried
+    assert all(b.closed for b in bodies)
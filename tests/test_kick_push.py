@@ -0,0 +1,180 @@
+import json
+import os
+from dataclasses import replace
+
+import pytest
+
+import bot
+
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "kick_pusher_frames.json"), encoding="utf-8") as f:
+    FRAMES = json.load(f)
+
+RECV_TIMEOUT = object()  # the stand-in raises a recv timeout here (no frame within KICK_PUSH_PING_SEC)
+
+
+class ReplaySocket:
+    """Local stand-in for the Kick websocket: replays recorded frames, then reports the socket closed.
+
+    Callables in the script run when recv() reaches them, so a test can check what a tick would see
+    between two frames.
+    """
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.sent = []
+        self.closed = False
+
+    def send(self, frame: str) -> None:
+        self.sent.append(json.loads(frame))
+
+    def recv(self) -> str:
+        while self.script:
+            item = self.script.pop(0)
+            if item is RECV_TIMEOUT:
+                raise TimeoutError("recv timed out")
+            if callable(item):
+                item()
+                continue
+            return item
+        return ""  # closed by the server
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class Connector:
+    """connect(url, timeout) for kick_push_session(): hands out one ReplaySocket per connection."""
+
+    def __init__(self, *scripts):
+        self.sockets = [ReplaySocket(s) for s in scripts]
+        self.opened = []
+
+    def __call__(self, url: str, timeout: float):
+        if len(self.opened) == len(self.sockets):
+            raise StopReplay()
+        ws = self.sockets[len(self.opened)]
+        self.opened.append((url, timeout))
+        return ws
+
+
+class StopReplay(BaseException):
+    """Ends kick_push_forever() (which retries every Exception) once the script is used up."""
+
+
+@pytest.fixture
+def ch(monkeypatch):
+    monkeypatch.setattr(bot, "KICK_PUSH_ENABLED", True)
+    bot._PUSH_HINTS.clear()
+    bot._PUSH_CONNECTED.clear()
+    bot._POLL_NEXT_DUE.clear()
+    bot.POLL_WAKE.clear()
+    ch = replace(bot.MAIN_CHANNEL, kick_channel_id=668)
+    bot._POLL_NEXT_DUE[bot.fetch_key(ch, "kick")] = float("inf")  # only a push makes the poll due
+    # The polled API still says offline / the old title: only the push can tell channel_tick otherwise.
+    monkeypatch.setattr(bot, "kick_fetch", lambda deadline=None, ch=None: bot.PlatformSnapshot(live=False))
+    monkeypatch.setattr(bot, "vk_fetch_best_effort", lambda deadline=None, ch=None: bot.PlatformSnapshot(live=False))
+    return ch
+
+
+def tick_view(ch):
+    """What channel_tick() gets from its fetch step, and whether the Kick poll was made due."""
+    due = "kick" in bot.poll_due_platforms(ch)
+    kick, _vk = bot.fetch_platforms("tick", ("kick", "vk"), ch=ch)
+    return kick, due
+
+
+def test_replayed_events_reach_channel_tick(ch):
+    seen = {}
+
+    def checkpoint(name):
+        def check():
+            seen[name] = tick_view(ch)
+            bot._POLL_NEXT_DUE[bot.fetch_key(ch, "kick")] = float("inf")  # as if the tick just polled
+            bot.POLL_WAKE.clear()
+        return check
+
+    def live_api(title):
+        # After the start the API catches up; updates and the stop are pushed ahead of it again.
+        return lambda: setattr(bot, "kick_fetch", lambda deadline=None, ch=None: bot.PlatformSnapshot(live=True, title=title, category="Just Chatting"))
+
+    connect = Connector([
+        FRAMES["connection_established"],
+        FRAMES["subscription_succeeded"],
+        FRAMES["chat_message"],
+        checkpoint("subscribed"),
+        FRAMES["streamer_is_live"],
+        checkpoint("start"),
+        live_api("Патока с утра"),
+        FRAMES["livestream_updated"],
+        checkpoint("update"),
+        live_api("Катаем в PUBG"),
+        FRAMES["stop_stream_broadcast"],
+        checkpoint("stop"),
+    ])
+    with pytest.raises(ConnectionError):
+        bot.kick_push_session(ch, connect)
+
+    ws = connect.sockets[0]
+    assert ws.sent[0] == {"event": "pusher:subscribe", "data": {"auth": "", "channel": "channel.668"}}
+    assert ws.closed
+
+    kick, due = seen["subscribed"]
+    assert not kick.live and not due
+
+    kick, due = seen["start"]
+    assert due and kick.live
+    assert kick.title == "Патока с утра"
+    assert kick.created_at == "2026-10-17T10:00:03.000000Z"
+
+    kick, due = seen["update"]
+    assert due and kick.live
+    assert (kick.title, kick.category) == ("Катаем в PUBG", "PUBG: Battlegrounds")
+
+    kick, due = seen["stop"]
+    assert due and not kick.live
+
+    assert bot.kick_push_stats()["start"] >= 1
+
+
+def test_ping_pong(ch):
+    connect = Connector([
+        FRAMES["subscription_succeeded"],
+        FRAMES["ping"],  # server ping: answered with a pong
+        RECV_TIMEOUT,  # quiet socket: the client pings
+        FRAMES["pong"],
+        RECV_TIMEOUT,
+        RECV_TIMEOUT,  # still nothing after our ping: the session gives up
+    ])
+    with pytest.raises(TimeoutError):
+        bot.kick_push_session(ch, connect)
+    events = [m["event"] for m in connect.sockets[0].sent]
+    assert events == ["pusher:subscribe", "pusher:pong", "pusher:ping", "pusher:ping"]
+
+
+def test_reconnect_after_drop_polls_and_resubscribes(ch, monkeypatch):
+    monkeypatch.setattr(bot, "_backoff_delay", lambda *a, **k: 0.0)
+    key = bot.fetch_key(ch, "kick")
+    after_drop = {}
+
+    def polled():
+        bot._POLL_NEXT_DUE[key] = float("inf")
+        bot.POLL_WAKE.clear()
+
+    def record_due():
+        after_drop["due"] = bot._POLL_NEXT_DUE.get(key)
+        after_drop["wake"] = bot.POLL_WAKE.is_set()
+
+    connect = Connector(
+        [FRAMES["subscription_succeeded"], FRAMES["streamer_is_live"], polled],  # then the socket drops
+        [record_due, FRAMES["subscription_succeeded"], FRAMES["stop_stream_broadcast"]],
+    )
+    with pytest.raises(StopReplay):
+        bot.kick_push_forever(ch, connect)
+
+    assert len(connect.opened) == 2
+    assert all(ws.sent[0]["event"] == "pusher:subscribe" for ws in connect.sockets)
+    # Events may have been missed while the socket was down: the Kick poll is due at once.
+    assert after_drop == {"due": 0.0, "wake": True}
+    assert key not in bot._PUSH_CONNECTED
+    kick, _due = tick_view(ch)
+    assert not kick.live
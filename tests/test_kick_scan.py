@@ -0,0 +1,46 @@
+import json
+
+import bot
+
+
+def scan(body: bytes, chunk: int = 7):
+    """Feed body the way read_streamed() does; return (snapshot, bytes read when the scan was done)."""
+    s = bot._KickScan()
+    buf = bytearray()
+    for i in range(0, len(body), chunk):
+        buf += body[i : i + chunk]
+        if s.feed(buf):
+            break
+    return s.result(buf), len(buf)
+
+
+def doc(**top) -> bytes:
+    return json.dumps(top, ensure_ascii=False).encode()
+
+
+def test_only_top_level_keys_match():
+    body = doc(
+        user={"bio": 'say "livestream": {"is_live": true} \\o/', "livestream": {"is_live": True, "session_title": "nested"}},
+        livestream={"is_live": False, "session_title": "top"},
+        streamer_channel={"playback_url": "https://x/m3u8"},
+        chatroom={"id": 1},
+    )
+    snap, read = scan(body)
+    assert snap.live is False and snap.title == "top"
+    assert snap.playback_url == "https://x/m3u8"
+    assert read < len(body)  # stopped before "chatroom"
+
+
+def test_null_member_and_early_end():
+    snap, read = scan(doc(id=668, livestream=None, slug="x"))
+    assert snap.live is False
+    snap, _ = scan(b'{"livestream": {"is_live": true, "categories": [{"name": "IRL"}]}}', chunk=3)
+    assert snap.live and snap.category == "IRL" and snap.playback_url is None
+
+
+def test_large_member_is_decoded_and_counted():
+    before = bot.kick_scan_stats()["large_members"]
+    big = {"is_live": True, "session_title": "big", "tags": ["x" * 100] * 1000}
+    snap, _ = scan(doc(livestream=big, streamer_channel={"playback_url": "u"}), chunk=4096)
+    assert snap.live and snap.title == "big"
+    assert bot.kick_scan_stats()["large_members"] == before + 1
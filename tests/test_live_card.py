@@ -0,0 +1,131 @@
+import dataclasses
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+import bot
+
+CARD = {"chat_id": -1001, "message_id": 7, "photo": True}
+
+
+class FakeTelegram:
+    """transport_request stand-in: records (method, caption) of card edits."""
+
+    def __init__(self):
+        self.edits = []
+
+    def __call__(self, session, method, url, **kw):
+        api = url.rsplit("/", 1)[-1]
+        body = kw.get("json") or kw.get("data") or {}
+        media = body.get("media")
+        if isinstance(media, str):
+            media = json.loads(media)
+        self.edits.append((api, body.get("caption") or (media or {}).get("caption")))
+        r = requests.Response()
+        r.url = url
+        r.status_code = 200
+        r._content = json.dumps({"ok": True, "result": True}).encode()
+        return r
+
+
+@pytest.fixture
+def card(monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(bot, "transport_request", fake)
+    monkeypatch.setattr(bot, "TG_RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(bot, "LIVE_CARD_ENABLED", True)
+    monkeypatch.setattr(bot, "LIVE_CARD_EDIT_SEC", 0)
+    monkeypatch.setattr(bot, "LIVE_CARD_MEDIA_SEC", 0)
+    monkeypatch.setattr(bot, "OUTBOX_ENABLED", True)
+    monkeypatch.setattr(bot, "OUTBOX", bot.Outbox(1))
+    monkeypatch.setattr(bot, "_SHOT_CACHE", {})
+
+    def no_ffmpeg(*a, **k):
+        raise AssertionError("ffmpeg ran in the sender")
+
+    monkeypatch.setattr(bot, "screenshot_from_m3u8", no_ffmpeg)
+    monkeypatch.setattr(bot, "screenshot_from_m3u8_fast", no_ffmpeg)
+    bot._LIVE_CARD_EDITS.clear()
+    bot._LIVE_CARD_LATEST.clear()
+    with bot.STATE_LOCK:
+        st = bot.load_state()
+        for k, v in dict(any_live=True, kick_live=True, started_at="2026-10-17T10:00:00+00:00", live_card=CARD).items():
+            st[k] = v
+        bot.save_state(st)
+    return fake
+
+
+def live_kick(title: str = "t") -> bot.PlatformSnapshot:
+    return bot.PlatformSnapshot(live=True, title=title, category="Just Chatting", viewers=100, playback_url="https://x/m3u8")
+
+
+def tick(title: str, ch=None) -> None:
+    ch = ch or bot.MAIN_CHANNEL
+    bot.live_card_tick(ch, bot.channel_view(ch), live_kick(title), bot.PlatformSnapshot(live=False), changed=False)
+
+
+def hold_chat(outbox) -> threading.Event:
+    """Keep the card's chat busy, as a slow alert upload would, until the event is set."""
+    release = threading.Event()
+    outbox.put(CARD["chat_id"], "slow upload", lambda _dl: release.wait(5), bot.PRIO_ALERT)
+    time.sleep(0.05)
+    return release
+
+
+def test_queued_edit_renders_the_latest_tick(card):
+    release = hold_chat(bot.OUTBOX)
+    tick("old title")  # queued behind the upload
+    tick("new title")  # an edit is already queued: only the data is updated
+    release.set()
+    assert bot.OUTBOX.drain(5)
+    assert len(card.edits) == 1
+    api, caption = card.edits[0]
+    assert api == "editMessageCaption"  # no cached frame: caption only, no ffmpeg
+    assert "new title" in caption and "old title" not in caption
+
+
+def test_media_edit_uses_the_cached_frame(card):
+    bot._shot_cache_set(b"\xff\xd8cached")
+    tick("t")
+    assert bot.OUTBOX.drain(5)
+    assert [api for api, _c in card.edits] == ["editMessageMedia"]
+
+
+def test_edit_queued_before_the_end_is_skipped(card):
+    release = hold_chat(bot.OUTBOX)
+    tick("t")
+    with bot.STATE_LOCK:
+        st = bot.load_state()
+        st["any_live"] = False
+        bot.save_state(st)
+    release.set()
+    assert bot.OUTBOX.drain(5)
+    assert card.edits == []
+
+
+def test_card_of_another_channel_gets_the_refreshed_frame(card, monkeypatch):
+    ch = dataclasses.replace(bot.MAIN_CHANNEL, id="second", kick_slug="second")
+    with bot.STATE_LOCK:
+        st = bot.channel_load(ch)
+        for k, v in dict(any_live=True, kick_live=True, started_at="2026-10-17T10:00:00+00:00", live_card=CARD).items():
+            st[k] = v
+        bot.channel_save(ch, st)
+    monkeypatch.setitem(bot._LAST_FETCHED, bot.fetch_key(ch, "kick"), live_kick())
+    monkeypatch.setattr(bot, "screenshot_from_m3u8_fast", lambda url: b"\xff\xd8refreshed")
+    assert bot.shot_refresh_once(ch)  # one pass of the refresher thread
+    assert not bot.shot_refresh_once(ch)  # still fresh: no second ffmpeg run
+    assert bot._shot_cache_get() is None  # the frame is the second channel's, not the main one's
+
+    monkeypatch.setattr(bot, "screenshot_from_m3u8_fast", lambda url: pytest.fail("ffmpeg ran in the sender"))
+    tick("t", ch)
+    assert bot.OUTBOX.drain(5)
+    assert [api for api, _c in card.edits] == ["editMessageMedia"]
+
+
+def test_refresher_cadence_is_within_the_frame_lifetime(monkeypatch):
+    monkeypatch.setattr(bot, "SHOT_REFRESH_SEC", 600)
+    monkeypatch.setattr(bot, "SHOT_CACHE_MAX_AGE_SEC", 60)
+    assert bot.shot_refresh_due() <= 60
@@ -0,0 +1,77 @@
+import itertools
+import json
+
+import pytest
+import requests
+
+import bot
+
+
+class FakeTelegram:
+    """transport_request stand-in: photo uploads get a new file_id; sends by file_id are recorded."""
+
+    def __init__(self):
+        self.calls = []
+        self.ids = itertools.count(1)
+
+    def __call__(self, session, method, url, **kw):
+        api = url.rsplit("/", 1)[-1]
+        body = kw.get("json") or kw.get("data") or {}
+        self.calls.append((api, "upload" if kw.get("files") else body.get("photo")))
+        n = next(self.ids)
+        result = {"message_id": n}
+        if api == "sendPhoto":
+            file_id = f"AgAC-{n}" if kw.get("files") else body.get("photo")
+            result["photo"] = [{"file_id": f"{file_id}-thumb", "width": 90}, {"file_id": file_id, "width": 1280}]
+        r = requests.Response()
+        r.url = url
+        r.status_code = 200
+        r._content = json.dumps({"ok": True, "result": result if api != "sendChatAction" else True}).encode()
+        return r
+
+
+@pytest.fixture
+def live(monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(bot, "transport_request", fake)
+    monkeypatch.setattr(bot, "TG_RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(bot, "OUTBOX_ENABLED", True)
+    monkeypatch.setattr(bot, "OUTBOX", bot.Outbox(1))
+    frames = itertools.count()
+    # Every ffmpeg run gives a different JPEG (as a live stream does): only reused bytes can hit the cache.
+    monkeypatch.setattr(bot, "screenshot_from_m3u8", lambda url, deadline=None: b"\xff\xd8frame-%d" % next(frames))
+    monkeypatch.setattr(bot, "_SHOT_CACHE", {})
+    monkeypatch.setattr(bot, "_MEDIA_CACHE", {})
+    monkeypatch.setattr(bot, "_MEDIA_COUNTERS", {"uploads": 0, "reused": 0})
+    kick = bot.PlatformSnapshot(live=True, title="t", category="Just Chatting", viewers=100, playback_url="https://x/m3u8")
+    vk = bot.PlatformSnapshot(live=False)
+    bot._cache_set_snapshot(bot.state_view(), kick, vk)
+    return fake, kick, vk
+
+
+def stream_command(n: int) -> dict:
+    return {"update_id": n, "message": {"message_id": n, "chat": {"id": -1001, "type": "supergroup"}, "text": "/stream"}}
+
+
+def test_stream_replies_reuse_the_alert_screenshot(live):
+    fake, kick, vk = live
+    bot.send_status_with_screen("start", bot.state_view(), kick, vk)
+    for n in range(3):
+        bot.handle_update(stream_command(n + 1))
+    assert bot.OUTBOX.drain(5)
+
+    photos = [photo for api, photo in fake.calls if api == "sendPhoto"]
+    assert photos[0] == "upload"
+    assert photos[1:] == ["AgAC-2"] * 3  # the alert's file_id, no new ffmpeg frame or upload
+    assert bot.media_cache_stats()["uploads"] == 1 and bot.media_cache_stats()["reused"] == 3
+
+
+def test_stale_frame_is_taken_again(live, monkeypatch):
+    fake, kick, vk = live
+    bot.handle_update(stream_command(1))
+    assert bot.OUTBOX.drain(5)
+    monkeypatch.setattr(bot, "SHOT_CACHE_MAX_AGE_SEC", -1)  # the cached frame is too old now
+    bot.handle_update(stream_command(2))
+    assert bot.OUTBOX.drain(5)
+    photos = [photo for api, photo in fake.calls if api == "sendPhoto"]
+    assert photos == ["upload", "upload"]
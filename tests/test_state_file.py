@@ -0,0 +1,31 @@
+import json
+
+import bot
+
+
+def test_oversized_state_keeps_every_channel_session(tmp_path, monkeypatch):
+    path = tmp_path / "state.json"
+    monkeypatch.setattr(bot, "STATE_FILE", str(path))
+    monkeypatch.setattr(bot, "notify_admin_dedup", lambda key, text: None)
+    started = "2026-10-17T10:00:00+00:00"
+    channels = {
+        f"ch{i}": {"started_at": started, "end_sent_for_started_at": None, "stream_stats": {"samples": list(range(400))}}
+        for i in range(30)
+    }
+    card = {"chat_id": -1001, "message_id": 7, "photo": True}
+    raw = json.dumps({"started_at": started, "live_card": card, "channels": channels, "last_change_sent_ts": 5}).encode()
+    assert len(raw) > bot.MAX_STATE_SIZE * len(bot.CHANNELS)
+    path.write_bytes(raw)
+
+    st = bot._read_state_file()
+    assert st["channels"] == channels and st["live_card"] == card and st["started_at"] == started
+    assert st["last_change_sent_ts"] == 0  # unimportant fields are still dropped
+
+
+def test_size_limit_grows_with_the_channel_count(tmp_path, monkeypatch):
+    path = tmp_path / "state.json"
+    monkeypatch.setattr(bot, "STATE_FILE", str(path))
+    monkeypatch.setattr(bot, "notify_admin_dedup", lambda key, text: None)
+    monkeypatch.setattr(bot, "CHANNELS", [bot.MAIN_CHANNEL] * 4)
+    path.write_bytes(json.dumps({"last_change_sent_ts": 5, "pad": "x" * (bot.MAX_STATE_SIZE * 2)}).encode())
+    assert bot._read_state_file()["last_change_sent_ts"] == 5  # 100 KB is normal for four channels
@@ -0,0 +1,106 @@
+import json
+import time
+
+import pytest
+import requests
+
+import bot
+
+
+class FakeTelegram:
+    """transport_request stand-in: records sendMessage calls; replies 429 with retry_after when told to."""
+
+    def __init__(self):
+        self.sent = []
+        self.reject_with = None  # retry_after for the next call
+
+    def __call__(self, session, method, url, **kw):
+        r = requests.Response()
+        r.url = url
+        if self.reject_with is not None:
+            r.status_code = 429
+            r._content = json.dumps({"ok": False, "error_code": 429, "parameters": {"retry_after": self.reject_with}}).encode()
+            self.reject_with = None
+            return r
+        self.sent.append(((kw.get("json") or {}).get("chat_id"), time.monotonic()))
+        r.status_code = 200
+        r._content = json.dumps({"ok": True, "result": {"message_id": len(self.sent)}}).encode()
+        return r
+
+
+@pytest.fixture
+def tg(monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(bot, "transport_request", fake)
+    monkeypatch.setattr(bot, "TG_RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(bot, "TG_GROUP_RATE_PER_MIN", 600.0)  # one token per 0.1 s
+    monkeypatch.setattr(bot, "TG_CHAT_BURST", 2.0)
+    monkeypatch.setattr(bot, "TG_RATE_MAX_WAIT_SEC", 0.5)
+    monkeypatch.setattr(bot, "_TG_CHAT_BUCKETS", {})
+    monkeypatch.setattr(bot, "_TG_GLOBAL_BUCKET", bot.TokenBucket(1000, 1000))
+    return fake
+
+
+def test_short_wait_is_slept_long_wait_is_deferred(tg, monkeypatch):
+    for _ in range(3):  # burst of 2, the third waits ~0.1 s
+        bot.tg_send_to(-100, None, "x")
+    assert len(tg.sent) == 3
+    assert tg.sent[2][1] - tg.sent[1][1] >= 0.08
+
+    monkeypatch.setattr(bot, "TG_RATE_MAX_WAIT_SEC", 0.01)
+    t0 = time.monotonic()
+    with pytest.raises(bot.TgRateLimited) as exc:
+        bot.tg_send_to(-100, None, "x")
+    assert time.monotonic() - t0 < 0.05  # no sleep in the caller
+    assert 0 < bot.tg_retry_after(exc.value) <= 0.2 and bot._is_retryable(exc.value)
+    assert len(tg.sent) == 3
+
+
+def test_nothing_is_sent_into_a_blocked_bucket(tg):
+    tg.reject_with = 30
+    with pytest.raises(bot.TgRateLimited) as exc:
+        bot.tg_send_to(-100, None, "x")
+    assert exc.value.retry_after == 30
+    with pytest.raises(bot.TgRateLimited):
+        bot.tg_send_to(-100, None, "x")
+    assert tg.sent == []
+    bot.tg_send_to(-200, None, "other chat")  # other chats keep going
+    assert [c for c, _t in tg.sent] == [-200]
+
+
+def test_outbox_resends_after_the_block_without_using_attempts(tg, monkeypatch):
+    monkeypatch.setattr(bot, "RETRY_MAX_ATTEMPTS", 1)  # a deferral must not count as the one attempt
+    bot.tg_rate_penalize(bot.tg_api_url("sendMessage"), {"chat_id": -100}, None, 0.3)  # an earlier 429
+    outbox = bot.Outbox(1)
+    outbox.put(-100, "alert", lambda dl: bot.tg_send_to(-100, None, "alert", retries=1), bot.PRIO_ALERT)
+    assert outbox.drain(5)
+    assert outbox.stats()["sent"] == 1 and outbox.stats()["dropped"] == 0
+    assert [c for c, _t in tg.sent] == [-100]
+
+
+def test_command_reply_is_retried_by_the_queue_not_the_commands_loop(tg, monkeypatch):
+    calls = []
+
+    def flaky(session, method, url, **kw):
+        calls.append(url)
+        if len(calls) == 1:
+            r = requests.Response()
+            r.url = url
+            r.status_code = 503
+            r._content = b'{"ok": false, "error_code": 503}'
+            return r
+        return tg(session, method, url, **kw)
+
+    def no_sleep(*a, **k):
+        raise AssertionError("a command reply slept inline")
+
+    monkeypatch.setattr(bot, "transport_request", flaky)
+    monkeypatch.setattr(bot, "_sleep_backoff", no_sleep)
+    monkeypatch.setattr(bot, "_backoff_delay", lambda *a, **k: 0.0)
+    monkeypatch.setattr(bot, "OUTBOX_ENABLED", True)
+    monkeypatch.setattr(bot, "OUTBOX", bot.Outbox(1))
+    bot._cache_set_snapshot(bot.state_view(), bot.PlatformSnapshot(live=False), bot.PlatformSnapshot(live=False))
+    bot.handle_update({"update_id": 1, "message": {"message_id": 5, "chat": {"id": -100, "type": "supergroup"}, "text": "/stream"}})
+    assert bot.OUTBOX.drain(5)
+    assert len(calls) == 2 and [c for c, _t in tg.sent] == [-100]
+    assert bot.OUTBOX.stats()["retries"] == 1